@@ -2,6 +2,7 @@
 # PagaRank job processor (DIST step)
 #
 import sys, io, json
+from collections import OrderedDict
 
 # syntax
 def syntax():
@@ -10,7 +11,7 @@ Syntax: %s <EC_HOME> <STEP_NAME> <BULK_SIZE>" % sys.argv[0]
 
 Options:
   EC_HOME   - ElasticCrawler home directory.
-  STEP_NAME - PageRank step name (INIT, DIST, RANK or PUBL).
+  STEP_NAME - PageRank step name (INIT, DIST, RANK, PUBL or LINK).
   BULK_SIZE - ElasticSearch bulk size ( > 0 ) for batch updates.
   """
 
@@ -25,15 +26,25 @@ STEP_NAME = sys.argv[2]
 BULK_SIZE = int(sys.argv[3])
 
 # validate input arguments
-if not STEP_NAME in ['INIT', 'DIST', 'RANK', 'PUBL'] or BULK_SIZE <= 0:
+if not STEP_NAME in ['INIT', 'DIST', 'RANK', 'PUBL', 'LINK'] or \
+   BULK_SIZE <= 0:
   syntax()
   sys.exit(2)
 
 # add ElasticCrawler lib to system path
 sys.path.append("%s/lib" % EC_HOME)
+import profiler
 from properties import Properties
 from elasticsearch import ElasticSearch
-from elasticcrawler import get_url_id
+from elasticcrawler import get_url_id, get_inlink_actions
+from inlinks import get_sources, get_olinks, get_inlink_docs
+from search import set_published
+from throttle import Throttle, get_options, get_status
+from pagerank import get_prob_field, get_rank, get_initial_rank, \
+  get_generation
+
+# sample the ranking step, if enabled (EC_PROFILE)
+profiler.start()
 
 # load ElasticCrawler configuarion
 conf = Properties()
@@ -44,15 +55,36 @@ ES_PORT = conf['ES_PORT']
 ES_INDEX = conf['ES_INDEX']
 ES_BASE = "http://%s:%s/%s" % (ES_HOST, ES_PORT, ES_INDEX)
 
+# DIST mode (push or pull, see elasticcrawler.conf)
+RANKING_MODE = conf['RANKING_MODE'] or 'push'
+
 # load ElasticSearch REST API module
-es = ElasticSearch()
+es = ElasticSearch(compress=conf['ES_COMPRESSION'] == 'true')
+
+# ES write throttle shared with the other writers (see lib/throttle.py)
+throttle = Throttle(ES_BASE, get_options(conf))
+
+# get current ranking generation (DIST and RANK steps)
+if STEP_NAME in ['DIST', 'RANK']:
+  GENERATION = get_generation(ES_BASE)
+  print "Generation: %d" % GENERATION
+if STEP_NAME in ['INIT', 'DIST']:
+  print "Mode: %s" % RANKING_MODE
 
 # create batch update container
 update_list = list()
 
+# bulk size of batch updates, lowered by the throttle level
+update_size = BULK_SIZE
+
 # create fetch doc id container
 fetch_list = list()
 
+# (rank, number of links) of the previous generation by doc id, pull mode,
+# least recently used ranks are dropped over RANK_CACHE_SIZE docs
+RANK_CACHE_SIZE = 100000
+rank_cache = OrderedDict()
+
 # invalid urls may contain tabs, therefore we need to hand-stitch the urls
 def get_docID_URL(line):
   parts = line.strip().split('\t')
@@ -60,54 +92,161 @@ def get_docID_URL(line):
 
 # update a batch of documents
 def batch_update(type):
-  global update_list
+  global update_list, update_size
   print "Updating %d %s docs" % (len(update_list)/2, type)
 
-  # send bulk request
+  # send bulk request, rejected items are retried by the throttle
   request = "%s/%s/_bulk" % (ES_BASE, type)
-  update = es.bulk("%s/%s/_bulk" % (ES_BASE, type), update_list)
+  update = throttle.bulk(es, request, update_list)
+  failed = [item for item in update.get('items', []) if
+    get_status(item) >= 300]
+  if 'items' not in update:
+    print "Update failed: %s" % update.get('error')
+  elif len(failed) > 0:
+    print "Update failed for %d %s docs" % (len(failed), type)
   update_list = list()
+  update_size = throttle.get_bulk_size(BULK_SIZE)
 
-# fetch a batch of docuemnts
-def batch_fetch(type):
+# fetch a batch of docuemnts, only with source field
+def batch_fetch(type, field):
   global fetch_list
   print "Fetching %d %s docs" % (len(fetch_list), type)
 
   # send mget request
   data = dict()
   data['ids'] = fetch_list
-  return es.post("%s/%s/_mget" % (ES_BASE, type), data)
+  request = "%s/%s/_mget?_source_include=%s" % (ES_BASE, type, field)
+  return es.post(request, data)
 
-# distribute a batch of docuemnts
+# finalize and distribute a batch of docuemnts, ranks of the previous
+# generation are set from its probability field, which is then cleared for
+# the next generation, and distributed into the current generation
 def batch_distribute(nodes, ranks):  
   global update_list
   print "Distributing %d docs" % (len(nodes['docs']))
+  prev_prob = get_prob_field(GENERATION - 1)
+  prob_field = get_prob_field(GENERATION)
 
   # process batch of nodes and ranks
   for node, rank in zip(nodes['docs'], ranks['docs']):
-    # get outlinks
+    # finalize ranking of the previous generation
     try:
-      olinks = node['_source']['olinks']
-      if len(olinks) == 0:
-        continue
+      ranking = get_rank(rank['_source'][prev_prob])
     except KeyError:
       continue
-    # get ranking
+    update_list.append({"update":{"_id":rank['_id'],"_retry_on_conflict":3}})
+    update_list.append({"doc":{"rank":ranking,"generation":GENERATION-1,
+      prev_prob:0.0}})
+
+    # get outlinks
     try:
-      ranking = rank['_source']['rank']
+      olinks = node['_source']['olinks']
     except KeyError:
-      continue
+      olinks = list()
 
     # calculate weighted probability
-    prob = float(ranking) / len(olinks)
+    if len(olinks) > 0:
+      prob = float(ranking) / len(olinks)
 
     # distribute weighted probability
     for link in olinks:
       doc_id = get_url_id(link)
-      update_list.append({"update":{"_id":doc_id}})
-      update_list.append({"script":"ec_rank_prob_add","params":{"delta":prob}})
-      if len(update_list) >= 2 * BULK_SIZE:
-        batch_update('rank')
+      update_list.append({"update":{"_id":doc_id,"_retry_on_conflict":3}})
+      update_list.append({"script":"ec_rank_prob_add",
+        "params":{"delta":prob,"prob":prob_field}})
+    if len(update_list) >= 2 * update_size:
+      batch_update('rank')
+
+# pull ranks of the linking nodes into a batch of documents, ranks of the
+# previous generation are set from its probability field and the probability
+# of the current generation is the sum of the linking node ranks over their
+# numbers of links; the pass only reads probabilities of the previous
+# generation, so ranks of often linking nodes stay cached across batches
+def batch_pull():
+  global update_list
+  prev_prob = get_prob_field(GENERATION - 1)
+  prob_field = get_prob_field(GENERATION)
+
+  # read inlinks, then the ranks of the docs and linking nodes not cached
+  inlinks = get_inlink_docs(es, ES_BASE, fetch_list)
+  needed = set(fetch_list)
+  for ilinks, count in inlinks.values():
+    needed.update(ilinks)
+  batch_ranks = dict()
+  missing = set()
+  for doc_id in needed:
+    if doc_id in rank_cache:
+      batch_ranks[doc_id] = rank_cache.pop(doc_id)
+    else:
+      missing.add(doc_id)
+  ranks = get_sources(es, ES_BASE, 'rank', missing, '%s,links' % prev_prob)
+  for doc_id in missing:
+    rank = ranks.get(doc_id, dict())
+    batch_ranks[doc_id] = (get_rank(rank[prev_prob]), rank.get('links', 0)) \
+      if prev_prob in rank else None
+  print "Pulling %d docs (%d ranks read)" % (len(fetch_list), len(missing))
+
+  # ranks of the batch become the most recently used
+  rank_cache.update(batch_ranks)
+  while len(rank_cache) > RANK_CACHE_SIZE:
+    rank_cache.popitem(last=False)
+
+  # one update per doc
+  for doc_id in fetch_list:
+    ranking = batch_ranks.get(doc_id)
+    if ranking is None:
+      continue
+    prob = 0.0
+    ilinks, count = inlinks.get(doc_id, ([], 0))
+    for source_id in ilinks:
+      source = batch_ranks.get(source_id)
+      if source is not None and source[1] > 0:
+        prob += source[0] / source[1]
+    # capped inlinks (MAX_INLINKS) pass the rank of all linking nodes
+    # at their mean
+    if count > len(ilinks) > 0:
+      prob *= float(count) / len(ilinks)
+    update_list.append({"update":{"_id":doc_id}})
+    update_list.append({"doc":{"rank":ranking[0],"generation":GENERATION-1,
+      prob_field:prob}})
+    if len(update_list) >= 2 * update_size:
+      batch_update('rank')
+
+# distribute (push mode) or pull (pull mode) a batch of documents
+def batch_step():
+  if RANKING_MODE == 'pull':
+    batch_pull()
+    return
+  nodes = batch_fetch('node', 'olinks')
+  ranks = batch_fetch('rank', get_prob_field(GENERATION - 1))
+  batch_distribute(nodes, ranks)
+
+# initialize a batch of rank documents, pull mode keeps the number of linked
+# urls of each node
+def batch_init():
+  global update_list
+  olinks = dict()
+  if RANKING_MODE == 'pull':
+    olinks = get_olinks(es, ES_BASE, fetch_list)
+  for doc_id in fetch_list:
+    rank = get_initial_rank()
+    if RANKING_MODE == 'pull':
+      rank['links'] = len(set(get_url_id(link)
+        for link in olinks.get(doc_id, [])))
+    update_list.append({"create":{"_id":doc_id}})
+    update_list.append(rank)
+    if len(update_list) >= 2 * update_size:
+      batch_update('rank')
+
+# add a batch of node docuemnts to the inlink index of their outlinks
+def batch_link():
+  global update_list
+  olinks = get_olinks(es, ES_BASE, fetch_list)
+  print "Linking %d docs" % (len(olinks))
+  for doc_id in fetch_list:
+    update_list.extend(get_inlink_actions(doc_id, [], olinks.get(doc_id, [])))
+    if len(update_list) >= 2 * update_size:
+      batch_update('inlink')
 
 # publish a batch of docuemnts
 def batch_publish(ranks):  
@@ -125,22 +264,24 @@ def batch_publish(ranks):
 
     update_list.append({"update":{"_id":doc_id}})
     update_list.append({"doc":{"rank":ranking+1.0}})
-    if len(update_list) >= 2 * BULK_SIZE:
+    if len(update_list) >= 2 * update_size:
       batch_update('page')
 
 # pagerank INIT job
 def pagerank_INIT():
-  global update_list
+  global fetch_list
 
   # process urls from stdin
   for line in sys.stdin:
     doc_id, url = get_docID_URL(line)
-    update_list.append({"create":{"_id":doc_id}})
-    update_list.append({"rank":1.0,"prob":0.0})
-    if len(update_list) >= 2 * BULK_SIZE:
-      batch_update('rank')
-  
+    fetch_list.append(doc_id)
+    if len(fetch_list) >= BULK_SIZE:
+      batch_init()
+      fetch_list = list()
+
   # process remaining urls
+  if len(fetch_list) > 0:
+    batch_init()
   if len(update_list) > 0:
     batch_update('rank')
 
@@ -153,31 +294,28 @@ def pagerank_DIST():
     doc_id, url = get_docID_URL(line)
     fetch_list.append(doc_id)
     if len(fetch_list) >= BULK_SIZE:
-      nodes = batch_fetch('node')
-      ranks = batch_fetch('rank')
-      batch_distribute(nodes, ranks)
+      batch_step()
       fetch_list = list()
 
   # process remaining urls
   if len(fetch_list) > 0:
-    nodes = batch_fetch('node')
-    ranks = batch_fetch('rank')
-    batch_distribute(nodes, ranks)
+    batch_step()
 
   # process remaining batch 
   if len(update_list) > 0:
     batch_update('rank')
 
-# pagerank RANK job
+# pagerank RANK job (set ranking of the current generation)
 def pagerank_RANK():
   global update_list
+  params = {"prob":get_prob_field(GENERATION),"generation":GENERATION}
 
   # process urls from stdin
   for line in sys.stdin:
     doc_id, url = get_docID_URL(line)
     update_list.append({"update":{"_id":doc_id}})
-    update_list.append({"script":"ec_rank_update"})
-    if len(update_list) >= 2 * BULK_SIZE:
+    update_list.append({"script":"ec_rank_update","params":params})
+    if len(update_list) >= 2 * update_size:
       batch_update('rank')
   
   # process remaining urls
@@ -193,19 +331,41 @@ def pagerank_PUBL():
     doc_id, url = get_docID_URL(line)
     fetch_list.append(doc_id)
     if len(fetch_list) >= BULK_SIZE:
-      ranks = batch_fetch('rank')
+      ranks = batch_fetch('rank', 'rank')
       batch_publish(ranks)
       fetch_list = list()
 
   # process remaining urls
   if len(fetch_list) > 0:
-    ranks = batch_fetch('rank')
+    ranks = batch_fetch('rank', 'rank')
     batch_publish(ranks)
        
   # process remaining urls
   if len(update_list) > 0:
     batch_update('page')
 
+  # published ranks invalidate cached search results
+  set_published(ES_BASE)
+
+# inlink index LINK job (add nodes to the inlink docs of their outlinks)
+def pagerank_LINK():
+  global fetch_list
+
+  # process urls from stdin
+  for line in sys.stdin:
+    doc_id, url = get_docID_URL(line)
+    fetch_list.append(doc_id)
+    if len(fetch_list) >= BULK_SIZE:
+      batch_link()
+      fetch_list = list()
+
+  # process remaining urls
+  if len(fetch_list) > 0:
+    batch_link()
+  if len(update_list) > 0:
+    batch_update('inlink')
+
 # call local pagerank_[STEP_NAME] method
 locals()["pagerank_%s" % STEP_NAME]()
+throttle.report_counters()
 
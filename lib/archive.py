@@ -0,0 +1,217 @@
+"""
+Raw content archive in WARC-style segment files. Each response record is
+a separate gzip member appended to the segment of its writer, so a record
+can be read at its offset without decompressing the whole segment. The
+offset index of a segment (SEGMENT.idx) has 'URL_ID OFFSET LENGTH TIME'
+lines, TIME is the append time in ms. Writers append to their segments
+concurrently, so the latest record of a url is the one with the latest
+append time, not the one in the latest segment. Segments roll over when
+they reach the segment size.
+
+"""
+import os, glob, gzip, time, uuid, zlib, bisect, heapq
+from io import BytesIO
+from array import array
+from elasticcrawler import get_url_id
+import urlids
+
+# segment file name and suffixes
+SEGMENT_PREFIX = 'ec'
+SEGMENT_SUFFIX = '.warc.gz'
+INDEX_SUFFIX = '.idx'
+
+# bits of the record offset in latest record locations, the segment number
+# is kept in the bits above
+OFFSET_BITS = 40
+
+# HTTP headers dropped from the record, archived bodies are decoded
+DECODED_HEADERS = ['content-encoding', 'transfer-encoding', 'content-length']
+
+# get index file of segment
+def get_index_file(segment):
+  return segment + INDEX_SUFFIX
+
+# get segment start time (ec-WRITER-YYYYmmddHHMMSS.warc.gz)
+def get_segment_time(segment):
+  return os.path.basename(segment)[:-len(SEGMENT_SUFFIX)].rsplit('-', 1)[1]
+
+# get segment start time in ms, the time of index lines without one
+def get_segment_time_ms(segment):
+  start = time.strptime(get_segment_time(segment), '%Y%m%d%H%M%S')
+  return long(time.mktime(start) * 1000)
+
+# list segments of directory in start time order
+def get_segments(directory):
+  return sorted(glob.glob(os.path.join(directory,
+    '%s-*%s' % (SEGMENT_PREFIX, SEGMENT_SUFFIX))),
+    key=lambda s: (get_segment_time(s), s))
+
+# get segment of writer to append to, new segment if the last one is full
+def get_writer_segment(directory, writer, segment_size):
+  pattern = '%s-%s-*%s' % (SEGMENT_PREFIX, writer, SEGMENT_SUFFIX)
+  segments = sorted(glob.glob(os.path.join(directory, pattern)))
+  if len(segments) > 0 and os.path.getsize(segments[-1]) < segment_size:
+    return segments[-1]
+  name = '%s-%s-%s%s' % (SEGMENT_PREFIX, writer,
+    time.strftime('%Y%m%d%H%M%S'), SEGMENT_SUFFIX)
+  return os.path.join(directory, name)
+
+# get HTTP headers of the final response from CURL headers file
+def get_final_headers(headers):
+  with open(headers) as f:
+    lines = [line.rstrip('\r\n') for line in f]
+  responses = list()
+  response = list()
+  for line in lines:
+    if len(line) == 0:
+      if len(response) > 0:
+        responses.append(response)
+      response = list()
+    else:
+      response.append(line)
+  if len(response) > 0:
+    responses.append(response)
+  return responses[-1] if len(responses) > 0 else list()
+
+# get WARC response record of url with HTTP headers and decoded body
+def get_record(url, http_headers, body):
+  # HTTP block with headers matching the decoded body
+  head = [http_headers[0]] if len(http_headers) > 0 else ['HTTP/1.1 200 OK']
+  for line in http_headers[1:]:
+    if line.split(':', 1)[0].strip().lower() not in DECODED_HEADERS:
+      head.append(line)
+  head.append('Content-Length: %d' % len(body))
+  block = '\r\n'.join(head) + '\r\n\r\n' + body
+
+  # WARC record
+  warc = list()
+  warc.append('WARC/1.0')
+  warc.append('WARC-Type: response')
+  warc.append('WARC-Target-URI: %s' % url)
+  warc.append('WARC-Date: %s' % time.strftime('%Y-%m-%dT%H:%M:%SZ',
+    time.gmtime()))
+  warc.append('WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4())
+  warc.append('Content-Type: application/http; msgtype=response')
+  warc.append('Content-Length: %d' % len(block))
+  return '\r\n'.join(warc) + '\r\n\r\n' + block + '\r\n\r\n'
+
+# append fetched url (headers and body files) to the writer segment,
+# returns the segment
+def append_record(directory, writer, segment_size, url, headers, body):
+  with open(body, 'rb') as f:
+    data = f.read()
+  record = get_record(url, get_final_headers(headers), data)
+
+  # compress record as separate gzip member
+  member = BytesIO()
+  with gzip.GzipFile(fileobj=member, mode='wb') as f:
+    f.write(record)
+  member = member.getvalue()
+
+  # append record, then its offset
+  segment = get_writer_segment(directory, writer, long(segment_size))
+  with open(segment, 'ab') as f:
+    f.seek(0, os.SEEK_END)
+    offset = f.tell()
+    f.write(member)
+  with open(get_index_file(segment), 'a') as f:
+    f.write('%s %d %d %d\n' % (get_url_id(url), offset, len(member),
+      long(time.time() * 1000)))
+  return segment
+
+# read segment index as list of (url id, offset, length, time), lines
+# written before append times were indexed get the segment start time
+def read_index(segment):
+  entries = list()
+  start = None
+  with open(get_index_file(segment)) as f:
+    for line in f:
+      parts = line.split()
+      if len(parts) == 4:
+        entries.append((parts[0], long(parts[1]), long(parts[2]),
+          long(parts[3])))
+      elif len(parts) == 3:
+        if start is None:
+          start = get_segment_time_ms(segment)
+        entries.append((parts[0], long(parts[1]), long(parts[2]), start))
+  return entries
+
+# parse WARC record into (url, HTTP headers, body)
+def parse_record(record):
+  warc, block = record.split('\r\n\r\n', 1)
+  url = None
+  length = len(block)
+  for line in warc.split('\r\n')[1:]:
+    name, value = line.split(':', 1)
+    name = name.strip().lower()
+    if name == 'warc-target-uri':
+      url = value.strip()
+    elif name == 'content-length':
+      length = int(value)
+  block = block[:length]
+  head, body = block.split('\r\n\r\n', 1)
+  return url, head.split('\r\n'), body
+
+# read record at offset of segment file object
+def read_record(f, offset, length):
+  f.seek(offset)
+  return parse_record(zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS))
+
+# check if offset is in sorted offsets
+def has_offset(offsets, offset):
+  index = bisect.bisect_left(offsets, offset)
+  return index < len(offsets) and offsets[index] == offset
+
+# iterate (url id, url, HTTP headers, body) of indexed segment records in
+# file order, records not in keep (sorted offsets by segment) are skipped
+def iterate_records(segment, keep = None):
+  offsets = keep.get(segment, ()) if keep is not None else None
+  with open(segment, 'rb') as f:
+    for url_id, offset, length, append_time in read_index(segment):
+      if offsets is not None and not has_offset(offsets, offset):
+        continue
+      url, headers, body = read_record(f, offset, length)
+      yield url_id, url, headers, body
+
+# iterate (time, segment number, url id, offset) of index entries of
+# segment, in append time order
+def iterate_entries(number, segment):
+  for url_id, offset, length, append_time in read_index(segment):
+    yield append_time, number, url_id, offset
+
+# iterate (url id digest, location) of index entries of segments in append
+# time order (each segment is in append order, segments are merged),
+# locations are segment numbers and offsets packed in a long
+def iterate_locations(segments):
+  entries = [iterate_entries(number, segment) for number, segment in
+    enumerate(segments)]
+  for append_time, number, url_id, offset in heapq.merge(*entries):
+    yield urlids.to_binary(url_id), (number << OFFSET_BITS) | offset
+
+# get latest record offsets of each url in segments, as sorted offset arrays
+# by segment, records appended later win (any segment); url ids are kept in
+# a compact id map (see urlids) instead of a dict of hex ids
+def get_latest_records(segments):
+  segments = sorted(segments, key=lambda s: (get_segment_time(s), s))
+  latest = urlids.build_map(iterate_locations(segments))
+  records = dict((segment, array('l')) for segment in segments)
+  mask = (1 << OFFSET_BITS) - 1
+  for location in latest.values:
+    records[segments[location >> OFFSET_BITS]].append(location & mask)
+  del latest
+  for segment, offsets in records.items():
+    records[segment] = array('l', sorted(offsets))
+  return records
+
+# find latest archived record (url, HTTP headers, body) of url in directory
+def find_record(directory, url):
+  url_id = get_url_id(url)
+  found = None
+  for segment in get_segments(directory):
+    for entry in read_index(segment):
+      if entry[0] == url_id and (found is None or entry[3] >= found[3]):
+        found = (segment, entry[1], entry[2], entry[3])
+  if found is None:
+    return None
+  with open(found[0], 'rb') as f:
+    return read_record(f, found[1], found[2])
@@ -4,6 +4,7 @@ The headers can be obtained by calling: curl -D 'headers' 'url'.
 Currenlty supported formats are for protocols: HTTP, HTTPS.
 
 """
+from urlparse import urljoin
 
 class Curlheaders:
   # response codes and headers container
@@ -61,4 +62,27 @@ class Curlheaders:
       return self.responses[response_index]['head'][header_name]
     except KeyError:
       return None
-      
+
+  def redirect_chain(self, url):
+    # follow location headers from url, a (url, code) hop per redirect and
+    # the last item for the last response: its url and code, or the target
+    # of its location and its 3xx code if curl stopped on a redirect
+    chain = list()
+    count = self.response_count()
+    for i in range(count):
+      code = self.http_code(i)
+      location = self.http_header(i, 'location')
+      if code.startswith('3') and location is not None:
+        chain.append((url, code))
+        url = urljoin(url, location)
+        if i == count - 1:
+          chain.append((url, code))
+      elif i == count - 1:
+        chain.append((url, code))
+    return chain
+
+  def redirect_unresolved(self):
+    # is the last response a redirect (curl stopped on max redirects)
+    count = self.response_count()
+    return count > 0 and self.http_code(count-1).startswith('3') and \
+      self.http_header(count-1, 'location') is not None
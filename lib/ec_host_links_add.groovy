@@ -0,0 +1,11 @@
+if (ctx._source.urls == null) {
+  ctx._source.urls = 0
+}
+ctx._source.urls += urls
+if (ctx._source.rejected_links == null) {
+  ctx._source.rejected_links = [:]
+}
+for (e in rejected.entrySet()) {
+  def count = ctx._source.rejected_links[e.key] ?: 0
+  ctx._source.rejected_links[e.key] = count + e.value
+}
@@ -0,0 +1,8 @@
+if (ctx._source.redirects == null) {
+  ctx._source.redirects = []
+}
+ctx._source.redirects.removeAll { it.startsWith(id + ' ') }
+ctx._source.redirects.add(redirect)
+if (ctx._source.redirects.size() > limit) {
+  ctx._source.redirects.remove(0)
+}
@@ -0,0 +1,16 @@
+if (ctx._source.rejected == null) {
+  ctx._source.rejected = []
+}
+def old = ctx._source.rejected.find { it.startsWith(pattern + ' ') }
+if (old != null) {
+  ctx._source.rejected.remove(old)
+}
+if (type != null) {
+  def count = old != null ? old.split(' ')[1].toInteger() + 1 : 1
+  ctx._source.rejected.add(pattern + ' ' + count + ' ' + type)
+  if (ctx._source.rejected.size() > limit) {
+    ctx._source.rejected.remove(0)
+  }
+} else if (old == null) {
+  ctx.op = 'none'
+}
@@ -0,0 +1,18 @@
+def s = ctx._source
+if (s.response_time == null) {
+  s.response_time = time
+} else {
+  s.response_time += alpha * (time - s.response_time)
+}
+s.timeouts = (1 - alpha) * (s.timeouts ?: 0) + timeout
+s.errors = (1 - alpha) * (s.errors ?: 0) + error
+if (timeout + error > 0) {
+  s.failures = (s.failures ?: 0) + 1
+  if (s.failures >= threshold) {
+    def exponent = Math.min(20, s.failures - threshold)
+    s.breaker_until = now + Math.min(max_backoff, backoff * (1L << exponent))
+  }
+} else {
+  s.failures = 0
+  s.breaker_until = 0
+}
@@ -0,0 +1,24 @@
+if (ctx._source.ilinks == null) {
+  ctx._source.ilinks = []
+}
+if (ctx._source.count == null) {
+  ctx._source.count = ctx._source.ilinks.size()
+}
+for (id in remove) {
+  // ids beyond max are not kept, but counted
+  if (ctx._source.ilinks.remove(id) ||
+    ctx._source.count > ctx._source.ilinks.size()) {
+    ctx._source.count -= 1
+  }
+}
+for (id in add) {
+  if (!ctx._source.ilinks.contains(id)) {
+    if (ctx._source.ilinks.size() < max) {
+      ctx._source.ilinks.add(id)
+    }
+    ctx._source.count += 1
+  }
+}
+if (ctx._source.count <= 0) {
+  ctx.op = 'delete'
+}
@@ -0,0 +1,2 @@
+ctx._source.lastmod = lastmod
+ctx._source.remove('status')
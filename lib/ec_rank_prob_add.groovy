@@ -1 +1 @@
-ctx._source.prob += delta
+ctx._source[prob] += delta
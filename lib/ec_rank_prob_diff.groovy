@@ -1,2 +1,2 @@
 D = 0.85
-_source.rank - (1.0 - D + D * _source.prob)
+_source.rank - (1.0 - D + D * _source[prob])
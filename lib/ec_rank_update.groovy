@@ -1,3 +1,3 @@
 D = 0.85
-ctx._source.rank = 1.0 - D + D * ctx._source.prob
-ctx._source.prob = 0
+ctx._source.rank = 1.0 - D + D * ctx._source[prob]
+ctx._source.generation = generation
@@ -0,0 +1,14 @@
+ctx._source['any'] += deltas['any']
+ctx._source['new'] += deltas['new']
+if (ctx._source.tags == null) {
+  ctx._source.tags = [:]
+}
+for (delta in deltas['tags'].entrySet()) {
+  def counts = ctx._source.tags[delta.key]
+  if (counts == null) {
+    counts = ['any' : 0, 'new' : 0]
+    ctx._source.tags[delta.key] = counts
+  }
+  counts['any'] += delta.value['any']
+  counts['new'] += delta.value['new']
+}
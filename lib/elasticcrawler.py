@@ -1,10 +1,33 @@
-import os, sys, socket, hashlib, traceback, json, robotparser
+import os, sys, socket, hashlib, traceback, json, robotparser, time
 from BeautifulSoup import BeautifulSoup as BS
 from urlparse import urlparse, urlunparse
+from urllib import unquote
 from curlheaders import Curlheaders
 from properties import Properties 
 from IPy import IP
 
+# permanent HTTP redirect codes, cached in host docs
+PERMANENT_REDIRECTS = ['301', '308']
+
+# maximum number of redirects cached in a host doc
+MAX_HOST_REDIRECTS = 1000
+
+# maximum number of linking node ids kept in an inlink doc, the count of
+# linking nodes stays exact
+MAX_INLINKS = 10000
+
+# maximum number of rejected url path patterns cached in a host doc
+MAX_HOST_REJECTED = 100
+
+# default ports dropped from canonical urls
+DEFAULT_PORTS = {'http' : '80', 'https' : '443'}
+
+# weight of the last fetch in rolling host stats
+HOST_STATS_ALPHA = 0.2
+
+# maximum host circuit breaker backoff in seconds
+MAX_BREAKER_BACKOFF = 86400
+
 # check if IP4 address is valid
 def is_valid_ipv4_address(address):
     try:
@@ -76,6 +99,88 @@ def get_valid_url(url):
   scheme, netloc, path, params, query, fragment = urlparse(url)
   return urlunparse((scheme, netloc, path, params, query, scheme))
 
+# check if parameter name matches one of comma separated names, '*' suffix
+# matches a name prefix
+def is_parameter_matched(name, names):
+  name = unquote(name).strip().lower()
+  for n in names.replace(' ', '').lower().split(','):
+    if len(n) == 0:
+      continue
+    elif n.endswith('*') and name.startswith(n[:-1]):
+      return True
+    elif n == name:
+      return True
+  return False
+
+# get canonical url: lowercase scheme and host, no default port and
+# fragment, path and query parameters in strip removed, query sorted; an
+# empty path is kept (no '/' added), so host root urls keep their node ids
+def get_canonical_url(url, strip):
+  scheme, netloc, path, params, query, fragment = urlparse(url)
+  scheme = scheme.lower()
+
+  # lowercase host, drop default port
+  userinfo, at, hostport = netloc.rpartition('@')
+  hostport = hostport.lower()
+  port = DEFAULT_PORTS.get(scheme)
+  if port is not None and hostport.endswith(':' + port):
+    hostport = hostport[:-len(port)-1]
+  netloc = userinfo + at + hostport
+
+  # strip session ids from path parameters (ie: ;jsessionid=X)
+  params = ';'.join(p for p in params.split(';') if len(p) > 0 and
+    not is_parameter_matched(p.split('=')[0], strip))
+
+  # strip tracking and session parameters, sort the rest
+  query = '&'.join(sorted((p for p in query.split('&') if len(p) > 0 and
+    not is_parameter_matched(p.split('=')[0], strip)),
+    key=lambda p: p.split('=')[0]))
+
+  return urlunparse((scheme, netloc, path, params, query, ''))
+
+# get reason (depth, query, repeat, urls) to reject link to a url of a host
+# with known urls, None if the url is within limits (-1 for no limit)
+def get_link_rejection(url, known, max_depth, max_params, max_repeats,
+  max_urls):
+  url_parsed = urlparse(url)
+  segments = [s for s in url_parsed.path.split('/') if len(s) > 0]
+  if max_depth >= 0 and len(segments) > max_depth:
+    return 'depth'
+  params = [p for p in url_parsed.query.split('&') if len(p) > 0]
+  if max_params >= 0 and len(params) > max_params:
+    return 'query'
+  if max_repeats >= 0 and len(segments) > 0 and \
+     max(segments.count(s) for s in set(segments)) > max_repeats:
+    return 'repeat'
+  if max_urls >= 0 and known >= max_urls:
+    return 'urls'
+  return None
+
+# get host update actions adding created and rejected link counts,
+# hosts maps host id to (created, {reason : rejected})
+def get_host_links_actions(hosts):
+  actions = list()
+  for host_id, (created, rejected) in hosts.items():
+    # host update action
+    host_action = dict()
+    host_action['update'] = dict()
+    host_action['update']['_type'] = 'host'
+    host_action['update']['_id'] = host_id
+
+    # host update data
+    host_data = dict()
+    host_data['script'] = 'ec_host_links_add'
+    host_data['params'] = dict()
+    host_data['params']['urls'] = created
+    host_data['params']['rejected'] = rejected
+    host_data['upsert'] = dict()
+    host_data['upsert']['urls'] = created
+    host_data['upsert']['rejected_links'] = rejected
+
+    actions.append(host_action)
+    actions.append(host_data)
+  return actions
+
 # get robots url
 def get_robots_url(url):
   scheme, netloc, path, params, query, fragment = urlparse(url)
@@ -87,6 +192,30 @@ def get_netloc_id(url):
   hash.update(urlparse(url).netloc)
   return hash.hexdigest();
 
+# get host partition of url (jump consistent hash of network location id)
+def get_host_partition(url, count):
+  key = long(get_netloc_id(url)[:16], 16)
+  bucket, jump = -1, 0
+  while jump < count:
+    bucket = jump
+    key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+    jump = long((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+  return int(bucket)
+
+# split urls into files of host partitions (prefix.PARTITION), every
+# partition gets a file
+def split_host_partitions(urls, prefix, count):
+  files = [open('%s.%d' % (prefix, p), 'w') for p in range(count)]
+  try:
+    with open(urls) as fin:
+      for url in fin:
+        url = url.strip()
+        if len(url) > 0:
+          files[get_host_partition(url, count)].write('%s\n' % url)
+  finally:
+    for f in files:
+      f.close()
+
 # get HTTP response code
 def get_response_code(headers):
   ch = Curlheaders(headers)
@@ -99,6 +228,285 @@ def get_header_value(headers, name):
   count = ch.response_count()
   return ch.http_header(count-1, name)
 
+# get HTTP redirect chain as list of (url, code) (see
+# Curlheaders.redirect_chain) and final url, the final url of a chain ending
+# on a redirect (unresolved) is the last fetched url, the source of that
+# redirect; redirect targets are canonical like links (strip parameters)
+def get_redirects(headers, url, strip = ''):
+  ch = Curlheaders(headers)
+  chain = ch.redirect_chain(url)
+  chain = chain[:1] + [(get_canonical_url(target, strip), code)
+    for target, code in chain[1:]]
+  final = chain[-2][0] if ch.redirect_unresolved() else chain[-1][0]
+  return chain, final
+
+# get final url after following redirects
+def get_final_url(headers, url, strip = ''):
+  return get_redirects(headers, url, strip)[1]
+
+# get cached redirect (code, target) of url from host redirects file
+def get_cached_redirect(redirects, url):
+  url_id = get_url_id(url)
+  with open(redirects) as f:
+    for line in f:
+      parts = line.strip().split(' ', 2)
+      if len(parts) == 3 and parts[0] == url_id:
+        return parts[1], parts[2]
+  return None
+
+# get cached redirect target of url, hosts maps host id to redirect lines
+def get_redirect_target(url, hosts, hops = 5):
+  for hop in range(hops):
+    url_id = get_url_id(url)
+    target = None
+    for line in hosts.get(get_netloc_id(url), []):
+      parts = line.split(' ', 2)
+      if len(parts) == 3 and parts[0] == url_id:
+        target = parts[2]
+        break
+    if target is None:
+      break
+    url = target
+  return url
+
+# get redirect update actions of source url
+def get_redirect_actions(url, code, target):
+  actions = []
+
+  # node update action, source node points to redirect target
+  node_action = dict()
+  node_action['update'] = dict()
+  node_action['update']['_type'] = 'node'
+  node_action['update']['_id'] = get_url_id(url)
+
+  # node update data
+  node_data = dict()
+  node_data['doc_as_upsert'] = True
+  node_data['doc'] = dict()
+  node_data['doc']['url'] = url
+  node_data['doc']['status'] = code
+  node_data['doc']['redirect'] = target
+
+  actions.append(node_action)
+  actions.append(node_data)
+
+  # permanent redirects are cached in host doc as 'URL_ID CODE TARGET'
+  if code in PERMANENT_REDIRECTS:
+    host_action = dict()
+    host_action['update'] = dict()
+    host_action['update']['_type'] = 'host'
+    host_action['update']['_id'] = get_netloc_id(url)
+
+    # host update data
+    redirect = '%s %s %s' % (get_url_id(url), code, target)
+    host_data = dict()
+    host_data['script'] = 'ec_host_redirect_add'
+    host_data['params'] = dict()
+    host_data['params']['id'] = get_url_id(url)
+    host_data['params']['redirect'] = redirect
+    host_data['params']['limit'] = MAX_HOST_REDIRECTS
+    host_data['upsert'] = dict()
+    host_data['upsert']['redirects'] = [redirect]
+
+    actions.append(host_action)
+    actions.append(host_data)
+
+  return actions
+
+# get redirect update request of source url
+def get_redirect_update_request(url, code, target):
+  actions = get_redirect_actions(url, code, target)
+  return '\n'.join(json.JSONEncoder().encode(a) for a in actions)
+
+# get url path pattern (folder, extension and query keys), ie: /img/*.php?id
+def get_path_pattern(url):
+  url_parsed = urlparse(url)
+  path = url_parsed.path if len(url_parsed.path) > 0 else '/'
+  folder, name = path.rsplit('/', 1)
+  pattern = '%s/*%s' % (folder, os.path.splitext(name)[1].lower())
+  keys = sorted(set(p.split('=')[0] for p in url_parsed.query.split('&')
+    if len(p) > 0))
+  if len(keys) > 0:
+    pattern += '?' + '&'.join(keys)
+  return pattern.replace(' ', '%20')
+
+# read rejected patterns file ('PATTERN COUNT TYPE' lines) as list of tuples
+def read_rejected_patterns(rejected):
+  patterns = list()
+  if os.path.exists(rejected):
+    with open(rejected) as f:
+      for line in f:
+        parts = line.strip().split(' ', 2)
+        if len(parts) == 3:
+          patterns.append((parts[0], int(parts[1]), parts[2]))
+  return patterns
+
+# get content type rejected for url path pattern at least threshold times
+def get_rejected_type(rejected, url, threshold):
+  pattern = get_path_pattern(url)
+  for p, count, content_type in read_rejected_patterns(rejected):
+    if p == pattern and count >= threshold:
+      return content_type
+  return None
+
+# count content type rejection of url pattern in local rejected patterns
+# file, accepted fetch of the pattern clears it (same as host reject script)
+def update_rejected_file(rejected, url, content_type, accepted):
+  pattern = get_path_pattern(url)
+  patterns = read_rejected_patterns(rejected)
+  old = [p for p in patterns if p[0] == pattern]
+  patterns = [p for p in patterns if p[0] != pattern]
+  if content_type:
+    count = old[0][1] + 1 if old else 1
+    patterns.append((pattern, count, content_type))
+  elif not accepted or not old:
+    return
+  with open(rejected, 'w') as f:
+    for p in patterns[-MAX_HOST_REJECTED:]:
+      f.write('%s %d %s\n' % p)
+
+# get host update actions counting content type rejection of url pattern,
+# content type None clears the pattern
+def get_reject_actions(url, content_type):
+  # host update action
+  host_action = dict()
+  host_action['update'] = dict()
+  host_action['update']['_type'] = 'host'
+  host_action['update']['_id'] = get_netloc_id(url)
+
+  # host update data, patterns are cached as 'PATTERN COUNT TYPE'
+  pattern = get_path_pattern(url)
+  host_data = dict()
+  host_data['script'] = 'ec_host_reject_update'
+  host_data['params'] = dict()
+  host_data['params']['pattern'] = pattern
+  host_data['params']['type'] = content_type
+  host_data['params']['limit'] = MAX_HOST_REJECTED
+  host_data['upsert'] = dict()
+  host_data['upsert']['rejected'] = []
+  if content_type:
+    host_data['upsert']['rejected'].append('%s 1 %s' % (pattern,
+      content_type))
+
+  return [host_action, host_data]
+
+# update rolling host stats with fetch time (ms) and outcome (ok, timeout,
+# error), open circuit breaker after threshold consecutive failures
+def update_host_stats(stats, fetch_time, outcome, threshold, backoff, now):
+  timeout = 1 if outcome == 'timeout' else 0
+  error = 1 if outcome == 'error' else 0
+  alpha = HOST_STATS_ALPHA
+
+  # rolling response time and failure counts
+  if stats.get('response_time') is None:
+    stats['response_time'] = fetch_time
+  else:
+    stats['response_time'] += alpha * (fetch_time - stats['response_time'])
+  stats['timeouts'] = (1 - alpha) * stats.get('timeouts', 0) + timeout
+  stats['errors'] = (1 - alpha) * stats.get('errors', 0) + error
+
+  # consecutive failures, backoff doubles with each failure over threshold
+  if timeout + error > 0:
+    stats['failures'] = stats.get('failures', 0) + 1
+    if stats['failures'] >= threshold:
+      exponent = min(20, stats['failures'] - threshold)
+      delay = min(MAX_BREAKER_BACKOFF, backoff * 2 ** exponent)
+      stats['breaker_until'] = now + delay * 1000
+  else:
+    stats['failures'] = 0
+    stats['breaker_until'] = 0
+  return stats
+
+# get host stats update actions of a fetch (dict of time, outcome, threshold,
+# backoff)
+def get_host_stats_actions(url, fetch):
+  now = int(time.time() * 1000)
+
+  # host update action
+  host_action = dict()
+  host_action['update'] = dict()
+  host_action['update']['_type'] = 'host'
+  host_action['update']['_id'] = get_netloc_id(url)
+
+  # host update data, same rules as update_host_stats
+  host_data = dict()
+  host_data['script'] = 'ec_host_stats_update'
+  host_data['params'] = dict()
+  host_data['params']['time'] = fetch['time']
+  host_data['params']['timeout'] = 1 if fetch['outcome'] == 'timeout' else 0
+  host_data['params']['error'] = 1 if fetch['outcome'] == 'error' else 0
+  host_data['params']['alpha'] = HOST_STATS_ALPHA
+  host_data['params']['threshold'] = fetch['threshold']
+  host_data['params']['backoff'] = fetch['backoff'] * 1000
+  host_data['params']['max_backoff'] = MAX_BREAKER_BACKOFF * 1000
+  host_data['params']['now'] = now
+  host_data['upsert'] = update_host_stats(dict(), fetch['time'],
+    fetch['outcome'], fetch['threshold'], fetch['backoff'], now)
+
+  return [host_action, host_data]
+
+# update local host stats file (json) with fetch time and outcome
+def update_host_stats_file(hoststats, time_ms, outcome, threshold, backoff):
+  with open(hoststats) as f:
+    stats = json.load(f)
+  now = int(time.time() * 1000)
+  update_host_stats(stats, time_ms, outcome, threshold, backoff, now)
+  with open(hoststats, 'w') as f:
+    json.dump(stats, f)
+
+# get Crawl-delay in seconds from robots for user agent, None if not set
+def get_crawl_delay(robots, user_agent):
+  agent = user_agent.split('/')[0].lower()
+  delays = dict()
+  agents = list()
+  group = True
+  with open(robots) as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+      if ':' not in line:
+        continue
+      name, value = [part.strip() for part in line.split(':', 1)]
+      name = name.lower()
+      if name == 'user-agent':
+        # consecutive user-agent lines share the group
+        if not group:
+          agents = list()
+        agents.append(value.lower())
+        group = True
+      else:
+        group = False
+        if name == 'crawl-delay':
+          try:
+            for a in agents:
+              delays.setdefault(a, float(value))
+          except ValueError:
+            pass
+
+  # agent specific delay, then default
+  for a, delay in delays.items():
+    if a != '*' and a in agent:
+      return delay
+  return delays.get('*')
+
+# get host fetch schedule: access delay and breaker end time in seconds
+def get_host_schedule(hoststats, robots, user_agent, min_delay, max_delay,
+  factor):
+  with open(hoststats) as f:
+    stats = json.load(f)
+
+  # delay grows with response time and recent failures
+  delay = max(min_delay, factor * stats.get('response_time', 0) / 1000.0)
+  delay *= 1 + stats.get('timeouts', 0) + stats.get('errors', 0)
+  delay = min(max_delay, delay)
+
+  # robots Crawl-delay is always respected
+  crawl_delay = get_crawl_delay(robots, user_agent)
+  if crawl_delay is not None:
+    delay = max(delay, crawl_delay)
+
+  breaker_until = stats.get('breaker_until', 0) / 1000
+  return int(round(delay)), int(breaker_until)
+
 # get robots create request
 def get_robots_create_request(robots, robots_url):
   # create document
@@ -113,6 +521,18 @@ def get_robots_create_request(robots, robots_url):
   jdoc = json.JSONEncoder().encode(doc)
   return jdoc
 
+# get robots update request, keeps other fields of host doc (e.g. redirects)
+def get_robots_update_request(robots, robots_url):
+  # create update
+  update = dict()
+  update['doc'] = json.JSONDecoder().decode(
+    get_robots_create_request(robots, robots_url))
+  update['doc_as_upsert'] = True
+
+  # convert to json update
+  jupdate = json.JSONEncoder().encode(update)
+  return jupdate
+
 # decode json encoded file
 def json_decode(jsonfile):
   # read json file
@@ -123,12 +543,61 @@ def json_decode(jsonfile):
   text = json.JSONDecoder().decode(jtext)
   return text if text is not None else ''
 
+# read outlinks file
+def read_outlinks(outlinks):
+  with open(outlinks) as f:
+    return [link.strip() for link in f.readlines()]
+
+# get page update actions of url with title (subject) and content
+def get_page_actions(url, subject, content, upsert = True):
+  # separate title and content
+  with open(subject) as f:
+    title = f.read()
+  with open(content) as f:
+    body = f.read()
+  if body.startswith(title):
+    body = body[len(title):]
+
+  # page update action
+  page_action = dict()
+  page_action['update'] = dict()
+  page_action['update']['_type'] = 'page'
+  page_action['update']['_id'] = get_url_id(url)
+
+  # page update data
+  page_data = dict()
+  page_data['doc_as_upsert'] = upsert
+  page_data['doc'] = dict()
+  page_data['doc']['title'] = title
+  page_data['doc']['body'] = body
+  page_data['doc']['url'] = url
+
+  return [page_action, page_data]
+
 # get search index update request
-def get_index_update_request(url, status, okcodes, subject, content, outlinks):
-  
+def get_index_update_request(url, status, okcodes, subject, content, outlinks,
+  headers = None, fetch = None, previous = None, strip = ''):
+
   # create empty updates list
   request = []
 
+  # host stats of fetched url
+  host_stats = get_host_stats_actions(url, fetch) if fetch else []
+
+  # learn rejected content type of url pattern, clear it on accepted fetch
+  if fetch and fetch.get('rejected'):
+    host_stats.extend(get_reject_actions(url, fetch['rejected']))
+  elif fetch and fetch.get('patterns') and status in okcodes and \
+       get_rejected_type(fetch['patterns'], url, 1) is not None:
+    host_stats.extend(get_reject_actions(url, None))
+
+  # content belongs to the final url, redirect sources point to their targets
+  redirects = []
+  if headers:
+    chain, url = get_redirects(headers, url, strip)
+    for (source, code), (target, final) in zip(chain, chain[1:]):
+      redirects.extend(get_redirect_actions(source, code, target))
+
   # url id, host id
   url_id = get_url_id(url)
   host_id = get_netloc_id(url)
@@ -157,37 +626,25 @@ def get_index_update_request(url, status, okcodes, subject, content, outlinks):
   host_data['doc_as_upsert'] = True
   host_data['doc'] = dict()
 
+  # host stats update also updates _timestamp of the fetched host
+  if host_stats and host_stats[0]['update']['_id'] == host_id:
+    host_data = host_stats[1]
+    host_stats = host_stats[2:]
+
   # if success update page
+  inlinks = []
   if status in okcodes:
     # extended node data
-    with open(outlinks) as f:
-      node_data['doc']['olinks'] = [link.strip() for link in f.readlines()]
-
-    # separate title and content
-    with open(subject) as f:
-      title = f.read()
-    with open(content) as f:
-      body = f.read()
-    if body.startswith(title):
-      body = body[len(title):]
-
-    # page update action
-    page_action = dict()
-    page_action['update'] = dict()
-    page_action['update']['_type'] = 'page'
-    page_action['update']['_id'] = url_id
-
-    # page update data
-    page_data = dict()
-    page_data['doc_as_upsert'] = True
-    page_data['doc'] = dict()
-    page_data['doc']['title'] = title
-    page_data['doc']['body'] = body
-    page_data['doc']['url'] = url
+    node_data['doc']['olinks'] = read_outlinks(outlinks)
+
+    # inlink index follows the olinks diff, if previous olinks are given
+    if previous is not None:
+      inlinks = get_inlink_actions(url_id, previous,
+        node_data['doc']['olinks'])
 
     # output create actions
-    request.append(json.JSONEncoder().encode(page_action))
-    request.append(json.JSONEncoder().encode(page_data))
+    for action in get_page_actions(url, subject, content):
+      request.append(json.JSONEncoder().encode(action))
 
   # output update action
   request.append(json.JSONEncoder().encode(node_action))
@@ -197,64 +654,110 @@ def get_index_update_request(url, status, okcodes, subject, content, outlinks):
   request.append(json.JSONEncoder().encode(host_action))
   request.append(json.JSONEncoder().encode(host_data))
 
+  # output host stats, redirect and inlink updates
+  for action in host_stats + redirects + inlinks:
+    request.append(json.JSONEncoder().encode(action))
+
   return '\n'.join(line for line in request)
 
+# get inlink update actions of node olinks change, linked url ids added to
+# and removed from the node olinks get the node id added to or removed from
+# their inlink doc (see lib/inlinks.py), up to MAX_INLINKS ids are kept
+def get_inlink_actions(url_id, previous, current):
+  actions = []
+  previous_ids = set(get_url_id(link) for link in previous)
+  current_ids = set(get_url_id(link) for link in current)
+  changes = [(target, True) for target in current_ids - previous_ids]
+  changes.extend((target, False) for target in previous_ids - current_ids)
+  for target, added in sorted(changes):
+    # inlink update action
+    inlink_action = dict()
+    inlink_action['update'] = dict()
+    inlink_action['update']['_type'] = 'inlink'
+    inlink_action['update']['_id'] = target
+    inlink_action['update']['_retry_on_conflict'] = 3
+
+    # inlink update data, removals from a missing doc leave an empty doc
+    inlink_data = dict()
+    inlink_data['script'] = 'ec_inlink_update'
+    inlink_data['params'] = dict()
+    inlink_data['params']['add'] = [url_id] if added else []
+    inlink_data['params']['remove'] = [] if added else [url_id]
+    inlink_data['params']['max'] = MAX_INLINKS
+    inlink_data['upsert'] = dict()
+    inlink_data['upsert']['ilinks'] = inlink_data['params']['add']
+    inlink_data['upsert']['count'] = len(inlink_data['params']['add'])
+
+    actions.append(inlink_action)
+    actions.append(inlink_data)
+  return actions
+
 # is access allowed by client
 def is_client_access_allowed(url, config, allowed, excluded):
+  rules = get_client_access_rules(config, allowed, excluded)
+  return is_access_allowed(url, rules)
 
-  # get url blocks
-  url_parsed = urlparse(url)
-  protocol = url_parsed.scheme
-  hostname = url_parsed.hostname
-  path = url_parsed.path
+# read client access rules of EC configuration and allowed and excluded host
+# files, to check many urls with is_access_allowed
+def get_client_access_rules(config, allowed, excluded):
+  rules = dict()
 
   # read config variables
   conf = Properties()
   with open(config) as f:
     conf.load(f)
-
-  # check allowed protocols
-  allowed_protocols = conf['ALLOWED_PROTOCOLS'].replace(' ', '').split(',')
-  if url_parsed.scheme not in allowed_protocols:
-    return False
-
-  # check excluded file types
-  exluded_types = conf['EXCLUDE_FILE_TYPES'].replace(' ', '').split(',')
-  dot_index = path.rfind('.', 0)
-  if dot_index > 0 and path[dot_index+1:].lower() in exluded_types:
-    return False
+  rules['protocols'] = conf['ALLOWED_PROTOCOLS'].replace(' ', '').split(',')
+  rules['types'] = conf['EXCLUDE_FILE_TYPES'].replace(' ', '').split(',')
 
   # get host groups flags
-  exclude_privates = True if conf['EXCLUDE_PRIVATE_HOSTS'] == 'true' else False
-  exclude_singles = True if conf['EXCLUDE_SINGLE_HOSTS'] == 'true' else False
+  rules['privates'] = conf['EXCLUDE_PRIVATE_HOSTS'] == 'true'
+  rules['singles'] = conf['EXCLUDE_SINGLE_HOSTS'] == 'true'
 
   # read exluded hosts
   with open(excluded) as f:
-    excluded_hosts = [host.strip() for host in f.readlines()]
+    rules['excluded'] = set(host.strip() for host in f.readlines())
 
   # read allowed hosts
   with open(allowed) as f:
-    allowed_hosts = [host.strip() for host in f.readlines()]
+    rules['allowed'] = set(host.strip() for host in f.readlines())
+  return rules
+
+# is host access allowed by client access rules
+def is_access_allowed(url, rules):
+
+  # get url blocks
+  url_parsed = urlparse(url)
+  hostname = url_parsed.hostname
+  path = url_parsed.path
+
+  # check allowed protocols
+  if url_parsed.scheme not in rules['protocols']:
+    return False
+
+  # check excluded file types
+  dot_index = path.rfind('.', 0)
+  if dot_index > 0 and path[dot_index+1:].lower() in rules['types']:
+    return False
 
   # validate address
   if hostname == None or len(hostname) == 0:
     return False;
 
   # check excluded hosts
-  if hostname in excluded_hosts:
+  if hostname in rules['excluded']:
     return False
 
   # check allowed hosts
-  if len(allowed_hosts) > 0 and (hostname not in allowed_hosts):
+  if len(rules['allowed']) > 0 and (hostname not in rules['allowed']):
     return False
 
   # exclude private hosts
-  if exclude_privates == True:
+  if rules['privates'] == True:
     if is_ip_address_private(hostname):
       return False
 
   # exclude single hosts
-  if exclude_singles == True:
+  if rules['singles'] == True:
     if len(hostname.split('.')) == 1:
       return False
 
@@ -273,11 +776,11 @@ def is_robot_access_allowed(url, robots, user_agent):
 
   # check access
   agent  = user_agent.split('/')[0]
-  if not parser.can_fetch(agent, url):
-    sys.exit(1)
+  return parser.can_fetch(agent, url)
 
-# extract links and title
-def extract_links_and_title(url, html, protocols, excluded, outlinks, subject):
+# extract links and title, links are canonical if strip parameters are given
+def extract_links_and_title(url, html, protocols, excluded, outlinks, subject,
+  strip = None):
   # parse parent URL
   p_scheme, p_netloc, p_path, p_params, p_query, p_fragment = urlparse(url)
 
@@ -311,6 +814,8 @@ def extract_links_and_title(url, html, protocols, excluded, outlinks, subject):
       params    = p_params    if params   is '' else params
       fragment  = ''
       href = urlunparse((scheme, netloc, path, params, query, fragment))
+      if strip is not None:
+        href = get_canonical_url(href, strip)
       if scheme in protocols and href not in hrefs and href is not url:
         hrefs.add(href)
 
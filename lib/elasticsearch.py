@@ -1,4 +1,4 @@
-import json, pycurl
+import json, gzip, pycurl
 from io import BytesIO
 
 """
@@ -14,8 +14,13 @@ class ElasticNodes:
 
   def load(self, nodestats):
     # read nodestats
-    with open(nodestats, 'r') as f:
-      self.nodes = json.load(f)['nodes']
+    if type(nodestats) is dict:
+      self.nodes = nodestats['nodes']
+    elif type(nodestats) is file:
+      self.nodes = json.load(nodestats)['nodes']
+    else:
+      with open(nodestats, 'r') as f:
+        self.nodes = json.load(f)['nodes']
 
   def get_nodes(self):
     return self.nodes.keys()
@@ -25,6 +30,22 @@ class ElasticNodes:
 
   def get_ip(self, node_id):
     return self.nodes[node_id]['ip'][0][6:].split(':')[0]
+
+  # active and queued search requests of node (thread_pool stats)
+  def get_search_load(self, node_id):
+    search = self.nodes[node_id].get('thread_pool', dict()).get('search',
+      dict())
+    return search.get('active', 0) + search.get('queue', 0)
+
+  # queued bulk requests of node (thread_pool stats)
+  def get_bulk_queue(self, node_id):
+    bulk = self.nodes[node_id].get('thread_pool', dict()).get('bulk', dict())
+    return bulk.get('queue', 0)
+
+  # rejected bulk requests of node since its start (thread_pool stats)
+  def get_bulk_rejected(self, node_id):
+    bulk = self.nodes[node_id].get('thread_pool', dict()).get('bulk', dict())
+    return bulk.get('rejected', 0)
     
 
 """
@@ -82,20 +103,49 @@ class ElasticShards:
     return self.shards[index][primary]['index'] if len(self.shards[index]) > primary else None
 
 """
-ES RESTful API
+ES RESTful API. With compression, responses are requested gzip encoded and
+bulk request bodies are sent gzip encoded.
 """
 class ElasticSearch:
   # curl instance
   curl = None
 
+  # gzip request bodies and accept compressed responses
+  compress = False
+
+  # request timeout in milliseconds, 0 for no timeout
+  timeout = 0
+
   # json converters
   jenc = json.JSONEncoder()
   jdec = json.JSONDecoder()
 
-  def __init__(self, keepAlive = False):
+  def __init__(self, keepAlive = False, compress = False, timeout = 0):
+    self.compress = compress
+    self.timeout = timeout
     if keepAlive:
       self.curl = pycurl.Curl()
 
+  # set response and request body encoding and request timeout, request
+  # body is compressed only if given
+  def set_encoding(self, c, body = None):
+    headers = list()
+    if self.compress:
+      c.setopt(c.ENCODING, 'gzip')
+      if body is not None:
+        compressed = BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+          f.write(body)
+        body = compressed.getvalue()
+        headers.append('Content-Encoding: gzip')
+    if len(headers) > 0:
+      c.setopt(c.HTTPHEADER, headers)
+    else:
+      c.unsetopt(c.HTTPHEADER)
+    c.setopt(c.NOSIGNAL, 1)
+    c.setopt(c.TIMEOUT_MS, self.timeout)
+    return body
+
   # close ES connection
   def close(self):
     if not self.curl is None:
@@ -116,6 +166,8 @@ class ElasticSearch:
 
     # make a request
     c.setopt(c.URL, url)
+    c.setopt(c.HTTPGET, 1)
+    self.set_encoding(c)
     c.setopt(c.WRITEFUNCTION, output.write)
     c.perform()
 
@@ -142,6 +194,7 @@ class ElasticSearch:
 
     # make a request
     c.setopt(c.URL, url)
+    self.set_encoding(c)
     c.setopt(c.POSTFIELDS, jinput)
     c.setopt(c.WRITEFUNCTION, output.write)
     c.perform()
@@ -172,7 +225,7 @@ class ElasticSearch:
 
     # make a request
     c.setopt(c.URL, url)
-    c.setopt(c.POSTFIELDS, binput.getvalue())
+    c.setopt(c.POSTFIELDS, self.set_encoding(c, binput.getvalue()))
     c.setopt(c.WRITEFUNCTION, boutput.write)
     c.perform()
 
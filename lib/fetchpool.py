@@ -0,0 +1,288 @@
+"""
+Fetch server of the fetch stage. A single process serves the page and
+robots fetches of an ec-fetch-urls job, so connections and lookups are kept
+across urls: curl handles are pooled per host (keep-alive connections are
+reused, idle handles are closed least recently used first), TLS sessions
+are shared between the handles and host addresses are kept in a DNS cache.
+Hosts of the queued urls are resolved ahead by a background thread.
+Connection reuse and the handshake time it saves are recorded as job
+metrics counters.
+
+Requests are read line by line (KIND LINE URL, KIND is page or robots, LINE
+is the input line of the url), replies are written line by line (RET
+[TYPE], see pagefetch.fetch).
+
+"""
+import sys, time, socket, urlparse, threading, collections
+import pycurl
+import pagefetch
+import profiler
+
+# request kinds
+PAGE = 'page'
+ROBOTS = 'robots'
+
+# default ports of the allowed protocols
+PORTS = {'http' : 80, 'https' : 443}
+
+"""
+Host address cache. Addresses are kept for the cache TTL, the system
+resolver does not expose record TTLs, so records are expected to be cached
+by the system resolver (nscd, systemd-resolved) within their TTL.
+"""
+class DnsCache:
+  # cached (address, expiry time) by (host, port)
+  entries = None
+  ttl = 0
+
+  # lookup counters
+  hits = 0
+  misses = 0
+
+  def __init__(self, ttl):
+    self.entries = dict()
+    self.ttl = ttl
+    self.lock = threading.Lock()
+
+  # get cached (address,) entry, None if not cached or expired, the address
+  # is None for hosts that did not resolve
+  def get(self, host, port):
+    with self.lock:
+      entry = self.entries.get((host, port))
+      if entry is None or entry[1] < time.time():
+        return None
+      return entry[:1]
+
+  # resolve host address (IPv4 first), None if the host does not resolve
+  def resolve(self, host, port):
+    try:
+      infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except (socket.error, UnicodeError):
+      infos = list()
+    infos.sort(key=lambda info: info[0] != socket.AF_INET)
+    address = infos[0][4][0] if len(infos) > 0 else None
+    with self.lock:
+      self.entries[(host, port)] = (address, time.time() + self.ttl)
+    return address
+
+  # get cached or resolved address and whether it was cached
+  def lookup(self, host, port):
+    entry = self.get(host, port)
+    if entry is not None:
+      self.hits += 1
+      return entry[0], True
+    self.misses += 1
+    return self.resolve(host, port), False
+
+# get (host, port) of url, None if the url has no host
+def get_host_port(url):
+  try:
+    parts = urlparse.urlsplit(url)
+    host = parts.hostname
+    port = parts.port or PORTS.get(parts.scheme.lower())
+  except ValueError:
+    return None
+  if not host or not port:
+    return None
+  return host, port
+
+# get curl resolve entry of host address (IPv6 addresses in brackets)
+def get_resolve_entry(host, port, address):
+  if ':' in address:
+    address = '[%s]' % address
+  return '%s:%d:%s' % (host, port, address)
+
+"""
+Resolves hosts of the queued urls ahead of their fetch, at most a window
+of input lines ahead of the line being fetched.
+"""
+class Prefetcher(threading.Thread):
+  daemon = True
+
+  # input file, dns cache and lines ahead
+  input = None
+  dns = None
+  window = 0
+
+  # input line being fetched
+  line = 0
+
+  def __init__(self, input, dns, window):
+    threading.Thread.__init__(self)
+    self.input = input
+    self.dns = dns
+    self.window = window
+    self.position = threading.Condition()
+
+  # set input line being fetched
+  def set_line(self, line):
+    with self.position:
+      self.line = max(self.line, line)
+      self.position.notify()
+
+  def run(self):
+    with open(self.input) as f:
+      for number, url in enumerate(f, 1):
+        with self.position:
+          while number > self.line + self.window:
+            self.position.wait()
+        host_port = get_host_port(url.strip())
+        if host_port is not None and self.dns.get(*host_port) is None:
+          self.dns.resolve(*host_port)
+
+"""
+Pool of curl handles by host. Handles keep their connection alive between
+fetches of the host, handles idle for longer than the idle time and the
+least recently used handles over the pool size are closed.
+"""
+class FetchPool:
+  # handles by (scheme, host, port), least recently used first, values are
+  # (handle, last use time)
+  handles = None
+  size = 0
+  idle = 0
+
+  # shared TLS sessions and DNS cache
+  share = None
+  dns = None
+
+  # last handshake milliseconds by host, to estimate the saved time
+  handshakes = None
+
+  # connection counters
+  reused = 0
+  connects = 0
+  closed = 0
+  saved = 0
+
+  def __init__(self, size, idle, dns):
+    self.handles = collections.OrderedDict()
+    self.size = size
+    self.idle = idle
+    self.dns = dns
+    self.handshakes = dict()
+    self.share = pycurl.CurlShare()
+    self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+
+  # get pooled or new handle of host key
+  def get_handle(self, key):
+    entry = self.handles.pop(key, None)
+    if entry is not None:
+      return entry[0]
+    c = pycurl.Curl()
+    c.setopt(pycurl.SHARE, self.share)
+    c.setopt(pycurl.MAXCONNECTS, 1)
+    c.setopt(pycurl.DNS_CACHE_TIMEOUT, self.dns.ttl)
+    return c
+
+  # return handle to the pool, then close idle and least recently used
+  def put_handle(self, key, c):
+    now = time.time()
+    self.handles[key] = (c, now)
+    for oldest, (handle, used) in self.handles.items():
+      if len(self.handles) <= self.size and now - used <= self.idle:
+        break
+      del self.handles[oldest]
+      handle.close()
+      self.closed += 1
+
+  # fetch url with the handle of its host, returns (ret, fetch state,
+  # metrics counters)
+  def fetch(self, url, body, headers, user_agent, protocols, max_time,
+    max_size, types):
+    counters = collections.OrderedDict()
+    host_port = get_host_port(url)
+    key = (urlparse.urlsplit(url).scheme.lower(),) + (host_port or ('', 0))
+    c = self.get_handle(key)
+
+    # pin resolved address of the host, redirect targets are resolved by curl
+    if host_port is not None:
+      address, cached = self.dns.lookup(*host_port)
+      counters['fetch_dns_hits' if cached else 'fetch_dns_misses'] = 1
+      if address is not None:
+        c.setopt(pycurl.RESOLVE, ['-%s:%d' % host_port,
+          get_resolve_entry(host_port[0], host_port[1], address)])
+
+    try:
+      ret, state, wire = pagefetch.perform(c, url, body, headers, user_agent,
+        protocols, max_time, max_size, types)
+      connects = c.getinfo(pycurl.NUM_CONNECTS)
+      handshake = max(c.getinfo(pycurl.APPCONNECT_TIME),
+        c.getinfo(pycurl.CONNECT_TIME)) - c.getinfo(pycurl.NAMELOOKUP_TIME)
+    except:
+      c.close()
+      raise
+    self.put_handle(key, c)
+
+    # reused connections save the last handshake time of the host
+    if connects > 0:
+      self.connects += connects
+      self.handshakes[key] = int(max(handshake, 0) * 1000)
+      counters['fetch_connects'] = connects
+      counters['fetch_handshake_ms'] = self.handshakes[key]
+    elif ret == 0 or state.code is not None:
+      self.reused += 1
+      self.saved += self.handshakes.get(key, 0)
+      counters['fetch_connections_reused'] = 1
+      counters['fetch_handshake_saved_ms'] = self.handshakes.get(key, 0)
+    counters['fetch_wire_bytes'] = wire
+    counters['fetch_decoded_bytes'] = state.size
+    return ret, state, counters
+
+  def close(self):
+    for c, used in self.handles.values():
+      c.close()
+    self.handles.clear()
+    self.share.close()
+
+# append counters to metrics events file
+def record_counters(metrics, counters):
+  with open(metrics, 'a') as f:
+    for name, value in counters.items():
+      f.write('C %s %d\n' % (name, value))
+
+# serve fetch requests from stdin until closed, options are output files
+# and limits (see ec-fetch-urls), input is the url file to resolve ahead
+def serve(options, input = None):
+  profiler.start()
+  dns = DnsCache(options['dns_ttl'])
+  pool = FetchPool(options['max_connections'], options['idle_time'], dns)
+  prefetcher = None
+  if input is not None and options['prefetch'] > 0:
+    prefetcher = Prefetcher(input, dns, options['prefetch'])
+    prefetcher.start()
+
+  try:
+    for request in iter(sys.stdin.readline, ''):
+      parts = request.rstrip('\r\n').split(' ', 2)
+      if len(parts) < 3:
+        sys.stdout.write('%d\n' % pycurl.E_URL_MALFORMAT)
+        sys.stdout.flush()
+        continue
+      kind, line, url = parts
+      if prefetcher is not None and line.isdigit():
+        prefetcher.set_line(int(line))
+
+      # robots are fetched with any content type
+      if kind == ROBOTS:
+        ret, state, counters = pool.fetch(url, options['robots'],
+          options['headers'], options['user_agent'], options['protocols'],
+          options['max_time'], options['max_size'], '')
+      else:
+        ret, state, counters = pool.fetch(url, options['body'],
+          options['headers'], options['user_agent'], options['protocols'],
+          options['max_time'], options['max_size'], options['types'])
+      if options['metrics']:
+        record_counters(options['metrics'], counters)
+
+      content_type = ''
+      if ret == pagefetch.REJECTED_TYPE and state.content_type is not None:
+        content_type = ' %s' % state.content_type
+      sys.stdout.write('%d%s\n' % (ret, content_type))
+      sys.stdout.flush()
+  finally:
+    pool.close()
+    sys.stderr.write('Fetch connections: reused %d new %d closed %d ' \
+      'handshake saved %d ms dns hits %d misses %d\n' % (pool.reused,
+      pool.connects, pool.closed, pool.saved, dns.hits, dns.misses))
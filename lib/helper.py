@@ -0,0 +1,417 @@
+"""
+Resident helper service of the shell tools. ec-server start runs it on a Unix
+socket (HELPER_SOCKET) with elasticcrawler.py, the EC configuration and the
+allowed and excluded host lists loaded, so the shell tools ask it instead of
+starting python for each url. The configuration and host lists are read
+again when their files change.
+
+Requests are read line by line (COMMAND ARGUMENT, see the do_ methods of
+Helper), a batch ends with an empty line or the end of the input. Replies
+are written line by line in request order (OK VALUE or ERROR MESSAGE), then
+the connection is closed. When the service is down the shell tools run the
+same requests locally (see run).
+
+The fetcher (ec-fetch-urls) runs its own fetch helper next to the fetch
+server, with the work files and settings of the job (FetchHelper). Batches
+of requests and their replies are passed through fifos, so the steps of a
+url (host cache, robots, redirects, host schedule, archive, parsing, links,
+index update and seeding) start no process.
+
+"""
+import os, sys, json, gzip, signal, socket, threading, SocketServer
+from cStringIO import StringIO
+import elasticcrawler as ec
+import archive
+import profiler
+import seeds
+import throttle
+from elasticsearch import ElasticSearch
+from reparse import ParseTimeout, on_alarm, parse_content
+
+# reply prefixes
+OK = 'OK'
+ERROR = 'ERROR'
+
+"""
+Helper commands of an EC configuration folder.
+"""
+class Helper:
+  # configuration and host list files
+  files = None
+
+  # client access rules and modification times of the files they were read
+  # from
+  rules = None
+  mtimes = None
+
+  def __init__(self, conf):
+    self.files = [os.path.join(conf, 'elasticcrawler.conf'),
+      os.path.join(conf, 'allowed.hosts'), os.path.join(conf, 'excluded.hosts')]
+    self.lock = threading.Lock()
+
+  # get client access rules, read again if the files changed
+  def get_rules(self):
+    mtimes = [os.path.getmtime(f) for f in self.files]
+    with self.lock:
+      if mtimes != self.mtimes:
+        self.rules = ec.get_client_access_rules(*self.files)
+        self.mtimes = mtimes
+      return self.rules
+
+  # get reply line of request line
+  def handle(self, line):
+    command, _, argument = line.partition(' ')
+    method = getattr(self, 'do_%s' % command, None)
+    if method is None:
+      return '%s unknown command %s' % (ERROR, command)
+    try:
+      return '%s %s' % (OK, method(argument))
+    except Exception as e:
+      return '%s %s' % (ERROR, str(e).replace('\n', ' '))
+
+  def do_ping(self, argument):
+    return 'pong'
+
+  def do_url_id(self, url):
+    return ec.get_url_id(url)
+
+  def do_netloc_id(self, url):
+    return ec.get_netloc_id(url)
+
+  def do_robots_url(self, url):
+    return ec.get_robots_url(url)
+
+  # response code of the last response of a headers file
+  def do_response_code(self, headers):
+    return ec.get_response_code(headers)
+
+  # true or false
+  def do_client_access(self, url):
+    return 'true' if ec.is_access_allowed(url, self.get_rules()) else 'false'
+
+  # own EC configuration folder (physical path), checked by ec-server before
+  # reusing the service
+  def do_conf(self, argument):
+    return os.path.realpath(os.path.dirname(self.files[0]))
+
+"""
+Helper commands of a fetcher, options are the work files and settings of
+the job (see start_fetch_helper of ec-fetch-urls). Files of the current url
+(robots, headers, fetched content, ...) are rewritten by the fetcher for
+each url.
+"""
+class FetchHelper(Helper):
+  # fetch time and outcome of the current url for the index update (see
+  # do_fetch_outcome)
+  fetch = None
+
+  def __init__(self, conf, options):
+    Helper.__init__(self, conf)
+    self.options = options
+    self.es = ElasticSearch(True, options['compress'])
+    signal.signal(signal.SIGALRM, on_alarm)
+
+  # true or false
+  def do_robots_allowed(self, url):
+    allowed = ec.is_robot_access_allowed(url, self.options['robots'],
+      self.options['user_agent'])
+    return 'true' if allowed else 'false'
+
+  # cached permanent redirect of url (CODE TARGET), empty if none
+  def do_cached_redirect(self, url):
+    redirect = ec.get_cached_redirect(self.options['redirects'], url)
+    return '%s %s' % redirect if redirect is not None else ''
+
+  # content type rejected for the url path pattern, empty if none
+  def do_rejected_type(self, url):
+    content_type = ec.get_rejected_type(self.options['rejected'], url,
+      self.options['reject_threshold'])
+    return content_type if content_type is not None else ''
+
+  # host access delay and circuit breaker end time (DELAY BREAKER_UNTIL)
+  def do_host_schedule(self, argument):
+    options = self.options
+    return '%d %d' % ec.get_host_schedule(options['hoststats'],
+      options['robots'], options['user_agent'], options['access_delay'],
+      options['max_access_delay'], options['delay_factor'])
+
+  # final url after redirects of the last fetch
+  def do_final_url(self, url):
+    return ec.get_final_url(self.options['headers'], url,
+      self.options['strip'])
+
+  # keep fetch time and outcome (ok, timeout, error) of url for the index
+  # update (rolling host stats) with the rejected content type (rejected url
+  # patterns), local host files of hosts owned by the job are updated
+  # (HOST_ID TIME OUTCOME STATUS URL [TYPE])
+  def do_fetch_outcome(self, argument):
+    host_id, time_ms, outcome, status, url, content_type = \
+      (argument.split(' ', 5) + [''])[:6]
+    options = self.options
+    self.fetch = {'time' : int(time_ms), 'outcome' : outcome,
+      'threshold' : options['breaker_failures'],
+      'backoff' : options['breaker_backoff'], 'rejected' : content_type,
+      'patterns' : options['rejected']}
+    if options['partition']:
+      hosts = os.path.join(options['hosts'], host_id)
+      ec.update_host_stats_file('%s.stats' % hosts, int(time_ms), outcome,
+        options['breaker_failures'], options['breaker_backoff'])
+      ec.update_rejected_file('%s.rejected' % hosts, url, content_type,
+        status == options['success'])
+    return 'ok'
+
+  # append fetched content and headers of url to raw content archive
+  def do_archive(self, url):
+    options = self.options
+    archive.append_record(options['archive'], options['archive_writer'],
+      options['archive_segment_size'], url, options['headers'],
+      options['fetched'])
+    return 'ok'
+
+  # extract links and title of fetched content, timeout if longer than the
+  # parse time
+  def do_extract(self, url):
+    options = self.options
+    try:
+      signal.alarm(options['parse_time'])
+      ec.extract_links_and_title(url, options['fetched'],
+        options['protocols'], options['excluded'], options['outlinks'],
+        options['subject'], options['strip'])
+    except ParseTimeout:
+      return 'timeout'
+    finally:
+      signal.alarm(0)
+    return 'ok'
+
+  # read robots, cached redirects, rejected url patterns and rolling host
+  # stats of the host doc into their files, the host access time in seconds
+  # is returned with true if robots are cached (HOST HOST_ID)
+  def do_host_cache(self, argument):
+    host, host_id = argument.split(' ', 1)
+    options = self.options
+    fields = 'robots,redirects,rejected,_timestamp,response_time,timeouts,' \
+      'errors,failures,breaker_until'
+    response = self.es.get('%s:%s/%s/host/%s?fields=%s' % (host,
+      options['port'], options['index'], host_id, fields))
+    fields = response.get('fields', dict())
+    with open(options['redirects'], 'w') as f:
+      f.writelines('%s\n' % line.encode('utf-8')
+        for line in fields.get('redirects', []))
+    with open(options['rejected'], 'w') as f:
+      f.writelines('%s\n' % line.encode('utf-8')
+        for line in fields.get('rejected', []))
+    with open(options['hoststats'], 'w') as f:
+      json.dump(dict((k, v[0]) for k, v in fields.items()
+        if k not in ['robots', 'redirects', 'rejected', '_timestamp']), f)
+    if os.path.exists(options['robots']):
+      os.remove(options['robots'])
+    if 'robots' in fields:
+      with open(options['robots'], 'w') as f:
+        f.write(fields['robots'][0].encode('utf-8'))
+    access_time = fields.get('_timestamp', 0) / 1000
+    return '%d %s' % (access_time, 'true' if 'robots' in fields else 'false')
+
+  # set fetched robots in the host doc, keeps cached redirects of the host
+  # (HOST HOST_ID ROBOTS_URL)
+  def do_robots_update(self, argument):
+    host, host_id, robots_url = argument.split(' ', 2)
+    options = self.options
+    update = json.loads(ec.get_robots_update_request(options['robots'],
+      robots_url))
+    self.es.post('%s:%s/%s/host/%s/_update' % (host, options['port'],
+      options['index'], host_id), update)
+    return 'ok'
+
+  # parse fetched content with the Tika parse server into the parsed file,
+  # timeout if longer than the parse time
+  def do_parse(self, argument):
+    options = self.options
+    with open(options['fetched']) as f:
+      data = f.read()
+    try:
+      content = parse_content(options['parser_port'], data,
+        options['parse_time'])
+    except socket.timeout:
+      return 'timeout'
+    with open(options['parsed'], 'w') as f:
+      f.write(content)
+    return 'ok'
+
+  # get node state (new, old or none) and tag of url before the index
+  # update, and the olinks of the node of the final url for the inlink index
+  # diff (one _mget of both nodes)
+  def get_node_state(self, base, url, final_url):
+    fields = 'status,tag,olinks' if self.options['inlinks'] else 'status,tag'
+    response = self.es.post('%s/node/_mget?_source_include=%s' % (base,
+      fields), {'ids' : [ec.get_url_id(url), ec.get_url_id(final_url)]})
+    node, final = response['docs']
+    state = ('old' if node['_source'].get('status') else 'new') \
+      if node.get('found') else 'none'
+    tag = node['_source'].get('tag', '-') if node.get('found') else '-'
+    return state, tag, final.get('_source', dict()).get('olinks', [])
+
+  # get error code of bulk response, 0 if all actions succeeded
+  def get_bulk_error(self, response):
+    if response.get('errors') is True:
+      for item in response['items']:
+        for action in item.values():
+          if not str(action.get('status', '')).startswith('2'):
+            return action.get('status')
+    elif response.get('errors') is False:
+      return 0
+    return response.get('status', 1)
+
+  # record url stats changes of the index update in the stats changes file
+  def record_stats(self, state, tag, response):
+    created = len([item for item in response['items']
+      if item.get('update', dict()).get('_type') == 'node' and
+      item['update'].get('status') == 201])
+    with open(self.options['stats'], 'a') as f:
+      # new url has been crawled
+      if state == 'new':
+        f.write('T 0 -1\n')
+        f.write('G %s 0 -1\n' % tag)
+      # nodes created by the update (crawled url, redirects)
+      if created > 0:
+        f.write('T %d 0\n' % created)
+
+  # update search index with url (redirect source only, if a target is
+  # given) through the ES write throttle and record the url stats changes,
+  # the error code of the bulk response is returned (0 if indexed)
+  # (HOST STATUS FETCHED URL FINAL_URL [TARGET])
+  def do_index_update(self, argument):
+    host, status, fetched, url, final_url, target = \
+      (argument.split(' ', 5) + [''])[:6]
+    options = self.options
+    fetch, self.fetch = self.fetch, None
+    base = '%s:%s/%s' % (host, options['port'], options['index'])
+    state, tag, previous = self.get_node_state(base, url, final_url)
+    if len(target) > 0:
+      request = ec.get_redirect_update_request(url, status, target)
+    else:
+      if not options['inlinks'] or status != options['success']:
+        previous = None
+      headers = options['headers'] if fetched == 'true' else ''
+      request = ec.get_index_update_request(url, status,
+        [options['success']], options['subject'], options['parsed'],
+        options['outlinks'], headers, fetch, previous, options['strip'])
+    with open(options['bulkdata'], 'w') as f:
+      f.write(request)
+      f.write('\n')
+    self.count_bulk(request)
+
+    response = throttle.bulk_file('%s/_bulk' % base, options['bulkdata'], base,
+      options['config'], options['compress'], options['metrics'], self.es)
+    error = self.get_bulk_error(response)
+    if error == 0:
+      self.record_stats(state, tag, response)
+    return str(error) if str(error).isdigit() else '1'
+
+  # count bulk bytes and compressed bytes, if metrics are enabled
+  def count_bulk(self, request):
+    if not self.options['metrics']:
+      return
+    size = len(request) + 1
+    wire = size
+    if self.options['compress']:
+      compressed = StringIO()
+      with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+        f.write(request + '\n')
+      wire = len(compressed.getvalue())
+    with open(self.options['metrics'], 'a') as f:
+      f.write('C es_bulk_bytes %d\n' % size)
+      f.write('C es_bulk_wire_bytes %d\n' % wire)
+
+  # seed urls of file (one per line) as new nodes on ES host, the number of
+  # created urls is returned (HOST FILE)
+  def do_seed(self, argument):
+    host, urls = argument.split(' ', 1)
+    options = self.options
+    with open(urls) as f:
+      urls = [url.strip() for url in f if len(url.strip()) > 0]
+    base = '%s:%s/%s' % (host, options['port'], options['index'])
+    response = seeds.create_urls(urls, base, self.get_rules(),
+      options['seeding'], options['stats'], self.es)
+    if 'items' not in response:
+      raise ValueError('seeding failed: %s' % json.dumps(response))
+    return str(len([item for item in response['items']
+      if item.get('create', dict()).get('status') == 201]))
+
+# handle request lines of input, write reply lines to output, returns False
+# at the end of the input
+def handle_requests(helper, input, output):
+  for line in iter(input.readline, ''):
+    line = line.rstrip('\r\n')
+    if len(line) == 0:
+      output.flush()
+      return True
+    output.write('%s\n' % helper.handle(line))
+  output.flush()
+  return False
+
+"""
+Connection of a shell client, one batch of requests.
+"""
+class HelperHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    handle_requests(self.server.helper, self.rfile, self.wfile)
+
+"""
+Helper service on a Unix socket, a thread per connection.
+"""
+class HelperServer(SocketServer.ThreadingMixIn,
+  SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, helper):
+    SocketServer.UnixStreamServer.__init__(self, path, HelperHandler)
+    self.helper = helper
+
+# check if a helper service answers on socket
+def is_running(path):
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(path)
+    return True
+  except socket.error:
+    return False
+  finally:
+    s.close()
+
+# serve requests on socket until terminated, the process id is kept in
+# the .pid file of the socket
+def serve(path, conf):
+  if is_running(path):
+    sys.stderr.write('Helper service already running on %s\n' % path)
+    sys.exit(1)
+  if os.path.exists(path):
+    os.remove(path)
+  server = HelperServer(path, Helper(conf))
+  with open('%s.pid' % path, 'w') as f:
+    f.write('%d\n' % os.getpid())
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    for name in [path, '%s.pid' % path]:
+      if os.path.exists(name):
+        os.remove(name)
+
+# run requests of stdin locally, the fallback of the shell clients, sampled
+# as a job process if enabled (EC_PROFILE)
+def run(conf):
+  profiler.start()
+  handle_requests(Helper(conf), sys.stdin, sys.stdout)
+
+# serve batches of fetch helper requests of stdin until closed (fetcher
+# fifo), sampled as a job process if enabled (EC_PROFILE)
+def serve_fetch(conf, options):
+  profiler.start()
+  helper = FetchHelper(conf, options)
+  try:
+    while handle_requests(helper, sys.stdin, sys.stdout):
+      pass
+  finally:
+    helper.es.close()
@@ -0,0 +1,60 @@
+"""
+Inlink index of the url graph. Node docs keep the outlinks of a url
+(olinks), inlink docs (type 'inlink', _id = SHA1(url)) keep the ids of the
+nodes linking to the url (ilinks) and their number (count). Inlink docs are
+updated with the olinks diff of each node update when INLINK_INDEX is on
+(see get_inlink_actions in elasticcrawler.py), or built from the node olinks
+by the ranking LINK step. ilinks keeps up to MAX_INLINKS ids, count stays
+exact. Inlinks of many urls are read in batches of _mget requests, so
+ranking can pull the ranks of the linking nodes (RANKING_MODE=pull) and the
+frontier can ask which pages link to a url.
+
+"""
+import itertools
+
+# inlink doc type
+INLINK_TYPE = 'inlink'
+
+# number of docs per _mget request
+BATCH_SIZE = 1000
+
+# get source field of docs by id as dict, missing docs are left out
+def get_sources(es, base, type, ids, field):
+  sources = dict()
+  ids = iter(ids)
+  while True:
+    batch = list(itertools.islice(ids, BATCH_SIZE))
+    if len(batch) == 0:
+      break
+    request = '%s/%s/_mget?_source_include=%s' % (base, type, field)
+    response = es.post(request, {'ids' : batch})
+    for doc in response['docs']:
+      if doc.get('found'):
+        sources[doc['_id']] = doc.get('_source', dict())
+  return sources
+
+# get olinks of nodes by id, nodes without olinks are left out
+def get_olinks(es, base, ids):
+  nodes = get_sources(es, base, 'node', ids, 'olinks')
+  return dict((node_id, source['olinks']) for node_id, source in nodes.items()
+    if 'olinks' in source)
+
+# get inlinks (linking node ids) of url ids, urls without inlinks are left
+# out
+def get_inlinks(es, base, ids):
+  docs = get_sources(es, base, INLINK_TYPE, ids, 'ilinks')
+  return dict((url_id, source.get('ilinks', [])) for url_id, source in
+    docs.items())
+
+# get (inlinks, number of inlinks) of url ids, urls without inlinks are
+# left out, inlinks are a part of the linking nodes if capped (MAX_INLINKS)
+def get_inlink_docs(es, base, ids):
+  docs = get_sources(es, base, INLINK_TYPE, ids, 'ilinks,count')
+  return dict((url_id, (source.get('ilinks', []), source.get('count', 0)))
+    for url_id, source in docs.items())
+
+# get number of inlinks of url ids, urls without inlinks are left out
+def get_inlink_counts(es, base, ids):
+  docs = get_sources(es, base, INLINK_TYPE, ids, 'count')
+  return dict((url_id, source.get('count', 0)) for url_id, source in
+    docs.items())
@@ -0,0 +1,184 @@
+import os, json, time, glob
+
+# latency histogram bucket upper bounds in milliseconds (last one unbounded)
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500,
+           1000, 2000, 5000, 10000, 20000, 60000]
+
+# stage counted as one processed page
+PAGE_STAGE = 'index'
+
+"""
+Job metrics with latency histogram and status code counters per stage.
+Snapshots are stored as json files and can be merged across jobs.
+"""
+class Metrics:
+  # snapshot start and update time
+  start = None
+  time = None
+
+  # stage histograms, status codes and counters
+  stages = None
+  counters = None
+
+  def __init__(self, snapshot = None):
+    self.start = time.time()
+    self.time = self.start
+    self.stages = dict()
+    self.counters = dict()
+    if snapshot is not None and os.path.exists(snapshot):
+      self.load(snapshot)
+
+  def load(self, snapshot):
+    # read snapshot
+    with open(snapshot) as f:
+      data = json.load(f)
+    self.start = data['start']
+    self.time = data['time']
+    self.stages = data['stages']
+    self.counters = data['counters']
+
+  def save(self, snapshot):
+    # write snapshot atomically, readers never see partial file
+    self.time = time.time()
+    data = dict()
+    data['start'] = self.start
+    data['time'] = self.time
+    data['stages'] = self.stages
+    data['counters'] = self.counters
+    with open(snapshot + '.tmp', 'w') as f:
+      json.dump(data, f)
+    os.rename(snapshot + '.tmp', snapshot)
+
+  def get_stage(self, name):
+    if name not in self.stages:
+      stage = dict()
+      stage['count'] = 0
+      stage['sum'] = 0
+      stage['max'] = 0
+      stage['buckets'] = [0] * (len(BUCKETS) + 1)
+      stage['codes'] = dict()
+      self.stages[name] = stage
+    return self.stages[name]
+
+  def record(self, name, millis, code = None):
+    # find histogram bucket
+    bucket = 0
+    while bucket < len(BUCKETS) and millis > BUCKETS[bucket]:
+      bucket += 1
+
+    # update stage
+    stage = self.get_stage(name)
+    stage['count'] += 1
+    stage['sum'] += millis
+    stage['max'] = max(stage['max'], millis)
+    stage['buckets'][bucket] += 1
+    if code is not None:
+      code = str(code)
+      stage['codes'][code] = stage['codes'].get(code, 0) + 1
+
+  def add(self, name, value):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def merge(self, other):
+    self.start = min(self.start, other.start)
+    self.time = max(self.time, other.time)
+    for name, other_stage in other.stages.items():
+      stage = self.get_stage(name)
+      stage['count'] += other_stage['count']
+      stage['sum'] += other_stage['sum']
+      stage['max'] = max(stage['max'], other_stage['max'])
+      for i in range(len(stage['buckets'])):
+        stage['buckets'][i] += other_stage['buckets'][i]
+      for code, count in other_stage['codes'].items():
+        stage['codes'][code] = stage['codes'].get(code, 0) + count
+    for name, value in other.counters.items():
+      self.add(name, value)
+
+  def percentile(self, name, percent):
+    # upper bound of the bucket holding the percentile (max if unbounded)
+    stage = self.get_stage(name)
+    limit = stage['count'] * percent / 100.0
+    total = 0
+    for i in range(len(stage['buckets'])):
+      total += stage['buckets'][i]
+      if total >= limit and total > 0:
+        return min(BUCKETS[i], stage['max']) if i < len(BUCKETS) \
+          else stage['max']
+    return 0
+
+  def pages(self):
+    return self.get_stage(PAGE_STAGE)['count']
+
+  def rate(self):
+    elapsed = self.time - self.start
+    return self.pages() / elapsed if elapsed > 0 else 0.0
+
+# update metrics snapshot with recorded events and clear the events
+def update_snapshot(events, snapshot):
+  m = Metrics(snapshot)
+
+  # read events (S STAGE MILLIS [CODE] or C COUNTER VALUE)
+  if not os.path.exists(events):
+    m.save(snapshot)
+    return
+  with open(events) as f:
+    for line in f:
+      parts = line.split()
+      if len(parts) > 2 and parts[0] == 'S':
+        code = parts[3] if len(parts) > 3 else None
+        m.record(parts[1], int(parts[2]), code)
+      elif len(parts) > 2 and parts[0] == 'C':
+        m.add(parts[1], int(parts[2]))
+
+  m.save(snapshot)
+  open(events, 'w').close()
+
+# merge snapshots of the latest job run found in logs folder
+def get_latest_snapshots(logs):
+  # group snapshots by job name and date ($SCRIPT-$JOB_DATE_TIME-$PPID)
+  runs = dict()
+  for snapshot in glob.glob(os.path.join(logs, '*.metrics')):
+    run = os.path.basename(snapshot).rsplit('-', 1)[0]
+    runs.setdefault(run, list()).append(snapshot)
+  if len(runs) == 0:
+    return None, list()
+
+  # select the run updated most recently
+  latest = max(runs.keys(),
+    key=lambda run: max(os.path.getmtime(s) for s in runs[run]))
+  return latest, runs[latest]
+
+# report cluster-wide metrics of the latest job run
+def report(logs):
+  run, snapshots = get_latest_snapshots(logs)
+  if run is None:
+    print "No job metrics found in %s" % logs
+    return
+
+  # merge job snapshots
+  total = Metrics(snapshots[0])
+  for snapshot in snapshots[1:]:
+    total.merge(Metrics(snapshot))
+
+  print "Job run: %s" % run
+  print "Job count: %d" % len(snapshots)
+  print "Pages: %d (%.2f pages/s)" % (total.pages(), total.rate())
+
+  # stage latency table
+  out = list()
+  out.append(["[stage]", "[count]", "[p50 ms]", "[p95 ms]", "[p99 ms]",
+    "[codes]"])
+  for name in sorted(total.stages.keys()):
+    stage = total.stages[name]
+    codes = ' '.join('%s:%d' % (code, count)
+      for code, count in sorted(stage['codes'].items()))
+    out.append([name, stage['count'], total.percentile(name, 50),
+      total.percentile(name, 95), total.percentile(name, 99), codes])
+  s = [[str(e) for e in row] for row in out]
+  lens = [max(map(len, col)) for col in zip(*s)]
+  fmt = '\t'.join('{{:{}}}'.format(x) for x in lens)
+  print '\n'.join(fmt.format(*row) for row in s)
+
+  # counters
+  for name in sorted(total.counters.keys()):
+    print "%s: %d" % (name, total.counters[name])
@@ -0,0 +1,163 @@
+"""
+Page fetch with early content gating. Response headers are inspected while
+the transfer is running, so pages with a Content-Type outside the allowlist
+or a Content-Length over the limit are aborted before the body is
+downloaded. Compressed responses are negotiated and decoded, the size limit
+applies to the decoded body. Headers are written in the CURL (-D) headers
+file format, see curlheaders.py.
+
+"""
+import re, pycurl
+
+# exit codes of rejected fetches (curl error codes are used otherwise)
+REJECTED_TYPE = 100
+REJECTED_SIZE = 101
+
+"""
+Fetch state of a single transfer: headers and body output, current response
+code and the reason of an abort.
+"""
+class PageFetch:
+  # output files
+  headers = None
+  body = None
+
+  # limits
+  types = None
+  max_size = -1
+
+  # current response code, received body size and rejection
+  code = None
+  size = 0
+  rejected = None
+  content_type = None
+
+  def __init__(self, headers, body, types, max_size):
+    self.headers = headers
+    self.body = body
+    self.types = types
+    self.max_size = max_size
+
+  def on_header(self, line):
+    self.headers.write(line)
+    line = line.strip()
+
+    # status line starts a new response (redirects, 100 continue)
+    if line.startswith('HTTP/'):
+      parts = line.split()
+      self.code = parts[1] if len(parts) > 1 else None
+      return
+
+    # only successful responses are gated, others are not parsed anyway
+    head = line.find(':')
+    if head < 0 or self.code is None or not self.code.startswith('2'):
+      return
+    name = line[0:head].strip().lower()
+    value = line[head+1:].strip()
+    if name == 'content-type':
+      if not is_content_type_allowed(value, self.types):
+        self.rejected = REJECTED_TYPE
+        self.content_type = get_media_type(value)
+        return -1
+    elif name == 'content-length':
+      try:
+        length = long(value)
+      except ValueError:
+        return
+      if self.max_size >= 0 and length > self.max_size:
+        self.rejected = REJECTED_SIZE
+        return -1
+
+  def on_body(self, data):
+    # decoded bodies (or without Content-Length) are limited while downloading
+    self.size += len(data)
+    if self.max_size >= 0 and self.size > self.max_size:
+      self.rejected = REJECTED_SIZE
+      return 0
+    self.body.write(data)
+
+# parse comma separated content types, '*' suffix matches a type prefix
+def get_content_types(types):
+  return [t.strip().lower() for t in types.split(',') if len(t.strip()) > 0]
+
+# get media type of Content-Type header value, limited to safe characters
+def get_media_type(content_type):
+  media_type = content_type.split(';')[0].strip().lower()
+  return re.sub(r'[^a-z0-9.+\-/]', '', media_type)
+
+# check if content type is allowed, missing type is allowed
+def is_content_type_allowed(content_type, types):
+  content_type = get_media_type(content_type)
+  if len(content_type) == 0 or len(types) == 0:
+    return True
+  for t in types:
+    if t.endswith('*') and content_type.startswith(t[:-1]):
+      return True
+    elif t == content_type:
+      return True
+  return False
+
+# get curl protocols mask of comma separated protocols
+def get_protocols(protocols):
+  mask = 0
+  for protocol in protocols.split(','):
+    mask |= getattr(pycurl, 'PROTO_%s' % protocol.strip().upper(), 0)
+  return mask
+
+# record bytes on the wire and decoded body bytes as job metrics counters
+def record_bytes(metrics, wire, decoded):
+  with open(metrics, 'a') as f:
+    f.write('C fetch_wire_bytes %d\n' % wire)
+    f.write('C fetch_decoded_bytes %d\n' % decoded)
+
+# set transfer options of curl handle, the handle may be reused across urls
+def setup(c, url, state, user_agent, protocols, max_time):
+  c.setopt(pycurl.URL, url)
+  c.setopt(pycurl.FOLLOWLOCATION, 1)
+  c.setopt(pycurl.MAXREDIRS, 50)
+  c.setopt(pycurl.USERAGENT, user_agent)
+  c.setopt(pycurl.TIMEOUT, int(max_time))
+  c.setopt(pycurl.NOSIGNAL, 1)
+  c.setopt(pycurl.ENCODING, '')
+  c.setopt(pycurl.HEADERFUNCTION, state.on_header)
+  c.setopt(pycurl.WRITEFUNCTION, state.on_body)
+  mask = get_protocols(protocols)
+  if mask:
+    c.setopt(pycurl.PROTOCOLS, mask)
+    c.setopt(pycurl.REDIR_PROTOCOLS, mask)
+
+# fetch url with curl handle into body and headers files, returns (0, curl
+# error code or rejection code, fetch state, bytes on the wire)
+def perform(c, url, body, headers, user_agent, protocols, max_time, max_size,
+  types):
+  with open(headers, 'w') as fh, open(body, 'wb') as fb:
+    state = PageFetch(fh, fb, get_content_types(types), long(max_size))
+    setup(c, url, state, user_agent, protocols, max_time)
+    try:
+      c.perform()
+      ret = 0
+    except pycurl.error as e:
+      ret = e.args[0]
+    wire = c.getinfo(pycurl.HEADER_SIZE) + c.getinfo(pycurl.SIZE_DOWNLOAD)
+
+  # aborted by header or body callback
+  if state.rejected is not None:
+    ret = state.rejected
+  return ret, state, int(wire)
+
+# fetch url into body and headers files, returns 0, curl error code or
+# rejection code (the rejected content type is printed)
+def fetch(url, body, headers, user_agent, protocols, max_time, max_size,
+  types, metrics = None):
+  c = pycurl.Curl()
+  try:
+    ret, state, wire = perform(c, url, body, headers, user_agent, protocols,
+      max_time, max_size, types)
+  finally:
+    c.close()
+
+  if metrics:
+    record_bytes(metrics, wire, state.size)
+  if ret == REJECTED_TYPE and state.content_type is not None:
+    print state.content_type
+  return ret
@@ -0,0 +1,48 @@
+"""
+PageRank generations of the rank type. Rank docs keep the probabilities of
+two generations (prob_0 and prob_1), so a DIST pass of generation G both
+finalizes and distributes: the rank of generation G-1 is set from its
+probability field, which is then cleared for reuse by generation G+1, and
+the rank is distributed to the outlinks into the probability field of
+generation G. One pass over the url set is needed per iteration. The current
+generation is kept in the ranking stats doc (see search.py), each DIST map
+starts the next generation.
+
+"""
+import search
+from elasticsearch import ElasticSearch
+
+# dumping factor of the rank iteration
+D = 0.85
+
+# get probability field of generation
+def get_prob_field(generation):
+  return 'prob_%d' % (generation % 2)
+
+# get rank of accumulated probability
+def get_rank(prob):
+  return 1.0 - D + D * prob
+
+# get initial rank doc, its rank is the rank of generation 0
+def get_initial_rank():
+  return {'rank' : 1.0, 'prob_0' : 1.0, 'prob_1' : 0.0, 'generation' : 0}
+
+# get current generation, 0 if the ranking has not started
+def get_generation(base):
+  url = '%s?fields=generation' % search.get_ranking_url(base)
+  response = ElasticSearch().get(url)
+  fields = response.get('fields', dict())
+  if not response.get('found') or 'generation' not in fields:
+    return 0
+  return fields['generation'][0]
+
+# set current generation
+def set_generation(base, generation):
+  update = {'doc' : {'generation' : generation}, 'doc_as_upsert' : True}
+  ElasticSearch().post('%s/_update' % search.get_ranking_url(base), update)
+
+# start next generation and return it
+def next_generation(base):
+  generation = get_generation(base) + 1
+  set_generation(base, generation)
+  return generation
@@ -0,0 +1,140 @@
+"""
+Opt-in sampling profiler of job processes. When EC_PROFILE is set to a
+sampling interval in milliseconds (see elasticcrawler.conf) and
+EC_PROFILE_OUTPUT to an output prefix (set by the job scripts next to the
+job log), the main thread stack is sampled on the process CPU timer
+(SIGPROF). At exit the samples of the process are merged into the
+collapsed-stack file PREFIX.profile (one 'frame;frame;... COUNT' line per
+stack, the flame graph input format) shared by all processes of the job, and
+the top functions summary PREFIX.top is rewritten.
+
+"""
+import os, sys, fcntl, signal, atexit, collections
+
+# number of functions in the top functions summary
+TOP_FUNCTIONS = 20
+
+# maximum sampled stack depth
+MAX_DEPTH = 100
+
+# active profiler of the process
+active = None
+
+"""
+Stack sampler of the main thread, samples are counted by collapsed stack.
+"""
+class Sampler:
+  # sampling interval in seconds and output prefix
+  interval = 0
+  output = None
+
+  # sample counts by collapsed stack
+  stacks = None
+
+  def __init__(self, interval, output):
+    self.interval = interval
+    self.output = output
+    self.stacks = collections.Counter()
+
+  def on_sample(self, signum, frame):
+    frames = list()
+    while frame is not None and len(frames) < MAX_DEPTH:
+      code = frame.f_code
+      frames.append('%s:%s' % (os.path.basename(code.co_filename),
+        code.co_name))
+      frame = frame.f_back
+    if len(frames) > 0:
+      self.stacks[';'.join(reversed(frames))] += 1
+
+  def start(self):
+    signal.signal(signal.SIGPROF, self.on_sample)
+    # restart system calls interrupted by samples
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+  def stop(self):
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+  # merge samples into the job profile and rewrite the summary
+  def dump(self):
+    self.stop()
+    if len(self.stacks) == 0:
+      return
+    with open(self.output + '.profile', 'a+') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      f.seek(0)
+      stacks = read_stacks(f)
+      stacks.update(self.stacks)
+      f.seek(0)
+      f.truncate()
+      for stack, count in stacks.most_common():
+        f.write('%s %d\n' % (stack, count))
+      f.flush()
+      write_summary(self.output + '.top', stacks, self.interval)
+
+# read sample counts of collapsed-stack file
+def read_stacks(f):
+  stacks = collections.Counter()
+  for line in f:
+    stack, _, count = line.rstrip('\n').rpartition(' ')
+    if len(stack) > 0 and count.isdigit():
+      stacks[stack] += int(count)
+  return stacks
+
+# get (self, total) sample counts by function, total counts a function once
+# per stack
+def get_function_samples(stacks):
+  functions = collections.defaultdict(lambda: [0, 0])
+  for stack, count in stacks.items():
+    frames = stack.split(';')
+    functions[frames[-1]][0] += count
+    for name in set(frames):
+      functions[name][1] += count
+  return functions
+
+# write top functions by self samples
+def write_summary(summary, stacks, interval):
+  samples = sum(stacks.values())
+  functions = get_function_samples(stacks)
+  top = sorted(functions.items(), key=lambda f: (-f[1][0], -f[1][1]))
+  with open(summary, 'w') as f:
+    f.write('Samples: %d (%.2fs cpu, interval %d ms)\n' % (samples,
+      samples * interval, interval * 1000))
+    f.write('[self %]\t[total %]\t[function]\n')
+    for name, counts in top[:TOP_FUNCTIONS]:
+      f.write('%.1f\t%.1f\t%s\n' % (100.0 * counts[0] / samples,
+        100.0 * counts[1] / samples, name))
+
+# start profiler of the process if enabled by EC_PROFILE and
+# EC_PROFILE_OUTPUT, samples are written at exit
+def start():
+  global active
+  if active is not None:
+    return
+  output = os.environ.get('EC_PROFILE_OUTPUT')
+  try:
+    interval = float(os.environ.get('EC_PROFILE', 0)) / 1000
+  except ValueError:
+    interval = 0
+  if interval <= 0 or not output:
+    return
+  # signal handlers can only be set in the main thread
+  sampler = Sampler(interval, output)
+  try:
+    sampler.start()
+  except ValueError:
+    return
+  active = sampler
+  atexit.register(stop)
+
+# stop profiler and write samples
+def stop():
+  global active
+  if active is None:
+    return
+  try:
+    active.dump()
+  except IOError as e:
+    sys.stderr.write('Profile not written: %s\n' % e)
+  active = None
@@ -0,0 +1,169 @@
+"""
+Re-parse of archived raw content (see archive.py). Segments are streamed by
+parallel workers through the content parser and extract_links_and_title,
+and page and node docs are bulk-updated without refetching the urls. Only
+the latest record of each url is used, docs of pruned urls are not
+recreated. The inlink index follows the olinks diff of the updated nodes
+(INLINK_INDEX).
+
+"""
+import os, time, signal, socket, shutil, tempfile, multiprocessing
+import archive
+import inlinks
+import elasticcrawler as ec
+from elasticsearch import ElasticSearch
+
+# latest record offsets by segment, set before the workers are forked
+latest = None
+
+"""
+Raised when parsing of a record takes longer than the parse time.
+"""
+class ParseTimeout(Exception):
+  pass
+
+# raise parse timeout on alarm
+def on_alarm(signum, frame):
+  raise ParseTimeout()
+
+# parse content with Tika text parse server (tika-app -T -s PORT)
+def parse_content(port, data, timeout):
+  s = socket.create_connection(('localhost', port), timeout)
+  try:
+    s.sendall(data)
+    s.shutdown(socket.SHUT_WR)
+    chunks = list()
+    while True:
+      chunk = s.recv(65536)
+      if len(chunk) == 0:
+        break
+      chunks.append(chunk)
+  finally:
+    s.close()
+  return ''.join(chunks)
+
+# get page and node update actions of archived url
+def get_reparse_actions(url, body, workdir, options):
+  fetched = os.path.join(workdir, 'fetched')
+  parsed = os.path.join(workdir, 'parsed')
+  outlinks = os.path.join(workdir, 'outlinks')
+  subject = os.path.join(workdir, 'subject')
+
+  # extract content (tika returns content with title)
+  with open(fetched, 'wb') as f:
+    f.write(body)
+  with open(parsed, 'wb') as f:
+    f.write(parse_content(options['port'], body, options['parse_time']))
+
+  # extract links and title (to subtract from content)
+  ec.extract_links_and_title(url, fetched, options['protocols'],
+    options['excluded'], outlinks, subject, options['strip'])
+
+  # node update action, existing nodes only
+  node_action = dict()
+  node_action['update'] = dict()
+  node_action['update']['_type'] = 'node'
+  node_action['update']['_id'] = ec.get_url_id(url)
+
+  # node update data
+  node_data = dict()
+  node_data['doc'] = dict()
+  node_data['doc']['olinks'] = ec.read_outlinks(outlinks)
+
+  actions = ec.get_page_actions(url, subject, parsed, False)
+  return actions + [node_action, node_data]
+
+# get inlink update actions of the node updates in actions, existing nodes
+# only, the previous olinks are read before the node updates are sent
+def get_inlink_updates(es, base, actions):
+  nodes = [(actions[i]['update']['_id'], actions[i+1]['doc']['olinks'])
+    for i in xrange(0, len(actions), 2)
+    if actions[i]['update'].get('_type') == 'node']
+  previous = inlinks.get_sources(es, base, 'node',
+    [node_id for node_id, olinks in nodes], 'olinks')
+  updates = list()
+  for node_id, olinks in nodes:
+    if node_id in previous:
+      updates.extend(ec.get_inlink_actions(node_id,
+        previous[node_id].get('olinks', []), olinks))
+  return updates
+
+# send bulk of actions, returns number of updated and failed docs
+def send_bulk(es, base, actions):
+  if len(actions) == 0:
+    return 0, 0
+  response = es.bulk('%s/_bulk' % base, actions)
+  updated = len([item for item in response.get('items', [])
+    if item['update'].get('status', 500) < 300])
+  return updated, len(actions) / 2 - updated
+
+# send bulk of page and node updates and the inlink updates of their olinks
+# (inlinks option), returns number of updated and failed page and node docs
+def send_updates(es, base, actions, options):
+  updates = list()
+  if options.get('inlinks') and len(actions) > 0:
+    updates = get_inlink_updates(es, base, actions)
+  counts = send_bulk(es, base, actions)
+  send_bulk(es, base, updates)
+  return counts
+
+# re-parse segment, returns (segment, records, parse errors, updated docs,
+# failed docs, seconds)
+def reparse_segment(args):
+  segment, base, options = args
+  start = time.time()
+  signal.signal(signal.SIGALRM, on_alarm)
+  es = ElasticSearch(True, options['compress'])
+  workdir = tempfile.mkdtemp(prefix='ec-reparse-')
+  records, errors, updated, failed = 0, 0, 0, 0
+  actions = list()
+  try:
+    for url_id, url, headers, body in archive.iterate_records(segment, latest):
+      records += 1
+      try:
+        signal.alarm(options['parse_time'])
+        actions.extend(get_reparse_actions(url, body, workdir, options))
+      except Exception:
+        errors += 1
+      finally:
+        signal.alarm(0)
+
+      # bulk size counts docs, each doc takes two lines
+      if len(actions) >= 2 * options['bulk_size']:
+        counts = send_updates(es, base, actions, options)
+        updated, failed = updated + counts[0], failed + counts[1]
+        actions = list()
+    counts = send_updates(es, base, actions, options)
+    updated, failed = updated + counts[0], failed + counts[1]
+  finally:
+    es.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+  return segment, records, errors, updated, failed, time.time() - start
+
+# re-parse segments with parallel workers and report progress
+def reparse(segments, base, jobs, options):
+  global latest
+  start = time.time()
+  latest = archive.get_latest_records(segments)
+  print "Records: %d urls in %d segments" % (sum(map(len, latest.values())),
+    len(segments))
+
+  # one segment per worker task, largest first
+  segments = sorted(segments, key=os.path.getsize, reverse=True)
+  pool = multiprocessing.Pool(jobs)
+  total = [0, 0, 0, 0]
+  try:
+    for result in pool.imap_unordered(reparse_segment,
+      [(s, base, options) for s in segments]):
+      print "Segment: %s records %d errors %d docs updated %d failed %d " \
+        "(%.1fs)" % ((os.path.basename(result[0]),) + result[1:])
+      total = [t + r for t, r in zip(total, result[1:5])]
+  finally:
+    pool.close()
+    pool.join()
+
+  elapsed = time.time() - start
+  print "Total: records %d errors %d docs updated %d failed %d " \
+    "(%.1f records/s)" % tuple(total + [total[0] / elapsed if elapsed > 0
+    else 0])
+  return total
@@ -0,0 +1,315 @@
+"""
+Rank-aware search of fetched pages. Title and body matches are combined with
+the published page rank (function_score), results are cached in an LRU
+cache keyed by the normalized query and page. The cache is cleared when a
+ranking PUBL step publishes new ranks (stats doc 'ranking'). Queries are
+sent with a timeout to the ES node with the fewest active and queued search
+requests.
+
+"""
+import re, time, json, urlparse, threading, collections
+import BaseHTTPServer, SocketServer
+import pycurl
+from elasticsearch import ElasticSearch, ElasticNodes
+
+# ranking stats doc type and id in the index
+RANKING_TYPE = 'stats'
+RANKING_ID = 'ranking'
+
+# client timeout over the query timeout in milliseconds, so timed out
+# queries return partial results
+TIMEOUT_MARGIN = 1000
+
+# get url of ranking stats doc
+def get_ranking_url(base):
+  return '%s/%s/%s' % (base, RANKING_TYPE, RANKING_ID)
+
+# mark ranks published, cached search results become stale
+def set_published(base):
+  doc = {'published' : long(time.time() * 1000)}
+  update = {'doc' : doc, 'doc_as_upsert' : True}
+  ElasticSearch().post('%s/_update' % get_ranking_url(base), update)
+
+# get time of the last rank publication, 0 if never published
+def get_published(es, base):
+  response = es.get('%s?fields=published' % get_ranking_url(base))
+  if not response.get('found'):
+    return 0
+  return response['fields']['published'][0]
+
+# normalize query: lowercase words separated by single spaces
+def normalize_query(query):
+  if type(query) is str:
+    query = query.decode('utf-8', 'replace')
+  return ' '.join(re.findall(r'\w+|[^\w\s]+', query.lower(), re.UNICODE))
+
+# get search request of query page, ranks are published page ranks
+def get_search_request(query, page, size, timeout):
+  request = dict()
+  request['from'] = page * size
+  request['size'] = size
+  request['timeout'] = '%dms' % timeout
+  request['_source'] = ['url', 'title', 'rank']
+  request['query'] = {
+    'function_score' : {
+      'query' : {
+        'multi_match' : {
+          'query' : query,
+          'fields' : ['title^3', 'body^2', 'url']
+        }
+      },
+      'field_value_factor' : {
+        'field' : 'rank',
+        'missing' : 1
+      },
+      'boost_mode' : 'multiply'
+    }
+  }
+  request['highlight'] = {
+    'fields' : {
+      'body' : {
+        'fragment_size' : 100,
+        'number_of_fragments' : 3,
+        'no_match_size' : 100
+      }
+    }
+  }
+  return request
+
+# get results of search response
+def get_results(response):
+  results = dict()
+  results['total'] = response['hits']['total']
+  results['took'] = response.get('took', 0)
+  results['timed_out'] = response.get('timed_out', False)
+  results['hits'] = list()
+  for hit in response['hits']['hits']:
+    source = hit.get('_source', dict())
+    result = dict()
+    result['url'] = source.get('url')
+    result['title'] = source.get('title')
+    result['rank'] = source.get('rank', 1.0)
+    result['score'] = hit.get('_score')
+    result['snippets'] = hit.get('highlight', dict()).get('body', list())
+    results['hits'].append(result)
+  return results
+
+"""
+LRU cache of search results, cleared when ranks are published.
+"""
+class ResultCache:
+  # cached results by key, least recently used first
+  entries = None
+  size = 0
+
+  # publication time of cached results
+  published = 0
+
+  # hit and miss counters
+  hits = 0
+  misses = 0
+
+  def __init__(self, size):
+    self.entries = collections.OrderedDict()
+    self.size = size
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      results = self.entries.pop(key, None)
+      if results is None:
+        self.misses += 1
+        return None
+      self.entries[key] = results
+      self.hits += 1
+      return results
+
+  def put(self, key, results):
+    if self.size <= 0:
+      return
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = results
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  # clear cache if ranks have been published since cached results
+  def set_published(self, published):
+    with self.lock:
+      if published != self.published:
+        self.entries.clear()
+        self.published = published
+
+"""
+Search of the default index with result cache and least-loaded node
+routing. Node loads and rank publication are checked every check interval.
+"""
+class Search:
+  # ES host, port and index
+  host = None
+  port = None
+  index = None
+
+  # query timeout in milliseconds and page size
+  timeout = 0
+  page_size = 10
+
+  # seconds between node load and publication checks
+  check = 0
+  checked = 0
+
+  # selected node
+  node = None
+
+  def __init__(self, host, port, index, timeout, page_size, cache_size,
+    check):
+    self.host = host
+    self.port = port
+    self.index = index
+    self.timeout = timeout
+    self.page_size = page_size
+    self.check = check
+    self.node = host
+    self.cache = ResultCache(cache_size)
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  # get ES connection of current thread
+  def get_es(self):
+    es = getattr(self.local, 'es', None)
+    if es is None:
+      es = ElasticSearch(True, False, self.timeout + TIMEOUT_MARGIN)
+      self.local.es = es
+    return es
+
+  # get node with the fewest active and queued search requests
+  def get_least_loaded(self, es):
+    nodes = ElasticNodes(es.get('%s:%s/_nodes/stats/thread_pool' %
+      (self.host, self.port)))
+    loads = [(nodes.get_search_load(n), nodes.get_ip(n))
+      for n in nodes.get_nodes()]
+    return min(loads)[1] if len(loads) > 0 else self.host
+
+  # check node loads and rank publication every check interval
+  def refresh(self):
+    with self.lock:
+      if time.time() - self.checked < self.check:
+        return
+      self.checked = time.time()
+    es = self.get_es()
+    try:
+      self.node = self.get_least_loaded(es)
+    except (pycurl.error, ValueError, KeyError, IndexError):
+      self.node = self.host
+    try:
+      base = '%s:%s/%s' % (self.host, self.port, self.index)
+      self.cache.set_published(get_published(es, base))
+    except (pycurl.error, ValueError, KeyError):
+      pass
+
+  # search query page, returns (results, cached)
+  def search(self, query, page = 0):
+    self.refresh()
+    query = normalize_query(query)
+    key = (query, page, self.page_size)
+    results = self.cache.get(key)
+    if results is not None:
+      return results, True
+
+    # timed out queries return partial results, they are not cached
+    request = '%s:%s/%s/page/_search' % (self.node, self.port, self.index)
+    try:
+      response = self.get_es().post(request, get_search_request(query, page,
+        self.page_size, self.timeout))
+    except pycurl.error:
+      # select another node on the next query
+      self.checked = 0
+      raise
+    if 'hits' not in response:
+      raise ValueError(response.get('error', 'Invalid search response'))
+    results = get_results(response)
+    if not results['timed_out']:
+      self.cache.put(key, results)
+    return results, False
+
+"""
+HTTP search service: GET /search?q=QUERY&page=PAGE returns results as json,
+GET /status returns cache counters.
+"""
+class SearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, port, search):
+    BaseHTTPServer.HTTPServer.__init__(self, ('', port), SearchHandler)
+    self.search = search
+
+"""
+Request handler of SearchServer.
+"""
+class SearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def reply(self, code, data):
+    body = json.dumps(data)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    params = dict(urlparse.parse_qsl(url.query))
+    search = self.server.search
+    if url.path == '/status':
+      cache = search.cache
+      self.reply(200, {'node' : search.node, 'cached' : len(cache.entries),
+        'hits' : cache.hits, 'misses' : cache.misses,
+        'published' : cache.published})
+      return
+    if url.path != '/search' or len(params.get('q', '').strip()) == 0:
+      self.reply(404, {'error' : 'Use /search?q=QUERY[&page=PAGE]'})
+      return
+    try:
+      page = max(0, int(params.get('page', 0)))
+    except ValueError:
+      page = 0
+    try:
+      results, cached = search.search(params['q'], page)
+    except pycurl.error as e:
+      self.reply(504, {'error' : e.args[-1]})
+      return
+    except ValueError as e:
+      self.reply(502, {'error' : str(e)})
+      return
+    response = dict(results)
+    response['query'] = normalize_query(params['q'])
+    response['page'] = page
+    response['cached'] = cached
+    self.reply(200, response)
+
+# run HTTP search service until interrupted
+def serve(port, search):
+  server = SearchServer(port, search)
+  print "Search service on port %d" % port
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+# print search results of query page
+def print_results(query, page, size, results):
+  first = page * size
+  print "Results %d-%d of %d for '%s' (%d ms%s)" % (
+    min(results['total'], first + 1), first + len(results['hits']),
+    results['total'], normalize_query(query).encode('utf-8'),
+    results['took'], ', timed out' if results['timed_out'] else '')
+  for hit in results['hits']:
+    print
+    print '%.3f %s' % (hit['rank'], hit['url'])
+    if hit['title']:
+      print '  %s' % hit['title'].encode('utf-8')
+    for snippet in hit['snippets']:
+      print '  ... %s' % snippet.encode('utf-8').replace('\n', ' ')
@@ -0,0 +1,136 @@
+"""
+Seeding of url nodes (ec-create-urls and the fetch helper). Urls allowed by
+the client access rules are canonicalized, links to cached permanent redirect
+sources are rewritten to their targets, crawler traps and hosts over the url
+limit are rejected, and the remaining urls are created as new node docs. The
+created urls are counted in the url stats and the host link counts.
+
+"""
+import sys
+import pycurl
+import elasticcrawler as ec
+import stats
+from elasticsearch import ElasticSearch
+
+# errors of ES requests and responses
+ES_ERRORS = (pycurl.error, ValueError, KeyError)
+
+# write error of step to job log
+def log_error(step, e):
+  sys.stderr.write('Seeding: %s failed (%s)\n' % (step, e))
+
+# get cached permanent redirects and known url counts of url hosts, without
+# them the batch is seeded without redirect rewrites and url limits (logged)
+def get_host_links(es, base, urls):
+  hosts = dict()
+  known = dict()
+  host_ids = list(set(ec.get_netloc_id(url) for url in urls))
+  if len(host_ids) > 0:
+    request = '%s/host/_mget?fields=redirects,urls' % base
+    try:
+      response = es.post(request, {'ids' : host_ids})
+      for doc in response['docs']:
+        if 'fields' in doc and 'redirects' in doc['fields']:
+          hosts[doc['_id']] = doc['fields']['redirects']
+        if 'fields' in doc and 'urls' in doc['fields']:
+          known[doc['_id']] = doc['fields']['urls'][0]
+    except ES_ERRORS as e:
+      log_error('host links', e)
+  return hosts, known
+
+# get node create actions of urls and links (seeded url hosts by id and
+# rejected links by host, for host link counts), options are the url
+# limits and strip parameters (see create_urls)
+def get_create_actions(urls, hosts, known, options):
+  actions = list()
+  created = set()
+  links = {'hosts' : dict(), 'rejected' : dict()}
+  for url in urls:
+    # link to redirect source is rewritten to its (canonical) target
+    url = ec.get_canonical_url(ec.get_redirect_target(url, hosts),
+      options['strip'])
+
+    # get id
+    id = ec.get_url_id(url)
+    if id in created:
+      continue
+    created.add(id)
+
+    # reject crawler traps and hosts over the url limit
+    host_id = ec.get_netloc_id(url)
+    reason = ec.get_link_rejection(url, known.get(host_id, 0),
+      options['max_depth'], options['max_params'], options['max_repeats'],
+      options['max_urls'])
+    if reason is not None:
+      rejected = links['rejected'].setdefault(host_id, dict())
+      rejected[reason] = rejected.get(reason, 0) + 1
+      continue
+    links['hosts'][id] = host_id
+    known[host_id] = known.get(host_id, 0) + 1
+
+    actions.append({'create' : {'_id' : id}})
+    actions.append({'url' : url})
+  return actions, links
+
+# add created urls and rejected links to host link counts
+def add_host_links(es, base, links, items):
+  hosts = dict((host_id, [0, rejected])
+    for host_id, rejected in links['rejected'].items())
+  for item in items:
+    host_id = links['hosts'].get(item['create']['_id'])
+    if host_id is not None and item['create'].get('status') == 201:
+      hosts.setdefault(host_id, [0, dict()])[0] += 1
+  actions = ec.get_host_links_actions(dict((k, tuple(v))
+    for k, v in hosts.items()))
+  if len(actions) > 0:
+    es.bulk('%s/_bulk' % base, actions)
+
+# create node docs of urls allowed by client access rules on ES base
+# (host:port/index), created urls are counted in the url stats (deferred to
+# the stats changes file, if given), the bulk response is returned
+def create_urls(urls, base, rules, options, deltas = None, es = None):
+  if es is None:
+    es = ElasticSearch(False, options['compress'])
+  urls = [ec.get_canonical_url(url, options['strip']) for url in urls
+    if ec.is_access_allowed(url, rules)]
+  hosts, known = get_host_links(es, base, urls)
+  actions, links = get_create_actions(urls, hosts, known, options)
+  if len(actions) == 0:
+    response = {'errors' : False, 'items' : []}
+  else:
+    response = es.bulk('%s/node/_bulk' % base, actions)
+  items = response.get('items', [])
+
+  # count created urls as new in url stats
+  created = len([item for item in items
+    if item.get('create', dict()).get('status') == 201])
+  if created > 0:
+    if deltas:
+      with open(deltas, 'a') as f:
+        f.write('T %d %d\n' % (created, created))
+    else:
+      try:
+        delta = stats.StatsDelta()
+        delta.add(created, created)
+        stats.update_stats(base, delta)
+      except ES_ERRORS as e:
+        # unknown delta, the next read recounts the urls
+        log_error('url stats', e)
+        try:
+          stats.mark_stale(base)
+        except ES_ERRORS as e:
+          log_error('url stats stale mark', e)
+
+  # add created urls and rejected links to host link counts
+  if len(links['rejected']) > 0 or created > 0:
+    try:
+      add_host_links(es, base, links, items)
+    except ES_ERRORS as e:
+      log_error('host link counts', e)
+  return response
+
+# get seeding options of configuration values
+def get_options(strip, max_depth, max_params, max_repeats, max_urls,
+  compress = False):
+  return {'strip' : strip, 'max_depth' : max_depth, 'max_params' : max_params,
+    'max_repeats' : max_repeats, 'max_urls' : max_urls, 'compress' : compress}
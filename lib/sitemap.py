@@ -0,0 +1,305 @@
+"""
+Sitemap discovery. Sitemap files listed in the cached robots of a host are
+fetched and stream-parsed (plain or gzipped XML, urlset or sitemapindex),
+so memory use does not depend on the sitemap size. Listed urls of the host
+are seeded in batches by ec-create-urls, crawled urls modified after their
+last fetch (lastmod) are reset to new, so they are refetched first. Child
+sitemaps not modified since the last sitemap run of the host are skipped.
+
+"""
+import os, re, gzip, time, calendar, datetime, tempfile, shutil, subprocess
+import xml.etree.cElementTree as etree
+import elasticcrawler as ec
+import pagefetch
+import stats
+from elasticsearch import ElasticSearch
+
+# batch size of _mget requests
+MGET_SIZE = 1000
+
+# sitemap entry kinds
+SITEMAP = 'sitemap'
+URL = 'url'
+
+"""
+Raised when a decompressed sitemap exceeds the maximum sitemap size.
+"""
+class SitemapTooLarge(Exception):
+  pass
+
+"""
+File reader limited to a maximum number of bytes, used to bound the
+decompressed size of gzipped sitemaps.
+"""
+class LimitedReader:
+  # underlying file and remaining bytes
+  f = None
+  remaining = 0
+
+  def __init__(self, f, max_size):
+    self.f = f
+    self.remaining = max_size
+
+  def read(self, size = -1):
+    data = self.f.read(size)
+    self.remaining -= len(data)
+    if self.remaining < 0:
+      raise SitemapTooLarge()
+    return data
+
+# get sitemap urls declared in robots file (Sitemap: URL lines)
+def get_robots_sitemaps(robots):
+  sitemaps = list()
+  with open(robots) as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+      if ':' not in line:
+        continue
+      name, value = [part.strip() for part in line.split(':', 1)]
+      if name.lower() == 'sitemap' and len(value) > 0 and \
+         value not in sitemaps:
+        sitemaps.append(value)
+  return sitemaps
+
+# parse W3C datetime of lastmod (YYYY[-MM[-DD[Thh:mm[:ss[.s]]TZD]]]) into
+# milliseconds since epoch, None if invalid
+def parse_lastmod(value):
+  m = re.match(r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})'
+    r'(?::(\d{2})(?:\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?)?)?$', value.strip())
+  if m is None:
+    return None
+  parts = [int(p) if p else d for p, d in zip(m.groups()[:6],
+    [0, 1, 1, 0, 0, 0])]
+  try:
+    seconds = calendar.timegm(datetime.datetime(*parts).utctimetuple())
+  except ValueError:
+    return None
+
+  # time zone offset
+  zone = m.group(7)
+  if zone and zone != 'Z':
+    offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+    seconds -= offset if zone[0] == '+' else -offset
+  return seconds * 1000
+
+# open sitemap file, gzipped sitemaps are detected by magic bytes
+def open_sitemap(sitemap, max_size):
+  with open(sitemap, 'rb') as f:
+    magic = f.read(2)
+  if magic == '\x1f\x8b':
+    return LimitedReader(gzip.open(sitemap, 'rb'), max_size)
+  return LimitedReader(open(sitemap, 'rb'), max_size)
+
+# get local name of XML tag ({namespace}name)
+def get_local_name(tag):
+  return tag.rsplit('}', 1)[-1]
+
+# iterate (kind, loc, lastmod) of sitemap file entries, kind is SITEMAP
+# for sitemap index entries and URL for urlset entries, parsed elements are
+# cleared so memory stays bounded
+def iterate_sitemap(sitemap, max_size):
+  f = open_sitemap(sitemap, max_size)
+  try:
+    loc, lastmod = None, None
+    context = etree.iterparse(f, events=('start', 'end'))
+    event, root = context.next()
+    for event, elem in context:
+      if event != 'end':
+        continue
+      name = get_local_name(elem.tag)
+      if name == 'loc':
+        loc = (elem.text or '').strip()
+      elif name == 'lastmod':
+        lastmod = parse_lastmod(elem.text or '')
+      elif name in [SITEMAP, URL]:
+        if loc:
+          yield name, loc, lastmod
+        loc, lastmod = None, None
+        root.clear()
+  finally:
+    f.f.close()
+
+"""
+Batch of sitemap urls with their lastmod times. Batches are seeded by
+ec-create-urls, crawled urls modified after their last fetch are reset to
+new by the ec_node_modified script.
+"""
+class SitemapBatch:
+  # urls by id, values are (url, lastmod)
+  urls = None
+
+  # processed url counts
+  seeded = 0
+  modified = 0
+
+  def __init__(self):
+    self.urls = dict()
+
+  def add(self, url, lastmod):
+    self.urls[ec.get_url_id(url)] = (url, lastmod)
+
+  def size(self):
+    return len(self.urls)
+
+  # seed urls and reset modified urls, then clear the batch
+  def flush(self, base, create, compress):
+    if self.size() == 0:
+      return
+    self.seed(create)
+    self.reset_modified(base, compress)
+    self.urls = dict()
+
+  # seed urls with ec-create-urls (existing urls are not created)
+  def seed(self, create):
+    workdir = tempfile.mkdtemp(prefix='ec-sitemap-')
+    try:
+      batch = os.path.join(workdir, 'urls')
+      with open(batch, 'w') as f:
+        for url, lastmod in self.urls.values():
+          f.write(ec.encode_utf8(url) + '\n')
+      with open(os.devnull, 'w') as devnull:
+        subprocess.call(['sh', create, batch], stdout=devnull,
+          stderr=devnull)
+      self.seeded += self.size()
+    finally:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  # reset crawled urls modified after their last fetch to new urls
+  def reset_modified(self, base, compress):
+    es = ElasticSearch(True, compress)
+    actions = list()
+    delta = stats.StatsDelta()
+    try:
+      ids = [i for i, (url, lastmod) in self.urls.items() if lastmod]
+      for i in range(0, len(ids), MGET_SIZE):
+        request = '%s/node/_mget?fields=status,tag,_timestamp' % base
+        response = es.post(request, {'ids' : ids[i:i+MGET_SIZE]})
+        for doc in response['docs']:
+          fields = doc.get('fields', dict())
+          if 'status' not in fields or '_timestamp' not in fields:
+            continue
+          lastmod = self.urls[doc['_id']][1]
+          if lastmod <= fields['_timestamp']:
+            continue
+          actions.append({'update' : {'_id' : doc['_id']}})
+          actions.append({'script' : 'ec_node_modified',
+            'params' : {'lastmod' : lastmod}})
+          delta.add(0, 1)
+          delta.add_tag(fields['tag'][0] if 'tag' in fields else None, 0, 1)
+      if len(actions) > 0:
+        es.bulk('%s/node/_bulk' % base, actions)
+        self.modified += len(actions) / 2
+    finally:
+      es.close()
+    stats.update_stats(base, delta)
+
+# get cached robots (host id, robots url, robots, last sitemap run time) of
+# host urls, hosts without cached robots are left out
+def get_hosts_robots(base, urls):
+  hosts = dict()
+  for url in urls:
+    hosts.setdefault(ec.get_netloc_id(url), url)
+  robots = list()
+  host_ids = hosts.keys()
+  es = ElasticSearch(True)
+  try:
+    for i in range(0, len(host_ids), MGET_SIZE):
+      request = '%s/host/_mget?fields=url,robots,sitemaps' % base
+      response = es.post(request, {'ids' : host_ids[i:i+MGET_SIZE]})
+      for doc in response['docs']:
+        fields = doc.get('fields', dict())
+        if 'robots' not in fields or 'url' not in fields:
+          print "Robots not cached: %s" % hosts[doc['_id']]
+          continue
+        since = fields['sitemaps'][0] if 'sitemaps' in fields else 0
+        robots.append((doc['_id'], fields['url'][0], fields['robots'][0],
+          since))
+  finally:
+    es.close()
+  return robots
+
+# fetch sitemap into file, returns True if fetched
+def fetch_sitemap(url, sitemap, options):
+  headers = sitemap + '.headers'
+  ret = pagefetch.fetch(url, sitemap, headers, options['user_agent'],
+    options['protocols'], options['fetch_time'], options['fetch_size'], '')
+  if ret != 0:
+    return False
+  with open(headers) as f:
+    codes = re.findall(r'^HTTP/\S+\s+(\d+)', f.read(), re.MULTILINE)
+  return len(codes) > 0 and codes[-1] == '200'
+
+# discover urls of host from its sitemaps, urls are added to the batch and
+# the batch is flushed when full, returns (sitemaps fetched, urls listed)
+def discover_host(host_id, robots_url, robots, since, batch, options):
+  workdir = tempfile.mkdtemp(prefix='ec-sitemap-')
+  fetched, listed = 0, 0
+  try:
+    robots_file = os.path.join(workdir, 'robots')
+    with open(robots_file, 'w') as f:
+      f.write(ec.encode_utf8(robots))
+    delay = max(ec.get_crawl_delay(robots_file, options['user_agent']) or 0,
+      options['delay'])
+
+    # sitemap index entries are queued, at most max files per host
+    queue = get_robots_sitemaps(robots_file)
+    seen = set(queue)
+    sitemap = os.path.join(workdir, 'sitemap')
+    while len(queue) > 0 and fetched < options['max_files']:
+      url = queue.pop(0)
+      if fetched > 0:
+        time.sleep(delay)
+      fetched += 1
+      if not fetch_sitemap(url, sitemap, options):
+        print "Sitemap failed: %s" % url
+        continue
+      try:
+        for kind, loc, lastmod in iterate_sitemap(sitemap,
+          options['max_size']):
+          if kind == SITEMAP:
+            # skip child sitemaps not modified since the last run
+            if loc not in seen and (lastmod is None or lastmod > since):
+              seen.add(loc)
+              queue.append(loc)
+            continue
+
+          # only urls of the host are seeded
+          loc = ec.get_canonical_url(loc, options['strip'])
+          if ec.get_netloc_id(loc) != host_id:
+            continue
+          listed += 1
+          batch.add(loc, lastmod)
+          if batch.size() >= options['batch_size']:
+            batch.flush(options['base'], options['create'],
+              options['compress'])
+      except (SyntaxError, SitemapTooLarge, IOError) as e:
+        print "Sitemap invalid: %s (%s)" % (url, type(e).__name__)
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+  return fetched, listed
+
+# set time of the last sitemap run of host
+def set_sitemaps_time(base, host_id, start):
+  update = {'doc' : {'sitemaps' : start}}
+  ElasticSearch().post('%s/host/%s/_update' % (base, host_id), update)
+
+# discover urls from sitemaps of hosts of urls and report progress
+def discover(urls, options):
+  start = long(time.time() * 1000)
+  base = options['base']
+  urls = [ec.get_canonical_url(url, options['strip']) for url in urls]
+  batch = SitemapBatch()
+  total = [0, 0]
+  for host_id, robots_url, robots, since in get_hosts_robots(base, urls):
+    fetched, listed = discover_host(host_id, robots_url, robots, since,
+      batch, options)
+    if fetched > 0:
+      set_sitemaps_time(base, host_id, start)
+    print "Host: %s sitemaps %d urls %d" % (ec.get_host(robots_url),
+      fetched, listed)
+    total = [total[0] + fetched, total[1] + listed]
+  batch.flush(base, options['create'], options['compress'])
+
+  print "Total: sitemaps %d urls %d seeded %d modified %d" % (total[0],
+    total[1], batch.seeded, batch.modified)
+  return total + [batch.seeded, batch.modified]
@@ -0,0 +1,170 @@
+import os, json, time, hashlib, tempfile
+from elasticsearch import ElasticSearch
+
+# url stats doc type and id in the index
+STATS_TYPE = 'stats'
+STATS_ID = 'urls'
+
+# batch size of _mget requests
+MGET_SIZE = 1000
+
+"""
+Url count changes (any and new urls, in total and per tag). Changes are
+collected as lines 'T ANY NEW' (totals) and 'G TAG ANY NEW' (tag counts)
+and added to the stats doc by ec_stats_add script.
+"""
+class StatsDelta:
+  # total and per tag changes
+  any = 0
+  new = 0
+  tags = None
+
+  def __init__(self, deltas = None):
+    self.tags = dict()
+    if deltas is not None and os.path.exists(deltas):
+      self.load(deltas)
+
+  def load(self, deltas):
+    with open(deltas) as f:
+      for line in f:
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == 'T':
+          self.add(int(parts[1]), int(parts[2]))
+        elif len(parts) == 4 and parts[0] == 'G':
+          self.add_tag(parts[1], int(parts[2]), int(parts[3]))
+
+  def add(self, any, new):
+    self.any += any
+    self.new += new
+
+  def add_tag(self, tag, any, new):
+    if tag is None or tag == '-':
+      return
+    counts = self.tags.setdefault(tag, {'any' : 0, 'new' : 0})
+    counts['any'] += any
+    counts['new'] += new
+
+  def is_empty(self):
+    return self.any == 0 and self.new == 0 and \
+      all(c['any'] == 0 and c['new'] == 0 for c in self.tags.values())
+
+  def get_params(self):
+    return {'any' : self.any, 'new' : self.new, 'tags' : self.tags}
+
+# get url of stats doc
+def get_stats_url(base):
+  return '%s/%s/%s' % (base, STATS_TYPE, STATS_ID)
+
+# get local cache file of stats doc
+def get_cache_file(base):
+  name = 'ec-stats-%s.json' % hashlib.sha1(base).hexdigest()[:16]
+  return os.path.join(tempfile.gettempdir(), name)
+
+# add delta to stats doc, missing doc is left for the next recount
+def update_stats(base, delta):
+  if delta.is_empty():
+    return
+  update = dict()
+  update['script'] = 'ec_stats_add'
+  update['params'] = dict()
+  update['params']['deltas'] = delta.get_params()
+  ElasticSearch().post('%s/_update' % get_stats_url(base), update)
+
+# add collected deltas to stats doc and clear the deltas file
+def flush_deltas(deltas, base):
+  if not os.path.exists(deltas):
+    return
+  update_stats(base, StatsDelta(deltas))
+  open(deltas, 'w').close()
+
+# mark stats doc stale, the next read recounts the urls
+def mark_stale(base):
+  update = {'doc' : {'stale' : True}}
+  ElasticSearch().post('%s/_update' % get_stats_url(base), update)
+
+# count urls and tags with live queries and store the stats doc
+def recount(base):
+  es = ElasticSearch()
+  new_filter = {'missing' : {'field' : 'status'}}
+  any_count = es.post('%s/node/_count' % base,
+    {'query' : {'match_all' : {}}})['count']
+  new_count = es.post('%s/node/_count' % base,
+    {'query' : {'filtered' : {'filter' : new_filter}}})['count']
+
+  # tag counts of any and new urls
+  aggregations = dict()
+  aggregations['any_tags'] = {'terms' : {'field' : 'tag', 'size' : 0}}
+  aggregations['new_tags'] = {'filter' : new_filter, 'aggregations' :
+    {'unique' : {'terms' : {'field' : 'tag', 'size' : 0}}}}
+  response = es.post('%s/node/_search?search_type=count' % base,
+    {'aggregations' : aggregations})['aggregations']
+  tags = dict()
+  for bucket in response['any_tags']['buckets']:
+    tags[bucket['key']] = {'any' : bucket['doc_count'], 'new' : 0}
+  for bucket in response['new_tags']['unique']['buckets']:
+    tags.setdefault(bucket['key'], {'any' : 0, 'new' : 0})
+    tags[bucket['key']]['new'] = bucket['doc_count']
+
+  # store stats doc
+  doc = dict()
+  doc['any'] = any_count
+  doc['new'] = new_count
+  doc['tags'] = tags
+  doc['time'] = long(time.time() * 1000)
+  doc['stale'] = False
+  es.post(get_stats_url(base), doc)
+  return doc
+
+# get stats doc from local cache (ttl seconds) or index, recount if stale
+def get_stats(base, ttl, max_age):
+  cache = get_cache_file(base)
+  if os.path.exists(cache) and time.time() - os.path.getmtime(cache) < ttl:
+    with open(cache) as f:
+      return json.load(f)
+
+  # read stats doc, recount if missing, marked stale or too old
+  response = ElasticSearch().get(get_stats_url(base))
+  doc = response.get('_source') if response.get('found') else None
+  if doc is None or doc.get('stale') or \
+     time.time() - doc['time'] / 1000.0 > max_age:
+    doc = recount(base)
+
+  # write cache atomically
+  with open(cache + '.tmp', 'w') as f:
+    json.dump(doc, f)
+  os.rename(cache + '.tmp', cache)
+  return doc
+
+# count any or new urls (optionally of a tag) from stats doc
+def get_count(base, strategy, tag, ttl, max_age):
+  doc = get_stats(base, ttl, max_age)
+  if tag:
+    return doc['tags'].get(tag, dict()).get(strategy, 0)
+  return doc[strategy]
+
+# list tags of any or new urls from stats doc, most frequent first
+def get_tags(base, strategy, ttl, max_age):
+  doc = get_stats(base, ttl, max_age)
+  tags = [(counts[strategy], tag) for tag, counts in doc['tags'].items()
+    if counts[strategy] > 0]
+  return [tag for count, tag in sorted(tags, key=lambda t: (-t[0], t[1]))]
+
+# get stats delta of setting tag on urls with ids
+def get_tag_delta(base, ids, tag):
+  es = ElasticSearch(True)
+  delta = StatsDelta()
+  ids = list(set(ids))
+  for i in range(0, len(ids), MGET_SIZE):
+    request = '%s/node/_mget?fields=tag,status' % base
+    response = es.post(request, {'ids' : ids[i:i+MGET_SIZE]})
+    for doc in response['docs']:
+      if not doc.get('found'):
+        continue
+      fields = doc.get('fields', dict())
+      old = fields['tag'][0] if 'tag' in fields else None
+      new = 0 if 'status' in fields else 1
+      if old != tag:
+        delta.add_tag(old, -1, -new)
+        delta.add_tag(tag, 1, new)
+  es.close()
+  return delta
@@ -0,0 +1,319 @@
+"""
+Backpressure throttle of ES writers. Bulk requests of the fetch loop and the
+ranking jobs are sent through a throttle level shared by the writers of a
+host (state file in the temp folder, keyed by the ES base url). Rejected
+bulk items (status 429, bulk thread pool full), bulk requests slower than
+the latency limit and bulk thread pool queues or rejections of the nodes
+(_nodes/stats, every check interval) raise the level, a recovery period
+without pressure lowers it. Each level halves the bulk size and the number
+of concurrent writers (writer slots are file locks), levels beyond a single
+writer pause it before each bulk request, doubling the pause per level.
+Rejected items are retried with a backoff doubled per attempt. Level changes
+are reported to stderr, the job log.
+
+"""
+import os, sys, json, time, fcntl, hashlib, tempfile
+import pycurl
+from elasticsearch import ElasticSearch, ElasticNodes
+from properties import Properties
+
+# highest throttle level
+MAX_LEVEL = 6
+
+# minimum bulk size in docs
+MIN_BULK_SIZE = 10
+
+# number of retries of rejected items
+RETRIES = 5
+
+# minimum seconds between level raises, writers see the same pressure
+RAISE_WAIT = 1.0
+
+# seconds between writer slot checks
+SLOT_WAIT = 0.1
+
+# status of rejected bulk items and requests
+REJECTED = 429
+
+# throttle options and their configuration variables (elasticcrawler.conf)
+OPTIONS = {
+  'writers' : 'THROTTLE_WRITERS',
+  'latency' : 'THROTTLE_LATENCY',
+  'queue' : 'THROTTLE_QUEUE',
+  'check' : 'THROTTLE_CHECK_INTERVAL',
+  'recovery' : 'THROTTLE_RECOVERY',
+  'pause' : 'THROTTLE_PAUSE',
+}
+
+# default options
+DEFAULTS = {
+  'writers' : 8,
+  'latency' : 5000,
+  'queue' : 40,
+  'check' : 10,
+  'recovery' : 30,
+  'pause' : 200,
+}
+
+# get throttle options of EC configuration (Properties)
+def get_options(conf):
+  options = dict()
+  for name, variable in OPTIONS.items():
+    try:
+      options[name] = int(conf[variable])
+    except ValueError:
+      options[name] = DEFAULTS[name]
+  return options
+
+# load throttle options of EC configuration file
+def load_options(config):
+  conf = Properties()
+  with open(config) as f:
+    conf.load(f)
+  return get_options(conf)
+
+# get throttle state file of ES base (host:port/index)
+def get_state_file(base):
+  name = 'ec-throttle-%s' % hashlib.sha1(base).hexdigest()[:16]
+  return os.path.join(tempfile.gettempdir(), name)
+
+# get ES host url of ES base
+def get_host(base):
+  return base.rstrip('/').rsplit('/', 1)[0]
+
+# get bulk item status
+def get_status(item):
+  return item.values()[0].get('status', 500)
+
+# split bulk actions into (action, data) items, deletes have no data
+def get_items(actions):
+  items = list()
+  i = 0
+  while i < len(actions):
+    if 'delete' in actions[i]:
+      items.append(actions[i:i+1])
+      i += 1
+    else:
+      items.append(actions[i:i+2])
+      i += 2
+  return items
+
+"""
+Throttle of the ES writers of a host, see module description.
+"""
+class Throttle:
+  # ES base, options and shared state file
+  base = None
+  options = None
+  state = None
+
+  # counters of the process
+  bulks = 0
+  rejected = 0
+  retried = 0
+  waited = 0.0
+
+  def __init__(self, base, options):
+    self.base = base
+    self.options = options
+    self.state = get_state_file(base)
+
+  # read shared state, update function of state changes it (False for no
+  # change)
+  def update_state(self, update = None):
+    with open(self.state, 'a+') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      f.seek(0)
+      try:
+        state = json.load(f)
+      except ValueError:
+        state = dict()
+      state.setdefault('level', 0)
+      state.setdefault('changed', 0)
+      state.setdefault('pressure', 0)
+      state.setdefault('checked', 0)
+      state.setdefault('nodes', dict())
+      if update is not None and update(state) is not False:
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        f.flush()
+      return state
+
+  # get number of writers, pause in seconds and bulk size divisor of level
+  def get_limits(self, level):
+    writers = max(1, self.options['writers'] >> level)
+    # levels beyond a single writer
+    single = level - (self.options['writers'].bit_length() - 1)
+    pause = 0.0 if single <= 0 else \
+      self.options['pause'] * 2 ** (single - 1) / 1000.0
+    return writers, pause, 2 ** level
+
+  # get bulk size of the current level
+  def get_bulk_size(self, bulk_size):
+    level = self.update_state()['level']
+    return max(min(MIN_BULK_SIZE, bulk_size), bulk_size >> level)
+
+  # report level change
+  def report(self, level, reason):
+    writers, pause, divisor = self.get_limits(level)
+    sys.stderr.write('Throttle: level %d (%s), writers %d, pause %d ms, ' \
+      'bulk size 1/%d\n' % (level, reason, writers, pause * 1000, divisor))
+
+  # raise level on pressure
+  def set_pressure(self, reason):
+    def update(state):
+      now = time.time()
+      state['pressure'] = now
+      if state['level'] < MAX_LEVEL and now - state['changed'] >= RAISE_WAIT:
+        state['level'] += 1
+        state['changed'] = now
+        self.report(state['level'], reason)
+    self.update_state(update)
+
+  # lower level after the recovery period without pressure
+  def recover(self, state):
+    now = time.time()
+    recovery = self.options['recovery']
+    if state['level'] == 0 or now - state['pressure'] < recovery or \
+       now - state['changed'] < recovery:
+      return False
+    state['level'] -= 1
+    state['changed'] = now
+    self.report(state['level'], 'recovered')
+
+  # check bulk thread pool queues and rejections of the nodes, once per
+  # check interval for all writers
+  def check_nodes(self, es):
+    claimed = list()
+    def claim(state):
+      if time.time() - state['checked'] < self.options['check']:
+        return False
+      state['checked'] = time.time()
+      claimed.append(True)
+    self.update_state(claim)
+    if len(claimed) == 0:
+      return
+    try:
+      nodes = ElasticNodes(es.get('%s/_nodes/stats/thread_pool' %
+        get_host(self.base)))
+      queues = [nodes.get_bulk_queue(n) for n in nodes.get_nodes()]
+      rejected = dict((n, nodes.get_bulk_rejected(n))
+        for n in nodes.get_nodes())
+    except (pycurl.error, ValueError, KeyError, TypeError):
+      return
+
+    # rejected counters of the last check
+    previous = dict()
+    def update(state):
+      previous.update(state['nodes'])
+      state['nodes'] = rejected
+    self.update_state(update)
+    if max(queues + [0]) > self.options['queue']:
+      self.set_pressure('bulk queue %d' % max(queues))
+    elif any(rejected[n] > previous.get(n, rejected[n]) for n in rejected):
+      self.set_pressure('node bulk rejections')
+
+  # acquire writer slot of the level, returns locked slot file
+  def acquire(self, writers):
+    while True:
+      for slot in range(writers):
+        f = open('%s.%d' % (self.state, slot), 'a')
+        try:
+          fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          return f
+        except IOError:
+          f.close()
+      time.sleep(SLOT_WAIT)
+      self.waited += SLOT_WAIT
+
+  # send bulk in a writer slot after the pause of the level, returns
+  # (response, seconds)
+  def send(self, es, url, actions):
+    state = self.update_state(self.recover)
+    writers, pause, divisor = self.get_limits(state['level'])
+    slot = self.acquire(writers)
+    try:
+      time.sleep(pause)
+      self.waited += pause
+      start = time.time()
+      response = es.bulk(url, actions)
+      return response, time.time() - start
+    finally:
+      slot.close()
+
+  # wait before retry of rejected items
+  def backoff(self, attempt):
+    wait = self.options['pause'] * 2 ** attempt / 1000.0
+    time.sleep(wait)
+    self.waited += wait
+
+  # send bulk of actions, rejected items are retried; returns the bulk
+  # response with the last status of each item
+  def bulk(self, es, url, actions):
+    self.check_nodes(es)
+    items = get_items(actions)
+    statuses = [None] * len(items)
+    pending = range(len(items))
+    response = dict()
+    for attempt in range(RETRIES + 1):
+      response, seconds = self.send(es, url,
+        [line for i in pending for line in items[i]])
+      self.bulks += 1
+      if seconds * 1000 > self.options['latency']:
+        self.set_pressure('bulk latency %d ms' % (seconds * 1000))
+
+      # whole request rejected or failed
+      if 'items' not in response:
+        if response.get('status') != REJECTED or attempt == RETRIES:
+          return response
+        self.set_pressure('bulk request rejected')
+        self.backoff(attempt)
+        continue
+
+      # retry rejected items
+      rejected = list()
+      for i, item in zip(pending, response['items']):
+        statuses[i] = item
+        if get_status(item) == REJECTED:
+          rejected.append(i)
+      if len(rejected) == 0:
+        break
+      self.rejected += len(rejected)
+      self.set_pressure('%d of %d items rejected' % (len(rejected),
+        len(pending)))
+      if attempt < RETRIES:
+        self.retried += len(rejected)
+        pending = rejected
+        self.backoff(attempt)
+
+    response['items'] = statuses
+    response['errors'] = any(get_status(item) >= 300 for item in statuses)
+    return response
+
+  # report counters of the process
+  def report_counters(self):
+    state = self.update_state()
+    sys.stderr.write('Throttle: level %d, bulks %d, rejected items %d, ' \
+      'retried %d, waited %d ms\n' % (state['level'], self.bulks,
+      self.rejected, self.retried, self.waited * 1000))
+
+# send bulk file (one json line per action) with the throttle of ES base and
+# get the response, throttle counters are appended to the metrics events
+# file (fetch loop, see FetchHelper of helper.py)
+def bulk_file(url, data, base, config, compress = False, metrics = None,
+  es = None):
+  with open(data) as f:
+    actions = [json.loads(line) for line in f if len(line.strip()) > 0]
+  throttle = Throttle(base, load_options(config))
+  if es is None:
+    es = ElasticSearch(False, compress)
+  try:
+    response = throttle.bulk(es, url, actions)
+  except pycurl.error as e:
+    response = {'error' : e.args[-1], 'status' : 503}
+  if metrics:
+    with open(metrics, 'a') as f:
+      f.write('C es_bulk_rejected %d\n' % throttle.rejected)
+      f.write('C es_throttle_wait_ms %d\n' % (throttle.waited * 1000))
+  return response
@@ -0,0 +1,165 @@
+"""
+Compact url id sets and maps. Url ids (SHA1 of the url, see get_url_id) are
+kept as sorted arrays of 20-byte digests instead of 40-character hex
+strings, about 20 bytes per id instead of well over 100. Lookups are binary
+searches within the bucket of the first two digest bytes (fanout table).
+Maps are built from sorted chunks merged at the end, so large maps do not
+need a dict of all ids, and processes forked from the process that built a
+map share its pages.
+
+"""
+import heapq, binascii
+from cStringIO import StringIO
+from array import array
+
+# digest size in bytes
+ID_SIZE = 20
+
+# fanout table buckets (first two digest bytes)
+BUCKETS = 65536
+
+# number of ids sorted per chunk while building
+CHUNK_SIZE = 65536
+
+# convert hex url id to digest
+def to_binary(url_id):
+  return binascii.unhexlify(url_id)
+
+# convert digest to hex url id
+def to_hex(digest):
+  return binascii.hexlify(digest)
+
+# get fanout bucket of digest
+def get_bucket(digest):
+  return (ord(digest[0]) << 8) | ord(digest[1])
+
+# get fanout table of sorted digests, entry b is the index of the first
+# digest of bucket b
+def get_fanout(data, offset, size):
+  fanout = array('I', [0]) * (BUCKETS + 1)
+  for i in xrange(size):
+    start = offset + i * ID_SIZE
+    fanout[get_bucket(data[start:start+2]) + 1] += 1
+  for bucket in xrange(BUCKETS):
+    fanout[bucket+1] += fanout[bucket]
+  return fanout
+
+"""
+Sorted set of digests in a string buffer.
+"""
+class IdSet:
+  # digests buffer, offset of the first digest and number of digests
+  data = ''
+  offset = 0
+  size = 0
+
+  # fanout table
+  fanout = None
+
+  def __init__(self, data = '', fanout = None, offset = 0):
+    self.data = data
+    self.offset = offset
+    self.size = (len(data) - offset) / ID_SIZE
+    self.fanout = fanout if fanout is not None else \
+      get_fanout(data, offset, self.size)
+
+  def __len__(self):
+    return self.size
+
+  def __contains__(self, digest):
+    return self.find(digest) >= 0
+
+  def __iter__(self):
+    for index in xrange(self.size):
+      yield self.get(index)
+
+  # get digest at index
+  def get(self, index):
+    start = self.offset + index * ID_SIZE
+    return self.data[start:start+ID_SIZE]
+
+  # get index of digest, -1 if not found
+  def find(self, digest):
+    bucket = get_bucket(digest)
+    low, high = self.fanout[bucket], self.fanout[bucket+1]
+    while low < high:
+      middle = (low + high) / 2
+      found = self.get(middle)
+      if found < digest:
+        low = middle + 1
+      elif found > digest:
+        high = middle
+      else:
+        return middle
+    return -1
+
+  # check if hex url id is in the set
+  def contains_id(self, url_id):
+    return to_binary(url_id) in self
+
+  # iterate hex url ids
+  def iter_ids(self):
+    for digest in self:
+      yield to_hex(digest)
+
+"""
+Sorted digests with a value per digest (array of the value typecode).
+"""
+class IdMap(IdSet):
+  # values in digest order
+  values = None
+
+  def __init__(self, data = '', values = None, fanout = None):
+    IdSet.__init__(self, data, fanout)
+    self.values = values if values is not None else array('l')
+
+  # get value of digest, default if not found
+  def get_value(self, digest, default = None):
+    index = self.find(digest)
+    return self.values[index] if index >= 0 else default
+
+  # iterate (digest, value) pairs
+  def items(self):
+    for index in xrange(self.size):
+      yield self.get(index), self.values[index]
+
+# get compact chunk of (digest, value) dict: (sorted digests, values, chunk
+# number)
+def get_chunk(chunk, typecode, number):
+  keys = sorted(chunk)
+  return ''.join(keys), array(typecode, [chunk[k] for k in keys]), number
+
+# get sorted chunks of (digest, value) items, later items of a digest win
+def get_sorted_chunks(items, typecode, chunk_size):
+  chunks = list()
+  chunk = dict()
+  for digest, value in items:
+    chunk[digest] = value
+    if len(chunk) >= chunk_size:
+      chunks.append(get_chunk(chunk, typecode, len(chunks)))
+      chunk = dict()
+  if len(chunk) > 0:
+    chunks.append(get_chunk(chunk, typecode, len(chunks)))
+  return chunks
+
+# iterate (digest, -chunk number, value) of compact chunk
+def iterate_chunk(chunk):
+  data, values, number = chunk
+  for index in xrange(len(values)):
+    yield data[index*ID_SIZE:(index+1)*ID_SIZE], -number, values[index]
+
+# build map of (digest, value) items in any order, the last value of a
+# digest wins
+def build_map(items, typecode = 'l', chunk_size = CHUNK_SIZE):
+  chunks = get_sorted_chunks(items, typecode, chunk_size)
+  digests = StringIO()
+  values = array(typecode)
+  last = None
+  # equal digests come latest chunk first
+  for digest, number, value in heapq.merge(*map(iterate_chunk, chunks)):
+    if digest != last:
+      digests.write(digest)
+      values.append(value)
+      last = digest
+  del chunks
+  return IdMap(digests.getvalue(), values)
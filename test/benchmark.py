@@ -0,0 +1,59 @@
+#
+# Plumbing shared by the benchmarks in this folder: EC installation config,
+# results files (one json line per run, see get_result) and the change
+# since the previous run with the same parameters.
+#
+import os, re, json, time, subprocess
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+EC_HOME = os.path.dirname(TEST_DIR)
+
+# add results file option of benchmark NAME to argument parser
+def add_output_option(parser, name):
+  parser.add_argument('-o', '--output',
+    default=os.path.join(TEST_DIR, '%s.results' % name),
+    help='results file (one json line per run)')
+
+# set configuration variables in EC config file
+def set_config(config, values):
+  with open(config) as f:
+    text = f.read()
+  for name, value in values.items():
+    text = re.sub(r'(?m)^%s=.*$' % name, '%s=%s' % (name, value), text)
+  with open(config, 'w') as f:
+    f.write(text)
+
+# get git revision of the benchmarked tree
+def get_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+      cwd=EC_HOME, stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# get new result of a run with the command line options as parameters
+def get_result(options):
+  params = dict(vars(options))
+  del params['output']
+  result = dict()
+  result['time'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+  result['revision'] = get_revision()
+  result['params'] = params
+  return result
+
+# get last result of a run with the same parameters
+def get_previous(output, params):
+  previous = None
+  if os.path.exists(output):
+    with open(output) as f:
+      for line in f:
+        result = json.loads(line)
+        if result['params'] == params:
+          previous = result
+  return previous
+
+# append result to results file
+def append_result(output, result):
+  with open(output, 'a') as f:
+    f.write('%s\n' % json.dumps(result, sort_keys=True))
+  print "Results appended to %s" % output
@@ -0,0 +1,800 @@
+#
+# Local stand-ins for the services used by Elasticcrawler: a minimal
+# Elasticsearch endpoint, a synthetic web site graph served as HTTP proxy and
+# a Tika text parse server. Used by the benchmarks in this folder.
+#
+import re, json, time, random, socket, threading, hashlib, urlparse, gzip
+import BaseHTTPServer, SocketServer
+from io import BytesIO
+from collections import Counter
+
+# dumping factor used by the ranking scripts
+D = 0.85
+
+# python twins of the ES scripts in lib folder
+def ec_rank_prob_add(source, params):
+  source[params['prob']] += params['delta']
+
+def ec_rank_update(source, params):
+  source['rank'] = 1.0 - D + D * source[params['prob']]
+  source['generation'] = params['generation']
+
+def ec_host_redirect_add(source, params):
+  redirects = [r for r in source.get('redirects', [])
+    if not r.startswith(params['id'] + ' ')]
+  redirects.append(params['redirect'])
+  source['redirects'] = redirects[-params['limit']:]
+
+def ec_host_reject_update(source, params):
+  prefix = params['pattern'] + ' '
+  rejected = source.get('rejected', [])
+  old = [r for r in rejected if r.startswith(prefix)]
+  rejected = [r for r in rejected if not r.startswith(prefix)]
+  if params['type'] is not None:
+    count = int(old[0].split(' ')[1]) + 1 if old else 1
+    rejected.append('%s%d %s' % (prefix, count, params['type']))
+  source['rejected'] = rejected[-params['limit']:]
+
+def ec_host_links_add(source, params):
+  source['urls'] = source.get('urls', 0) + params['urls']
+  rejected = source.setdefault('rejected_links', dict())
+  for reason, count in params['rejected'].items():
+    rejected[reason] = rejected.get(reason, 0) + count
+
+def ec_node_modified(source, params):
+  source['lastmod'] = params['lastmod']
+  source.pop('status', None)
+
+def ec_stats_add(source, params):
+  deltas = params['deltas']
+  source['any'] += deltas['any']
+  source['new'] += deltas['new']
+  tags = source.setdefault('tags', dict())
+  for tag, delta in deltas['tags'].items():
+    counts = tags.setdefault(tag, {'any' : 0, 'new' : 0})
+    counts['any'] += delta['any']
+    counts['new'] += delta['new']
+
+def ec_inlink_update(source, params):
+  ilinks = source.setdefault('ilinks', [])
+  count = source.get('count', len(ilinks))
+  for i in params['remove']:
+    if i in ilinks:
+      ilinks.remove(i)
+      count -= 1
+    elif count > len(ilinks):
+      count -= 1
+  for i in params['add']:
+    if i not in ilinks:
+      if len(ilinks) < params['max']:
+        ilinks.append(i)
+      count += 1
+  source['count'] = count
+  if count <= 0:
+    return 'delete'
+
+def ec_host_stats_update(source, params):
+  alpha = params['alpha']
+  if source.get('response_time') is None:
+    source['response_time'] = params['time']
+  else:
+    source['response_time'] += alpha * (params['time'] - source['response_time'])
+  source['timeouts'] = (1 - alpha) * source.get('timeouts', 0) + params['timeout']
+  source['errors'] = (1 - alpha) * source.get('errors', 0) + params['error']
+  if params['timeout'] + params['error'] > 0:
+    source['failures'] = source.get('failures', 0) + 1
+    if source['failures'] >= params['threshold']:
+      exponent = min(20, source['failures'] - params['threshold'])
+      source['breaker_until'] = params['now'] + min(params['max_backoff'],
+        params['backoff'] * 2 ** exponent)
+  else:
+    source['failures'] = 0
+    source['breaker_until'] = 0
+
+SCRIPTS = {
+  'ec_rank_prob_add' : ec_rank_prob_add,
+  'ec_rank_update' : ec_rank_update,
+  'ec_host_redirect_add' : ec_host_redirect_add,
+  'ec_stats_add' : ec_stats_add,
+  'ec_host_stats_update' : ec_host_stats_update,
+  'ec_host_reject_update' : ec_host_reject_update,
+  'ec_host_links_add' : ec_host_links_add,
+  'ec_node_modified' : ec_node_modified,
+  'ec_inlink_update' : ec_inlink_update,
+}
+
+# get current time in milliseconds
+def now_ms():
+  return long(time.time() * 1000)
+
+# convert ES date math 'now-AGE' to milliseconds
+def date_math_ms(value):
+  units = {'s' : 1000, 'm' : 60000, 'h' : 3600000, 'd' : 86400000}
+  m = re.match(r'now(-(\d+)([smhd]))?$', str(value))
+  if m is None:
+    return long(value)
+  if m.group(1) is None:
+    return now_ms()
+  return now_ms() - long(m.group(2)) * units[m.group(3)]
+
+# flatten nested settings into dotted names
+def flatten_settings(settings, prefix = ''):
+  flat = dict()
+  for name, value in settings.items():
+    if isinstance(value, dict):
+      flat.update(flatten_settings(value, prefix + name + '.'))
+    else:
+      flat[prefix + name] = str(value)
+  return flat
+
+# gzip encode data
+def gzip_encode(data):
+  output = BytesIO()
+  with gzip.GzipFile(fileobj=output, mode='wb') as f:
+    f.write(data)
+  return output.getvalue()
+
+"""
+Threaded HTTP server base.
+"""
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def get_port(self):
+    return self.server_address[1]
+
+"""
+Minimal Elasticsearch endpoint with in-memory documents. Supports document
+GET/PUT/DELETE, _update, _bulk, _mget (with _source_include), _count, scan and
+scroll, _search_shards, _nodes/stats/thread_pool, _settings (flat),
+_optimize, multi_match queries (any word), terms and filter aggregations
+and the named scripts in SCRIPTS. Gzip request
+bodies are decoded, responses are gzip encoded on request if compression is
+enabled (http.compression). Operation counters are kept in 'stats'. With
+bulk_threads only that many bulk requests run at once (each takes bulk_delay
+seconds), items of further concurrent bulks are rejected with status 429 like
+a full bulk thread pool.
+"""
+class FakeElasticsearch(ThreadedHTTPServer):
+  # documents by (index, type, id), values are (source, timestamp)
+  docs = None
+  # flat index settings by index
+  settings = None
+  # scroll id to (id list, position, size, fields)
+  scrolls = None
+  # operation counters
+  stats = None
+  # running bulk requests
+  bulk_active = 0
+
+  def __init__(self, port = 0, scripts = SCRIPTS, compression = False,
+    bulk_threads = 0, bulk_delay = 0):
+    ThreadedHTTPServer.__init__(self, ('127.0.0.1', port), FakeElasticsearchHandler)
+    self.compression = compression
+    self.bulk_threads = bulk_threads
+    self.bulk_delay = bulk_delay
+    self.docs = dict()
+    self.settings = dict()
+    self.scrolls = dict()
+    self.stats = Counter()
+    self.scripts = dict(scripts)
+    self.lock = threading.RLock()
+
+  def put(self, index, type, id, source):
+    with self.lock:
+      self.docs[(index, type, id)] = (source, now_ms())
+
+  def get(self, index, type, id):
+    with self.lock:
+      doc = self.docs.get((index, type, id))
+      return None if doc is None else doc[0]
+
+  def ids(self, index, type = None):
+    with self.lock:
+      return [k[2] for k in self.docs.keys()
+        if k[0] == index and (type is None or k[1] == type)]
+
+  # check if document matches a (small) subset of ES 1.x query DSL
+  def matches(self, doc, query):
+    source, timestamp = doc
+    if query is None or len(query) == 0:
+      return True
+    name, body = query.items()[0]
+    if name == 'match_all':
+      return True
+    if name == 'query':
+      return self.matches(doc, body)
+    if name == 'filtered':
+      return self.matches(doc, body.get('query')) and \
+        self.matches(doc, body.get('filter'))
+    if name == 'function_score':
+      return self.matches(doc, body.get('query'))
+    if name == 'multi_match':
+      words = body['query'].lower().split()
+      text = ' '.join(unicode(source.get(f.split('^')[0], ''))
+        for f in body['fields']).lower()
+      return any(w in text for w in words)
+    if name == 'and':
+      return all(self.matches(doc, q) for q in body)
+    if name == 'missing':
+      return source.get(body['field']) is None
+    if name == 'exists':
+      return source.get(body['field']) is not None
+    if name == 'term':
+      field, value = body.items()[0]
+      return source.get(field) == value
+    if name == 'range':
+      field, bounds = body.items()[0]
+      value = timestamp if field == '_timestamp' else source.get(field)
+      if value is None:
+        return False
+      for op, bound in bounds.items():
+        bound = date_math_ms(bound) if field == '_timestamp' else bound
+        if op == 'lt' and not value < bound: return False
+        if op == 'lte' and not value <= bound: return False
+        if op == 'gt' and not value > bound: return False
+        if op == 'gte' and not value >= bound: return False
+      return True
+    # unsupported queries match everything
+    return True
+
+  # evaluate terms and filter aggregations over documents
+  def aggregate(self, docs, aggregations):
+    result = dict()
+    for name, body in aggregations.items():
+      if 'terms' in body:
+        counts = Counter(doc[0].get(body['terms']['field']) for doc in docs)
+        buckets = [{'key' : key, 'doc_count' : count}
+          for key, count in counts.most_common() if key is not None]
+        result[name] = {'buckets' : buckets}
+      elif 'filter' in body:
+        matched = [doc for doc in docs if self.matches(doc, body['filter'])]
+        result[name] = self.aggregate(matched, body.get('aggregations', {}))
+        result[name]['doc_count'] = len(matched)
+    return result
+
+  def search(self, index, type, query):
+    with self.lock:
+      return [k[2] for k, doc in self.docs.items() if k[0] == index and
+        (type is None or k[1] == type) and self.matches(doc, query)]
+
+  # apply single bulk action, return item status
+  def apply(self, index, type, action, meta, data):
+    key = (index, meta.get('_type', type), meta.get('_id'))
+    self.stats[action] += 1
+    with self.lock:
+      doc = self.docs.get(key)
+      if action == 'delete':
+        if doc is None:
+          return 404
+        del self.docs[key]
+        return 200
+      if action == 'create' and doc is not None:
+        return 409
+      if action in ['create', 'index']:
+        self.docs[key] = (data, now_ms())
+        return 201
+      if action == 'update':
+        if doc is None:
+          if 'upsert' in data:
+            self.docs[key] = (dict(data['upsert']), now_ms())
+            return 201
+          if data.get('doc_as_upsert'):
+            self.docs[key] = (dict(data['doc']), now_ms())
+            return 201
+          return 404
+        source = dict(doc[0])
+        if 'doc' in data:
+          source.update(data['doc'])
+        # scripts return 'delete' to delete the doc (ctx.op)
+        if 'script' in data:
+          self.stats['script'] += 1
+          op = self.scripts[data['script']](source, data.get('params', dict()))
+          if op == 'delete':
+            del self.docs[key]
+            return 200
+        self.docs[key] = (source, now_ms())
+        return 200
+    return 400
+
+  def get_doc_response(self, index, type, id, fields = None, include = None):
+    response = {'_index' : index, '_type' : type, '_id' : id}
+    doc = self.docs.get((index, type, id))
+    response['found'] = doc is not None
+    if doc is None:
+      return response
+    source, timestamp = doc
+    response['_version'] = 1
+    if fields is None or '_source' in fields:
+      response['_source'] = source if include is None else \
+        dict((k, v) for k, v in source.items() if k in include)
+    if fields is not None:
+      response['fields'] = dict()
+      for field in fields:
+        if field == '_timestamp':
+          response['fields'][field] = timestamp
+        elif field in source:
+          value = source[field]
+          response['fields'][field] = value if isinstance(value, list) \
+            else [value]
+    return response
+
+"""
+Request handler of FakeElasticsearch.
+"""
+class FakeElasticsearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, code, data):
+    body = json.dumps(data)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    if self.server.compression and \
+       'gzip' in self.headers.get('Accept-Encoding', ''):
+      body = gzip_encode(body)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.server.stats['response_bytes'] += len(body)
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def read_body(self):
+    length = int(self.headers.get('Content-Length', 0))
+    body = self.rfile.read(length) if length > 0 else ''
+    self.server.stats['request_bytes'] += len(body)
+    if self.headers.get('Content-Encoding') == 'gzip' and len(body) > 0:
+      body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+    return body
+
+  def do_HEAD(self): self.handle_request()
+  def do_GET(self): self.handle_request()
+  def do_PUT(self): self.handle_request()
+  def do_POST(self): self.handle_request()
+  def do_DELETE(self): self.handle_request()
+
+  def handle_request(self):
+    es = self.server
+    url = urlparse.urlparse(self.path)
+    params = dict(urlparse.parse_qsl(url.query))
+    parts = [p for p in url.path.split('/') if len(p) > 0]
+    body = self.read_body()
+    es.stats['requests'] += 1
+
+    # split path into index, type, id and endpoint
+    endpoint = None
+    if len(parts) > 0 and parts[0].startswith('_'):
+      endpoint = '/'.join(parts)
+      parts = list()
+    elif len(parts) > 0 and parts[-1].startswith('_'):
+      endpoint = parts.pop()
+    index = parts[0] if len(parts) > 0 else None
+    type = parts[1] if len(parts) > 1 else None
+    id = parts[2] if len(parts) > 2 else None
+
+    try:
+      handler = getattr(self, 'handle_%s' % (endpoint or 'doc').strip('_')
+        .replace('/', '_'), None)
+      if handler is None:
+        self.reply(200, {'acknowledged' : True})
+      else:
+        handler(index, type, id, params, body)
+    except Exception, e:
+      self.reply(500, {'error' : repr(e), 'status' : 500})
+
+  def handle_doc(self, index, type, id, params, body):
+    es = self.server
+    if id is None:
+      self.reply(200, {'acknowledged' : True})
+    elif self.command in ['GET', 'HEAD']:
+      es.stats['get'] += 1
+      fields = params['fields'].split(',') if 'fields' in params else None
+      with es.lock:
+        response = es.get_doc_response(index, type, id, fields)
+      self.reply(200 if response['found'] else 404, response)
+    elif self.command == 'DELETE':
+      status = es.apply(index, type, 'delete', {'_id' : id}, None)
+      self.reply(status, {'found' : status == 200, '_id' : id})
+    else:
+      es.stats['put'] += 1
+      es.put(index, type, id, json.loads(body))
+      self.reply(201, {'_index' : index, '_type' : type, '_id' : id,
+        'created' : True})
+
+  def handle_update(self, index, type, id, params, body):
+    status = self.server.apply(index, type, 'update', {'_id' : id},
+      json.loads(body))
+    self.reply(status, {'_index' : index, '_type' : type, '_id' : id})
+
+  def handle_bulk(self, index, type, id, params, body):
+    es = self.server
+    es.stats['bulk'] += 1
+    with es.lock:
+      rejected = es.bulk_threads > 0 and es.bulk_active >= es.bulk_threads
+      if rejected:
+        es.stats['bulk_rejected'] += 1
+      else:
+        es.bulk_active += 1
+    try:
+      if not rejected:
+        time.sleep(es.bulk_delay)
+      self.reply_bulk(index, type, body, rejected)
+    finally:
+      if not rejected:
+        with es.lock:
+          es.bulk_active -= 1
+
+  # apply bulk actions (or reject them) and reply with their statuses
+  def reply_bulk(self, index, type, body, rejected):
+    es = self.server
+    lines = [line for line in body.split('\n') if len(line.strip()) > 0]
+    items = list()
+    errors = False
+    i = 0
+    while i < len(lines):
+      action, meta = json.loads(lines[i]).items()[0]
+      data = None
+      if action != 'delete':
+        i += 1
+        data = json.loads(lines[i])
+      i += 1
+      es.stats['bulk_items'] += 1
+      if rejected:
+        es.stats['bulk_items_rejected'] += 1
+        status = 429
+      else:
+        status = es.apply(index, type, action, meta, data)
+      item = {'_index' : index, '_type' : meta.get('_type', type),
+        '_id' : meta.get('_id'), 'status' : status}
+      if status >= 300:
+        errors = True
+        item['error'] = 'Failed with status %d' % status
+      items.append({action : item})
+    self.reply(200, {'took' : 1, 'errors' : errors, 'items' : items})
+
+  def handle_mget(self, index, type, id, params, body):
+    es = self.server
+    request = json.loads(body)
+    if 'ids' in request:
+      docs = [{'_type' : type, '_id' : doc_id} for doc_id in request['ids']]
+    else:
+      docs = request['docs']
+    fields = params['fields'].split(',') if 'fields' in params else None
+    include = params['_source_include'].split(',') \
+      if '_source_include' in params else None
+    es.stats['mget'] += 1
+    es.stats['mget_docs'] += len(docs)
+    with es.lock:
+      response = [es.get_doc_response(doc.get('_index', index),
+        doc.get('_type', type), doc['_id'], doc.get('fields', fields),
+        include)
+        for doc in docs]
+    self.reply(200, {'docs' : response})
+
+  def handle_count(self, index, type, id, params, body):
+    query = json.loads(body).get('query') if len(body) > 0 else None
+    self.reply(200, {'count' : len(self.server.search(index, type, query))})
+
+  def handle_search(self, index, type, id, params, body):
+    es = self.server
+    request = json.loads(body) if len(body) > 0 else dict()
+    ids = es.search(index, type, request.get('query'))
+    size = int(params.get('size', request.get('size', 10)))
+    first = int(request.get('from', 0))
+    fields = request.get('fields')
+    include = request.get('_source') \
+      if isinstance(request.get('_source'), list) else None
+    aggregations = request.get('aggregations', request.get('aggs'))
+    if aggregations is not None:
+      with es.lock:
+        docs = [es.docs[(index, type, doc_id)] for doc_id in ids]
+        response = self.get_hits(index, type, [], fields, len(ids))
+        response['aggregations'] = es.aggregate(docs, aggregations)
+      self.reply(200, response)
+      return
+    if 'scroll' not in params:
+      self.reply(200, self.get_hits(index, type, ids[first:first+size], fields,
+        len(ids), include))
+      return
+    # register scan and scroll
+    with es.lock:
+      scroll_id = hashlib.sha1('%s%d' % (self.path, len(es.scrolls))).hexdigest()
+      es.scrolls[scroll_id] = (index, type, ids, 0, size, fields)
+    response = self.get_hits(index, type, [], fields, len(ids))
+    response['_scroll_id'] = scroll_id
+    self.reply(200, response)
+
+  def handle_search_scroll(self, index, type, id, params, body):
+    es = self.server
+    scroll_id = params.get('scroll_id', body.strip())
+    es.stats['scroll'] += 1
+    with es.lock:
+      if self.command == 'DELETE' or scroll_id not in es.scrolls:
+        es.scrolls.pop(scroll_id, None)
+        self.reply(200, {'succeeded' : True})
+        return
+      index, type, ids, pos, size, fields = es.scrolls[scroll_id]
+      es.scrolls[scroll_id] = (index, type, ids, pos + size, size, fields)
+      response = self.get_hits(index, type, ids[pos:pos+size], fields, len(ids))
+    response['_scroll_id'] = scroll_id
+    self.reply(200, response)
+
+  def get_hits(self, index, type, ids, fields, total, include = None):
+    es = self.server
+    hits = list()
+    with es.lock:
+      for doc_id in ids:
+        doc_type = type
+        if doc_type is None:
+          doc_type = [k[1] for k in es.docs.keys()
+            if k[0] == index and k[2] == doc_id][0]
+        hit = es.get_doc_response(index, doc_type, doc_id, fields, include)
+        hit['_score'] = 1.0
+        del hit['found']
+        hits.append(hit)
+    return {'took' : 1, 'hits' : {'total' : total, 'hits' : hits}}
+
+  def handle_nodes_stats_thread_pool(self, index, type, id, params, body):
+    node = {'name' : 'fake', 'host' : 'localhost',
+      'ip' : ['inet[/127.0.0.1:9300]', 'NONE'],
+      'thread_pool' : {'search' : {'active' : 0, 'queue' : 0},
+      'bulk' : {'active' : self.server.bulk_active, 'queue' : 0,
+      'rejected' : self.server.stats['bulk_rejected']}}}
+    self.reply(200, {'nodes' : {'fake' : node}})
+
+  def handle_search_shards(self, index, type, id, params, body):
+    node = {'name' : 'fake', 'transport_address' : 'inet[/127.0.0.1:9300]'}
+    shard = {'state' : 'STARTED', 'primary' : True, 'node' : 'fake',
+      'index' : index, 'shard' : 0}
+    self.reply(200, {'nodes' : {'fake' : node}, 'shards' : [[shard]]})
+
+  def handle_refresh(self, index, type, id, params, body):
+    self.reply(200, {'_shards' : {'total' : 1, 'successful' : 1, 'failed' : 0}})
+
+  def handle_optimize(self, index, type, id, params, body):
+    self.server.stats['optimize'] += 1
+    self.handle_refresh(index, type, id, params, body)
+
+  def handle_settings(self, index, type, id, params, body):
+    es = self.server
+    with es.lock:
+      settings = es.settings.setdefault(index, {'index.refresh_interval' :
+        '1s', 'index.number_of_replicas' : '1'})
+      if self.command == 'PUT':
+        es.stats['settings'] += 1
+        request = flatten_settings(json.loads(body))
+        settings.update(dict((k if k.startswith('index.') else 'index.' + k,
+          v) for k, v in request.items()))
+        self.reply(200, {'acknowledged' : True})
+      else:
+        self.reply(200, {index : {'settings' : dict(settings)}})
+
+"""
+Synthetic web site graph served as HTTP proxy: any request for
+http://siteH.bench/pN is answered with a generated page. Page content,
+links, sizes, errors and redirects are reproducible for a given seed.
+Redirected pages answer /pN with 301 to /pages/pN. Some pages link to
+images served as /media/pN without file extension. Robots declare a sitemap
+index of gzipped sitemaps listing all pages. Pages are gzip encoded
+for clients accepting it.
+"""
+class FakeSite(ThreadedHTTPServer):
+  # pages per sitemap file
+  SITEMAP_SIZE = 1000
+
+  def __init__(self, port = 0, hosts = 10, pages = 1000, links = 20,
+               latency = 0.0, min_size = 2000, max_size = 20000,
+               error_rate = 0.0, redirect_rate = 0.0, binary_rate = 0.0,
+               seed = 0):
+    ThreadedHTTPServer.__init__(self, ('127.0.0.1', port), FakeSiteHandler)
+    self.hosts = hosts
+    self.pages = pages
+    self.links = links
+    self.latency = latency
+    self.min_size = min_size
+    self.max_size = max_size
+    self.error_rate = error_rate
+    self.redirect_rate = redirect_rate
+    self.binary_rate = binary_rate
+    self.seed = seed
+    self.stats = Counter()
+
+  def get_url(self, host, page):
+    return 'http://site%d.bench/p%d' % (host, page)
+
+  def get_random(self, host, page):
+    return random.Random('%d/%d/%d' % (self.seed, host, page))
+
+  def get_links(self, host, page):
+    # mostly links within the host, some to other hosts
+    rnd = self.get_random(host, page)
+    links = list()
+    for i in range(self.links):
+      target_host = host if rnd.random() < 0.8 else rnd.randrange(self.hosts)
+      links.append(self.get_url(target_host, rnd.randrange(self.pages)))
+    # one link excluded by robots.txt
+    links.append('http://site%d.bench/private/p%d' % (host, page))
+    # image link without file extension
+    if rnd.random() < self.binary_rate:
+      links.append('http://site%d.bench/media/p%d' % (host,
+        rnd.randrange(self.pages)))
+    return links
+
+  def get_sitemap_index(self, host):
+    entries = ''.join('<sitemap><loc>http://site%d.bench/sitemap-%d.xml.gz'
+      '</loc><lastmod>2015-05-01</lastmod></sitemap>\n' % (host, i)
+      for i in range(0, self.pages, self.SITEMAP_SIZE))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex ' \
+      'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n%s' \
+      '</sitemapindex>\n' % entries
+
+  def get_sitemap(self, host, first):
+    # pages are modified on a reproducible day of May 2015
+    entries = ''.join('<url><loc>%s</loc><lastmod>2015-05-%02dT12:00:00Z'
+      '</lastmod></url>\n' % (self.get_url(host, page),
+      1 + self.get_random(host, page).randrange(28))
+      for page in range(first, min(first + self.SITEMAP_SIZE, self.pages)))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<urlset ' \
+      'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n%s' \
+      '</urlset>\n' % entries
+
+  def is_redirect(self, host, page):
+    rnd = random.Random('%d/%d/%d/r' % (self.seed, host, page))
+    return rnd.random() < self.redirect_rate
+
+  def get_page(self, host, page):
+    rnd = self.get_random(host, page)
+    if rnd.random() < self.error_rate:
+      return 500, None
+    size = rnd.randint(self.min_size, self.max_size)
+    title = 'Page %d of site %d' % (page, host)
+    anchors = '\n'.join('<a href="%s">link %d</a>' % (link, i)
+      for i, link in enumerate(self.get_links(host, page)))
+    words = ['crawler', 'search', 'rank', 'graph', 'index', 'page', 'host']
+    text = list()
+    length = 0
+    while length < size:
+      word = words[rnd.randrange(len(words))]
+      text.append(word)
+      length += len(word) + 1
+    html = '<html><head><title>%s</title></head><body>\n%s\n<p>%s</p>\n' \
+      '</body></html>\n' % (title, anchors, ' '.join(text))
+    return 200, html
+
+"""
+Request handler of FakeSite.
+"""
+class FakeSiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, code, content_type, body, location = None):
+    self.send_response(code)
+    if location is not None:
+      self.send_header('Location', location)
+    self.send_header('Content-Type', content_type)
+    if content_type.startswith('text/') and \
+       'gzip' in self.headers.get('Accept-Encoding', ''):
+      body = gzip_encode(body)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.server.stats['bytes'] += len(body)
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def do_HEAD(self): self.do_GET()
+
+  def do_GET(self):
+    site = self.server
+    url = urlparse.urlparse(self.path)
+    site.stats['requests'] += 1
+    if site.latency > 0:
+      time.sleep(site.latency)
+
+    m = re.match(r'site(\d+)\.bench$', url.hostname or '')
+    if url.path == '/robots.txt':
+      self.reply(200, 'text/plain', 'User-agent: *\nDisallow: /private\n'
+        'Sitemap: http://%s/sitemap.xml\n' % url.hostname)
+      return
+
+    # sitemap index of gzipped sitemaps
+    s = re.match(r'/sitemap(?:-(\d+)\.xml\.gz|\.xml)$', url.path)
+    if m is not None and s is not None:
+      site.stats['sitemaps'] += 1
+      if s.group(1) is None:
+        self.reply(200, 'application/xml', site.get_sitemap_index(
+          int(m.group(1))))
+      else:
+        self.reply(200, 'application/x-gzip', gzip_encode(site.get_sitemap(
+          int(m.group(1)), int(s.group(1)))))
+      return
+
+    n = re.match(r'/(pages/|media/)?p(\d+)$', url.path)
+    if m is None or n is None:
+      self.reply(404, 'text/html', '<html><body>Not found</body></html>')
+      return
+    host, page = int(m.group(1)), int(n.group(2))
+
+    # image of reproducible size
+    if n.group(1) == 'media/':
+      site.stats['media'] += 1
+      rnd = random.Random('%d/%d/%d/m' % (site.seed, host, page))
+      self.reply(200, 'image/jpeg', '\xff' * rnd.randint(site.min_size,
+        site.max_size * 5))
+      return
+
+    # redirected page moved to /pages folder
+    if site.is_redirect(host, page) and n.group(1) is None:
+      site.stats['redirects'] += 1
+      self.reply(301, 'text/html', '<html><body>Moved</body></html>',
+        '/pages/p%d' % page)
+      return
+
+    code, html = site.get_page(host, page)
+    if html is None:
+      site.stats['errors'] += 1
+      self.reply(code, 'text/html', '<html><body>Error</body></html>')
+      return
+    site.stats['pages'] += 1
+    self.reply(code, 'text/html; charset=utf-8', html)
+
+"""
+Tika text parse server stand-in (tika-app -T -s PORT). Reads a document
+until end of stream or idle timeout and returns its text.
+"""
+class FakeTika(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, port = 0):
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), FakeTikaHandler)
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def get_port(self):
+    return self.server_address[1]
+
+"""
+Request handler of FakeTika.
+"""
+class FakeTikaHandler(SocketServer.BaseRequestHandler):
+
+  def handle(self):
+    # read document, nc may keep the connection half-open
+    data = list()
+    self.request.settimeout(0.2)
+    while True:
+      try:
+        chunk = self.request.recv(65536)
+      except socket.timeout:
+        break
+      if len(chunk) == 0:
+        break
+      data.append(chunk)
+      if '</html>' in chunk.lower():
+        break
+    html = ''.join(data)
+
+    # strip markup, title comes first as in tika text output
+    text = re.sub(r'(?s)<(script|style).*?</\1>', ' ', html)
+    text = re.sub(r'<[^>]*>', ' ', text)
+    text = re.sub(r'[ \t]+', ' ', text).strip()
+    self.request.sendall(text)
+    self.request.close()
@@ -0,0 +1,158 @@
+#
+# End-to-end benchmark of the fetch pipeline (bin/ec-fetch-urls) against local
+# stand-ins of the web, Elasticsearch and Tika (see fakeservers.py). Reports
+# pages per second, CPU time per page and peak RSS, and appends the results
+# to a results file to make regressions visible between runs.
+#
+import os, sys, json, time, shutil, tempfile, argparse, subprocess
+import resource, random, hashlib, signal
+from fakeservers import FakeElasticsearch, FakeSite, FakeTika
+from benchmark import EC_HOME, add_output_option, set_config, get_result, \
+  get_previous, append_result
+
+# parse command line
+def get_options():
+  parser = argparse.ArgumentParser(description='Fetch pipeline benchmark.')
+  parser.add_argument('-u', '--urls', type=int, default=200,
+    help='number of urls to fetch')
+  parser.add_argument('-H', '--hosts', type=int, default=20,
+    help='number of hosts in the site graph')
+  parser.add_argument('-p', '--pages', type=int, default=1000,
+    help='number of pages per host')
+  parser.add_argument('-l', '--links', type=int, default=20,
+    help='number of links per page')
+  parser.add_argument('-L', '--latency', type=float, default=0.0,
+    help='response latency of the site in seconds')
+  parser.add_argument('--min-size', type=int, default=2000,
+    help='minimum page size in bytes')
+  parser.add_argument('--max-size', type=int, default=20000,
+    help='maximum page size in bytes')
+  parser.add_argument('-e', '--error-rate', type=float, default=0.05,
+    help='fraction of pages answered with server error')
+  parser.add_argument('-r', '--redirect-rate', type=float, default=0.05,
+    help='fraction of pages moved permanently')
+  parser.add_argument('-b', '--binary-rate', type=float, default=0.05,
+    help='fraction of pages linking an image without file extension')
+  parser.add_argument('-z', '--compression', action='store_true',
+    help='compress ES traffic (ES_COMPRESSION)')
+  parser.add_argument('-d', '--delay', type=int, default=0,
+    help='HOST_ACCESS_DELAY used by the fetcher')
+  parser.add_argument('-s', '--seed', type=int, default=1,
+    help='seed of the site graph and url sample')
+  add_output_option(parser, 'fetch-benchmark')
+  return parser.parse_args()
+
+# create EC installation pointing at the local servers
+def create_home(workdir, es, tika, options):
+  home = os.path.join(workdir, 'ec')
+  for folder in ['bin', 'lib', 'conf']:
+    shutil.copytree(os.path.join(EC_HOME, folder), os.path.join(home, folder))
+  logs = os.path.join(workdir, 'logs')
+  os.mkdir(logs)
+  set_config(os.path.join(home, 'conf', 'elasticcrawler.conf'), {
+    'ES_HOST' : '127.0.0.1',
+    'ES_PORT' : es.get_port(),
+    'ES_INDEX' : 'bench',
+    'HOST_ACCESS_DELAY' : options.delay,
+    'ES_COMPRESSION' : 'true' if options.compression else 'false',
+    'TIKA_PARSER_PORT' : tika.get_port(),
+    'LOGS_DIRECTORY' : logs,
+  })
+  return home
+
+def main():
+  options = get_options()
+  workdir = tempfile.mkdtemp(prefix='ec-bench-')
+  ret = None
+  try:
+    # start local servers
+    es = FakeElasticsearch(compression=options.compression).start()
+    tika = FakeTika().start()
+    site = FakeSite(hosts=options.hosts, pages=options.pages,
+      links=options.links, latency=options.latency,
+      min_size=options.min_size, max_size=options.max_size,
+      error_rate=options.error_rate, redirect_rate=options.redirect_rate,
+      binary_rate=options.binary_rate, seed=options.seed).start()
+    home = create_home(workdir, es, tika, options)
+
+    # sample urls from the site graph and seed them as new nodes
+    rnd = random.Random(options.seed)
+    urls = os.path.join(workdir, 'urls')
+    with open(urls, 'w') as f:
+      for i in range(options.urls):
+        url = site.get_url(rnd.randrange(options.hosts),
+          rnd.randrange(options.pages))
+        es.put('bench', 'node', hashlib.sha1(url).hexdigest(), {'url' : url})
+        f.write('%s\n' % url)
+
+    # route page fetches through the site graph proxy, ES and Tika go direct
+    env = dict(os.environ)
+    env['http_proxy'] = 'http://127.0.0.1:%d' % site.get_port()
+    env['no_proxy'] = '127.0.0.1,localhost'
+    env['PATH'] = '%s:%s' % (os.path.join(home, 'bin'), env['PATH'])
+    env['EC_METRICS'] = os.path.join(workdir, 'logs', 'bench.metrics')
+
+    # run the fetcher
+    log = os.path.join(workdir, 'fetch.log')
+    usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    time_start = time.time()
+    with open(log, 'w') as f:
+      ret = subprocess.call(['sh', os.path.join(home, 'bin', 'ec-fetch-urls'),
+        urls], stdout=f, stderr=subprocess.STDOUT, env=env)
+    wall = time.time() - time_start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # collect results
+    with open(log) as f:
+      lines = f.readlines()
+    processed = len([l for l in lines if l.startswith('Processing:')])
+    fetched = len([l for l in lines if l.startswith('Fetching:')
+      and l.strip().endswith('OK')])
+    cpu = (usage.ru_utime - usage_start.ru_utime) + \
+      (usage.ru_stime - usage_start.ru_stime)
+
+    result = get_result(options)
+    result['exit'] = ret
+    result['processed'] = processed
+    result['fetched'] = fetched
+    result['wall'] = round(wall, 3)
+    result['pages_per_sec'] = round(processed / wall, 3) if wall > 0 else 0
+    result['cpu_per_page'] = round(cpu / processed, 4) if processed > 0 else 0
+    result['peak_rss_kb'] = usage.ru_maxrss
+    result['es'] = dict(es.stats)
+    result['site'] = dict(site.stats)
+
+    # report results and change since previous run
+    previous = get_previous(options.output, result['params'])
+    print "Exit code: %d (log: %s)" % (ret, log)
+    print "Processed: %d urls, fetched: %d pages" % (processed, fetched)
+    for name in ['wall', 'pages_per_sec', 'cpu_per_page', 'peak_rss_kb']:
+      change = ''
+      if previous is not None and previous[name]:
+        change = ' (%+.1f%% vs %s)' % (100.0 * (result[name] - previous[name])
+          / previous[name], previous['revision'])
+      print "%s: %s%s" % (name, result[name], change)
+    print "ES operations: %s" % json.dumps(result['es'], sort_keys=True)
+
+    # stage latencies recorded by the fetcher
+    if os.path.exists(env['EC_METRICS']):
+      sys.path.append(os.path.join(EC_HOME, 'lib'))
+      import metrics
+      metrics.report(os.path.join(workdir, 'logs'))
+
+    append_result(options.output, result)
+
+    if ret != 0 or processed == 0:
+      sys.exit(1)
+  finally:
+    # stop the helper service started by ec-server start of the fetcher
+    # (HELPER_SOCKET of the benchmark installation)
+    helper_pid = os.path.join(workdir, 'ec', 'helper.sock.pid')
+    if os.path.exists(helper_pid):
+      with open(helper_pid) as f:
+        os.kill(int(f.read()), signal.SIGTERM)
+    if ret == 0:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+  main()
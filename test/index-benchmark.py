@@ -0,0 +1,165 @@
+#
+# Indexing rate benchmark of crawl-like bulk updates (node and page docs)
+# with the default index settings and in bulk-load mode (ec-index -b/-u).
+# Runs against the local Elasticsearch stand-in (see fakeservers.py), or a
+# local Elasticsearch given by --es, where the index settings take effect.
+#
+import os, sys, time, shutil, random, hashlib, tempfile, argparse
+import subprocess, multiprocessing
+from fakeservers import FakeElasticsearch
+from benchmark import EC_HOME, add_output_option, set_config, get_result, \
+  get_previous, append_result
+sys.path.append(os.path.join(EC_HOME, 'lib'))
+from elasticsearch import ElasticSearch
+
+# parse command line
+def get_options():
+  parser = argparse.ArgumentParser(description='Indexing rate benchmark.')
+  parser.add_argument('-d', '--docs', type=int, default=20000,
+    help='number of crawled urls (one node and one page doc each)')
+  parser.add_argument('-b', '--bulk-size', type=int, default=500,
+    help='number of urls per bulk request')
+  parser.add_argument('-j', '--jobs', type=int, default=2,
+    help='number of parallel indexing jobs')
+  parser.add_argument('-l', '--links', type=int, default=20,
+    help='number of outlinks per node')
+  parser.add_argument('-s', '--seed', type=int, default=1,
+    help='seed of the doc generator')
+  parser.add_argument('--es',
+    help='local Elasticsearch HOST:PORT (default: stand-in)')
+  add_output_option(parser, 'index-benchmark')
+  return parser.parse_args()
+
+# create EC installation pointing at the benchmarked ES
+def create_home(workdir, host, port):
+  home = os.path.join(workdir, 'ec')
+  for folder in ['bin', 'lib', 'conf']:
+    shutil.copytree(os.path.join(EC_HOME, folder), os.path.join(home, folder))
+  set_config(os.path.join(home, 'conf', 'elasticcrawler.conf'), {
+    'ES_HOST' : host, 'ES_PORT' : port})
+  return home
+
+# run ec-index command
+def ec_index(home, *args):
+  with open(os.devnull, 'w') as devnull:
+    return subprocess.call(['sh', os.path.join(home, 'bin', 'ec-index')] +
+      list(args), stdout=devnull, stderr=devnull)
+
+# get bulk update actions of a crawled url (node and page upserts)
+def get_actions(rnd, doc, links):
+  url = 'http://h%d.bench/p%d' % (doc / 100, doc)
+  doc_id = hashlib.sha1(url).hexdigest()
+  olinks = ['http://h%d.bench/p%d' % (rnd.randrange(100), rnd.randrange(
+    10000)) for i in range(links)]
+  body = ' '.join(rnd.choice(['crawler', 'search', 'rank', 'graph', 'index'])
+    for i in range(300))
+  return [
+    {'update' : {'_type' : 'page', '_id' : doc_id}},
+    {'doc_as_upsert' : True, 'doc' : {'url' : url, 'title' : 'Page %d' % doc,
+      'body' : body}},
+    {'update' : {'_type' : 'node', '_id' : doc_id}},
+    {'doc_as_upsert' : True, 'doc' : {'url' : url, 'status' : 200,
+      'olinks' : olinks}}]
+
+# index docs of a job (every jobs-th doc), returns number of failed items
+def index_job(args):
+  base, job, jobs, options = args
+  rnd = random.Random('%d/%d' % (options.seed, job))
+  es = ElasticSearch(True)
+  failed = 0
+  actions = list()
+  try:
+    for doc in xrange(job, options.docs, jobs):
+      actions.extend(get_actions(rnd, doc, options.links))
+      if len(actions) >= 4 * options.bulk_size:
+        response = es.bulk('%s/_bulk' % base, actions)
+        failed += len([i for i in response['items']
+          if i['update'].get('status', 500) >= 300])
+        actions = list()
+    if len(actions) > 0:
+      response = es.bulk('%s/_bulk' % base, actions)
+      failed += len([i for i in response['items']
+        if i['update'].get('status', 500) >= 300])
+  finally:
+    es.close()
+  return failed
+
+# index all docs into a new index, bulk-load mode is set before and
+# restored after indexing, returns result of the mode
+def run_mode(home, base, index, bulk, options):
+  ec_index(home, '-d', index)
+  ec_index(home, '-n', index)
+  if bulk:
+    ec_index(home, '-b', index)
+
+  start = time.time()
+  pool = multiprocessing.Pool(options.jobs)
+  try:
+    failed = sum(pool.map(index_job, [('%s/%s' % (base, index), job,
+      options.jobs, options) for job in range(options.jobs)]))
+  finally:
+    pool.close()
+    pool.join()
+  index_time = time.time() - start
+
+  # settings are restored and docs made visible in both modes
+  if bulk:
+    ec_index(home, '-u', index)
+  else:
+    ElasticSearch().post('%s/%s/_refresh' % (base, index), {})
+  total_time = time.time() - start
+  ec_index(home, '-d', index)
+
+  result = dict()
+  result['index_time'] = round(index_time, 3)
+  result['total_time'] = round(total_time, 3)
+  result['docs_per_sec'] = round(2 * options.docs / total_time, 1)
+  result['failed'] = failed
+  return result
+
+def main():
+  options = get_options()
+  result = get_result(options)
+
+  workdir = tempfile.mkdtemp(prefix='ec-bench-')
+  es = None
+  try:
+    if options.es:
+      host, port = options.es.split(':')
+    else:
+      es = FakeElasticsearch().start()
+      host, port = '127.0.0.1', es.get_port()
+    home = create_home(workdir, host, port)
+    base = 'http://%s:%s' % (host, port)
+
+    for mode in ['default', 'bulk']:
+      result[mode] = run_mode(home, base, 'bench-%s' % mode, mode == 'bulk',
+        options)
+      print "Mode %s: %d docs in %.1fs (%.1f docs/s, indexing %.1fs, " \
+        "%d failed)" % (mode, 2 * options.docs, result[mode]['total_time'],
+        result[mode]['docs_per_sec'], result[mode]['index_time'],
+        result[mode]['failed'])
+    if es is not None:
+      result['es'] = dict(es.stats)
+  finally:
+    if es is not None:
+      es.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  result['speedup'] = round(result['bulk']['docs_per_sec'] /
+    result['default']['docs_per_sec'], 3)
+  print "Bulk-load speedup: %.2fx" % result['speedup']
+
+  # report change since previous run
+  previous = get_previous(options.output, result['params'])
+  if previous is not None:
+    print "Bulk-load rate change: %+.1f%%" % (100.0 * (
+      result['bulk']['docs_per_sec'] - previous['bulk']['docs_per_sec']) /
+      previous['bulk']['docs_per_sec'])
+  append_result(options.output, result)
+
+  if result['default']['failed'] > 0 or result['bulk']['failed'] > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
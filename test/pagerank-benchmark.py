@@ -0,0 +1,233 @@
+#
+# PageRank correctness and speed benchmark on reproducible power-law graphs.
+# Runs the production ranking steps (job/ranking-step/ranking.py) against the
+# local Elasticsearch stand-in (see fakeservers.py) and compares the ranks
+# with a local reference solution computed with the same iteration. Ranking
+# generations are started like ec-ranking maps do (see pagerank.py). In pull
+# mode (RANKING_MODE) the inlink index is built by the LINK step first.
+#
+import os, sys, json, time, shutil, random, hashlib, tempfile, argparse
+import subprocess, resource
+from array import array
+from fakeservers import FakeElasticsearch, D
+from benchmark import EC_HOME, add_output_option, set_config, get_result, \
+  get_previous, append_result
+
+RANKING = os.path.join(EC_HOME, 'job', 'ranking-step', 'ranking.py')
+sys.path.append(os.path.join(EC_HOME, 'lib'))
+import pagerank
+
+# parse command line
+def get_options():
+  parser = argparse.ArgumentParser(description='PageRank benchmark.')
+  parser.add_argument('-n', '--nodes', type=int, default=2000,
+    help='number of graph nodes (urls)')
+  parser.add_argument('-e', '--edges', type=int, default=20000,
+    help='approximate number of graph edges (links)')
+  parser.add_argument('-a', '--alpha', type=float, default=2.1,
+    help='power-law exponent of in-degree distribution')
+  parser.add_argument('-i', '--iterations', type=int, default=5,
+    help='number of DIST iterations')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='number of parallel ranking jobs per step')
+  parser.add_argument('-b', '--bulk-size', type=int, default=1000,
+    help='bulk size of ranking jobs')
+  parser.add_argument('-t', '--tolerance', type=float, default=1e-6,
+    help='maximum absolute rank difference from reference')
+  parser.add_argument('-s', '--seed', type=int, default=1,
+    help='seed of the graph generator')
+  parser.add_argument('-m', '--mode', choices=['push', 'pull'],
+    default='push', help='ranking DIST mode')
+  parser.add_argument('--bulk-threads', type=int, default=0,
+    help='concurrent bulk requests of the fake ES before it rejects bulk '
+    'items (0 for no limit), see THROTTLE_* in elasticcrawler.conf')
+  parser.add_argument('--bulk-delay', type=int, default=0,
+    help='time of each bulk request of the fake ES in ms')
+  parser.add_argument('--reference-only', action='store_true',
+    help='run the reference solution only')
+  add_output_option(parser, 'pagerank-benchmark')
+  return parser.parse_args()
+
+# get url of graph node
+def get_url(node):
+  return 'http://g%d.test/%d' % (node / 100, node)
+
+# generate power-law graph as compact source offsets and targets arrays
+def generate_graph(nodes, edges, alpha, seed):
+  rnd = random.Random(seed)
+  offsets = array('l', [0])
+  targets = array('l')
+  mean = float(edges) / nodes
+  exponent = 1.0 / (alpha - 1.0)
+  for source in xrange(nodes):
+    # out-degree with exponential spread around the mean
+    degree = int(rnd.expovariate(1.0 / mean) + 0.5)
+    seen = set()
+    for i in xrange(degree):
+      # in-degree follows power law, low node numbers are popular
+      target = int(nodes * rnd.random() ** (1.0 + exponent * 2)) % nodes
+      if target != source and target not in seen:
+        seen.add(target)
+        targets.append(target)
+    offsets.append(len(targets))
+  return offsets, targets
+
+# reference PageRank with the EC iteration (rank = 1 - D + D * prob)
+def reference_ranks(nodes, offsets, targets, iterations):
+  rank = array('d', [1.0]) * nodes
+  delta = 0.0
+  for iteration in xrange(iterations):
+    prob = array('d', [0.0]) * nodes
+    for source in xrange(nodes):
+      start, stop = offsets[source], offsets[source+1]
+      if stop > start:
+        weight = rank[source] / (stop - start)
+        for k in xrange(start, stop):
+          prob[targets[k]] += weight
+    delta = 0.0
+    for node in xrange(nodes):
+      value = 1.0 - D + D * prob[node]
+      delta = max(delta, abs(rank[node] - value))
+      rank[node] = value
+  return rank, delta
+
+# load graph nodes into ES stand-in, write job input (id<TAB>url) files
+def load_graph(es, workdir, nodes, offsets, targets, jobs):
+  ids = list()
+  inputs = [open(os.path.join(workdir, 'urls.%d' % j), 'w')
+    for j in range(jobs)]
+  for node in xrange(nodes):
+    url = get_url(node)
+    doc_id = hashlib.sha1(url).hexdigest()
+    ids.append(doc_id)
+    olinks = [get_url(targets[k])
+      for k in xrange(offsets[node], offsets[node+1])]
+    es.put('bench', 'node', doc_id, {'url' : url, 'olinks' : olinks})
+    inputs[node % jobs].write('%s\t%s\n' % (doc_id, url))
+  for f in inputs:
+    f.close()
+  return ids
+
+# run ranking step as parallel jobs
+def run_step(home, workdir, step, jobs, bulk_size):
+  procs = list()
+  for j in range(jobs):
+    with open(os.path.join(workdir, 'urls.%d' % j)) as stdin:
+      log = open(os.path.join(workdir, 'ranking.%s.%d.log' % (step, j)), 'a')
+      procs.append(subprocess.Popen(['python', RANKING, home, step,
+        str(bulk_size)], stdin=stdin, stdout=log, stderr=subprocess.STDOUT))
+  return [p.wait() for p in procs]
+
+def main():
+  options = get_options()
+  result = get_result(options)
+
+  # generate graph
+  start = time.time()
+  offsets, targets = generate_graph(options.nodes, options.edges,
+    options.alpha, options.seed)
+  result['edges'] = len(targets)
+  result['generate_time'] = round(time.time() - start, 3)
+  print "Graph: %d nodes, %d edges (%.1fs)" % (options.nodes, len(targets),
+    result['generate_time'])
+
+  # reference solution
+  start = time.time()
+  rank, delta = reference_ranks(options.nodes, offsets, targets,
+    options.iterations)
+  result['reference_time'] = round(time.time() - start, 3)
+  result['reference_delta'] = delta
+  print "Reference: %d iterations, last change %g (%.1fs)" % \
+    (options.iterations, delta, result['reference_time'])
+
+  if not options.reference_only:
+    workdir = tempfile.mkdtemp(prefix='ec-bench-')
+    es = FakeElasticsearch(bulk_threads=options.bulk_threads,
+      bulk_delay=options.bulk_delay / 1000.0).start()
+    try:
+      # EC installation pointing at the local ES
+      home = os.path.join(workdir, 'ec')
+      for folder in ['lib', 'conf']:
+        shutil.copytree(os.path.join(EC_HOME, folder),
+          os.path.join(home, folder))
+      set_config(os.path.join(home, 'conf', 'elasticcrawler.conf'), {
+        'ES_HOST' : '127.0.0.1', 'ES_PORT' : es.get_port(),
+        'ES_INDEX' : 'bench', 'RANKING_MODE' : options.mode})
+      ids = load_graph(es, workdir, options.nodes, offsets, targets,
+        options.jobs)
+
+      # inlink index of pull mode, built once per graph
+      if options.mode == 'pull':
+        start = time.time()
+        codes = run_step(home, workdir, 'LINK', options.jobs,
+          options.bulk_size)
+        if any(code != 0 for code in codes):
+          print "Ranking step LINK failed (see %s)" % workdir
+          sys.exit(1)
+        result['link_time'] = round(time.time() - start, 3)
+        print "Inlink index: %d urls (%.1fs)" % (len(es.ids('bench',
+          'inlink')), result['link_time'])
+      es.stats.clear()
+
+      # run production ranking steps, one DIST pass per iteration
+      steps = ['INIT'] + ['DIST'] * options.iterations + ['RANK']
+      base = 'http://127.0.0.1:%d/bench' % es.get_port()
+      times = dict()
+      start = time.time()
+      for step in steps:
+        step_start = time.time()
+        if step == 'INIT':
+          pagerank.set_generation(base, 0)
+        elif step == 'DIST':
+          pagerank.next_generation(base)
+        codes = run_step(home, workdir, step, options.jobs, options.bulk_size)
+        if any(code != 0 for code in codes):
+          print "Ranking step %s failed (see %s)" % (step, workdir)
+          sys.exit(1)
+        times[step] = times.get(step, 0.0) + time.time() - step_start
+      result['ranking_time'] = round(time.time() - start, 3)
+      result['step_time'] = dict((k, round(v, 3)) for k, v in times.items())
+      result['es'] = dict(es.stats)
+
+      # compare with reference
+      error = 0.0
+      for node in xrange(options.nodes):
+        doc = es.get('bench', 'rank', ids[node])
+        value = doc['rank'] if doc is not None else 0.0
+        error = max(error, abs(value - rank[node]))
+      result['max_error'] = error
+      result['correct'] = error <= options.tolerance
+      print "Ranking: %d steps in %.1fs %s" % (len(steps),
+        result['ranking_time'], json.dumps(result['step_time'],
+        sort_keys=True))
+      print "Update operations: %d bulk items, %d scripts, %d mget docs" % \
+        (es.stats['bulk_items'], es.stats['script'], es.stats['mget_docs'])
+      if options.bulk_threads > 0:
+        print "Rejected bulks: %d (%d items, retried by the throttle)" % \
+          (es.stats['bulk_rejected'], es.stats['bulk_items_rejected'])
+      print "Maximum rank error: %g (%s)" % (error,
+        'OK' if result['correct'] else 'FAILED')
+    finally:
+      es.shutdown()
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  # peak memory of benchmark and ranking jobs
+  result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  result['peak_job_rss_kb'] = \
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  print "Peak RSS: %d kB (jobs %d kB)" % (result['peak_rss_kb'],
+    result['peak_job_rss_kb'])
+
+  # report change since previous run
+  previous = get_previous(options.output, result['params'])
+  if previous is not None and previous.get('ranking_time') and \
+     result.get('ranking_time'):
+    print "Ranking time change: %+.1f%%" % (100.0 * (result['ranking_time'] -
+      previous['ranking_time']) / previous['ranking_time'])
+  append_result(options.output, result)
+
+  if result.get('correct') is False:
+    sys.exit(2)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,111 @@
+#
+# Memory and lookup time benchmark of url id maps: python dicts of hex url
+# ids (the representation of ec-reparse before lib/urlids.py) against
+# compact id maps. Each representation is built and looked up in a separate
+# process, memory is its RSS growth.
+#
+import os, sys, time, random, hashlib, argparse
+import multiprocessing
+from benchmark import EC_HOME, add_output_option, get_result, get_previous, \
+  append_result
+sys.path.append(os.path.join(EC_HOME, 'lib'))
+import urlids
+
+# benchmarked representations
+REPRESENTATIONS = ['hex', 'idmap']
+
+# parse command line
+def get_options():
+  parser = argparse.ArgumentParser(description='Url id map benchmark.')
+  parser.add_argument('-n', '--ids', type=int, default=1000000,
+    help='number of url ids in the map')
+  parser.add_argument('-l', '--lookups', type=int, default=200000,
+    help='number of lookups (half of them hits)')
+  parser.add_argument('-s', '--seed', type=int, default=1,
+    help='seed of the lookup generator')
+  add_output_option(parser, 'urlids-benchmark')
+  return parser.parse_args()
+
+# get hex url id of the nth url
+def get_id(n):
+  return hashlib.sha1('http://h%d.bench/p%d' % (n / 100, n)).hexdigest()
+
+# get resident set size of the process in bytes
+def get_rss():
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+# build representation of ids, the value of an id is its number (like the
+# packed record locations of ec-reparse)
+def build(representation, ids):
+  if representation == 'hex':
+    return dict((get_id(n), n) for n in xrange(ids))
+  return urlids.build_map((urlids.to_binary(get_id(n)), n)
+    for n in xrange(ids))
+
+# build representation and time lookups of hex ids, in a child process
+def run_representation(args):
+  representation, options = args
+  rnd = random.Random(options.seed)
+  # half of the lookups are ids in the set, ids are generated up front
+  lookups = [get_id(rnd.randrange(options.ids) if i % 2 == 0 else
+    options.ids + i) for i in xrange(options.lookups)]
+  rss = get_rss()
+  start = time.time()
+  ids = build(representation, options.ids)
+  build_time = time.time() - start
+  memory = get_rss() - rss
+
+  start = time.time()
+  if representation == 'hex':
+    found = sum(1 for url_id in lookups if ids.get(url_id) is not None)
+  else:
+    found = sum(1 for url_id in lookups
+      if ids.get_value(urlids.to_binary(url_id)) is not None)
+  lookup_time = time.time() - start
+
+  result = dict()
+  result['build_time'] = round(build_time, 3)
+  result['memory_bytes'] = memory
+  result['bytes_per_id'] = round(float(memory) / options.ids, 1)
+  result['lookup_us'] = round(1000000 * lookup_time / options.lookups, 2)
+  result['found'] = found
+  return result
+
+def main():
+  options = get_options()
+  result = get_result(options)
+
+  for representation in REPRESENTATIONS:
+    pool = multiprocessing.Pool(1)
+    try:
+      result[representation] = pool.apply(run_representation,
+        [(representation, options)])
+    finally:
+      pool.close()
+      pool.join()
+    print "Ids %s: %.1f bytes/id, %.2f us/lookup, built in %.1fs " \
+      "(%d found)" % (representation,
+      result[representation]['bytes_per_id'],
+      result[representation]['lookup_us'],
+      result[representation]['build_time'],
+      result[representation]['found'])
+
+  result['memory_ratio'] = round(float(result['hex']['memory_bytes']) /
+    max(result['idmap']['memory_bytes'], 1), 2)
+  print "Memory of hex ids over id map: %.1fx" % result['memory_ratio']
+
+  # report change since previous run
+  previous = get_previous(options.output, result['params'])
+  if previous is not None:
+    print "Id map lookup time change: %+.1f%%" % (100.0 * (
+      result['idmap']['lookup_us'] - previous['idmap']['lookup_us']) /
+      previous['idmap']['lookup_us'])
+  append_result(options.output, result)
+
+  # all representations find the same ids
+  if len(set(result[r]['found'] for r in REPRESENTATIONS)) > 1:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()